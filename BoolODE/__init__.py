@@ -1,5 +1,6 @@
 import os
 import sys
+import hashlib
 import yaml
 import argparse
 import itertools
@@ -10,6 +11,7 @@ from typing import Dict, List
 from BoolODE import model_generator as mg
 from BoolODE import run_experiment as runexp
 from BoolODE import post_processing as po
+from BoolODE import utils
 
 
 class GlobalSettings(object):
@@ -74,15 +76,43 @@ class BoolODE(object):
             data['outprefix'] = Path(self.global_settings.output_dir, job.get('name'))
             data['modelpath'] = Path(self.global_settings.model_dir, job.get('model_definition',''))
             data['simulation_time'] = job.get('simulation_time',20)
-            data['icsPath'] = Path(self.global_settings.model_dir, job.get('model_initial_conditions',''))
+            data['auto_time_pilot'] = job.get('auto_time_pilot',20)
+            data['auto_time_max'] = job.get('auto_time_max',50)
+            data['auto_time_margin'] = job.get('auto_time_margin',0.2)
+            data['auto_time_quantile'] = job.get('auto_time_quantile',0.9)
+            data['auto_ics'] = job.get('model_initial_conditions','') == 'auto'
+            data['icsPath'] = Path(self.global_settings.model_dir,
+                                   '' if data['auto_ics'] else job.get('model_initial_conditions',''))
             data['num_cells'] = job.get('num_cells',100)
+            # By default each job draws from its own stream, set by its name
+            data['seed'] = job.get('seed', int(hashlib.sha1(str(data['name']).encode()).hexdigest()[:8], 16))
             data['sample_cells'] = job.get('sample_cells',False)
             data['nClusters'] = job.get('nClusters',1)
+            data['attractor_max_nodes'] = job.get('attractor_max_nodes',18)
+            data['attractor_walks'] = job.get('attractor_walks',1000)
             data['doParallel'] = job.get('do_parallel',False)            
+            data['parallel_backend'] = job.get('parallel_backend','files')
+            data['async_write'] = job.get('async_write',False)
+            data['write_queue_size'] = job.get('write_queue_size',64)
+            data['max_memory'] = job.get('max_memory',None)
             data['identical_pars'] = job.get('identical_pars',False)
             data['sample_pars'] = job.get('sample_pars',False)
             data['sample_std'] = job.get('sample_std',0.1)
+            data['cell_parameters'] = job.get('cell_parameters',False)
+            data['cell_parameters_std'] = job.get('cell_parameters_std',0.1)
+            data['perturbations'] = job.get('perturbations',None)
+            data['common_random_numbers'] = job.get('common_random_numbers',False)
+            data['adaptive_allocation'] = job.get('adaptive_allocation',False)
+            data['allocation_pilot'] = job.get('allocation_pilot',0.5)
+            data['allocation_rounds'] = job.get('allocation_rounds',2)
+            data['split_time'] = job.get('split_time',None)
+            data['stop_on_convergence'] = job.get('stop_on_convergence',False)
+            data['convergence_tol'] = job.get('convergence_tol',0.02)
+            data['min_cells'] = job.get('min_cells',100)
+            data['convergence_step'] = job.get('convergence_step',None)
             data['integration_step_size'] = job.get('integration_step_size',0.01)            
+            data['record_step_size'] = job.get('record_step_size',None)
+            data['batch_size'] = job.get('batch_size',1)
             # Optional Settings
             data['parameter_inputs_path'] = Path(self.global_settings.model_dir,\
                                                  job.get('parameter_inputs_path',''))
@@ -94,6 +124,25 @@ class BoolODE(object):
                                              job.get('species_type',''))            
             # Simulator settings
             data['burnin'] = job.get('burn_in',False)
+            data['burn_in_time'] = job.get('burn_in_time',1.0)
+            data['burn_in_step_size'] = job.get('burn_in_step_size',None)
+            data['burn_in_pool_size'] = job.get('burn_in_pool_size',100)
+            # Shared by all the jobs in output_dir
+            data['burnInCachePath'] = Path(self.global_settings.output_dir, 'burnin-cache')
+            data['steady_state'] = job.get('steady_state',False)
+            data['steady_state_window'] = job.get('steady_state_window',1.0)
+            data['steady_state_tol'] = job.get('steady_state_tol',0.1)
+            data['steady_state_fill'] = job.get('steady_state_fill','pad')
+            data['integrator'] = job.get('integrator','euler')
+            data['adaptive_atol'] = job.get('adaptive_atol',0.05)
+            data['adaptive_rtol'] = job.get('adaptive_rtol',0.05)
+            data['adaptive_max_step'] = job.get('adaptive_max_step',0.2)
+            data['noise_step_size'] = job.get('noise_step_size',None)
+            data['snapshot'] = job.get('snapshot',False)
+            data['snapshot_times'] = job.get('snapshot_times',None)
+            data['snapshots_per_cell'] = job.get('snapshots_per_cell',1)
+            data['record_velocity'] = job.get('record_velocity',False)
+            data['record_jacobian'] = job.get('record_jacobian',False)
             data['writeProtein'] = job.get('write_protein',False)
             data['normalizeTrajectory'] = job.get('normalize_trajectory',False)
             data['add_dummy'] = job.get('add_dummy',False)
@@ -132,12 +181,78 @@ class BoolODE(object):
             print('Starting post processing')
             self.do_post_processing()
 
+    def plan_jobs(self):
+        '''
+        Estimate the runtime, memory and disk use of each job without
+        running it, see run_experiment.planRun(). Prints a table of the
+        estimates, with the recommended number of parallel workers: at
+        most the number of CPUs and of batches, such that the workers
+        and the collection of the cells fit in 80% of the memory.
+        Warns if the output or the peak memory exceed what is available.
+        '''
+        import shutil
+        import pandas as pd
+        import multiprocessing as mp
+        try:
+            memory = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+        except (ValueError, OSError, AttributeError):
+            memory = None
+        gensampleJobs = None
+        if self.global_settings.do_post_processing:
+            gensampleJobs = self.post_settings.gensample_jobs or [{}]
+        rows = {}
+        for jobid in self.jobs.keys():
+            settings = self.jobs[jobid]
+            plan = runexp.planRun(settings, gensampleJobs)
+            if plan is None:
+                continue
+            workers = min(mp.cpu_count(), plan['batches'])
+            if memory is not None:
+                workers = min(workers, max(1, int((0.8*memory - plan['peak_memory_bytes'])\
+                                                  /plan['worker_memory_bytes'])))
+            rows[settings['name']] = {'cells': plan['cells'],
+                                      'species': plan['species'],
+                                      'steps': plan['steps'],
+                                      'rhs_ms': 1e3*plan['evaluation_time'],
+                                      'cpu_h': plan['cpu_time']/3600,
+                                      'workers': workers,
+                                      'wall_h': plan['cpu_time']/3600/(workers if settings['doParallel'] else 1),
+                                      'sim_disk_MB': plan['simulation_bytes']/1e6,
+                                      'post_disk_MB': plan['post_processing_bytes']/1e6,
+                                      'peak_mem_MB': plan['peak_memory_bytes']/1e6,
+                                      'worker_mem_MB': plan['worker_memory_bytes']/1e6}
+        planDF = pd.DataFrame.from_dict(rows, orient='index')
+        print('Estimated cost of each job')
+        print('--------------------------')
+        print(planDF.to_string(float_format=lambda v: '%.3g' % v))
+        print('wall_h assumes the recommended workers for jobs with do_parallel')
+        if planDF.empty:
+            return planDF
+        outdir = Path(self.global_settings.output_dir).resolve()
+        while not outdir.exists():
+            outdir = outdir.parent
+        free = shutil.disk_usage(outdir).free
+        disk = 1e6*(planDF['sim_disk_MB'].sum() + planDF['post_disk_MB'].sum())
+        print('Total disk use: %.3g MB, %.3g MB free in %s' % (disk/1e6, free/1e6, outdir))
+        if disk > free:
+            print('Warning: the output does not fit on the disk')
+        if memory is not None:
+            for name, row in planDF.iterrows():
+                if 1e6*(row['peak_mem_MB'] + row['workers']*row['worker_mem_MB']) > memory:
+                    print('Warning: job %s may run out of memory (%.3g MB available)' % (name, memory/1e6))
+        return planDF
+
     def do_post_processing(self):
         """
         Call genSamples() first. Then run DimRed runSlingShot,  
         generateDropouts, if specified by the user.
         """
         alljobs =  list(self.jobs.keys())
+        # nClusters: auto is set when a job is simulated, otherwise
+        # it is read back from the attractors of an earlier run
+        for jobid in alljobs:
+            if self.jobs[jobid]['nClusters'] == 'auto':
+                self.jobs[jobid]['nClusters'] = utils.getAttractorCount(self.jobs[jobid]['outprefix'])
         filetypedict = {'expr':'ExpressionData.csv',
                         'pseudo':'PseudoTime.csv',
                         'refNet':'refNetwork.csv'}
@@ -163,14 +278,22 @@ class BoolODE(object):
                 gensample_jobs = self.post_settings.gensample_jobs
             for gsamp in gensample_jobs:
                 for jobid in alljobs:
-                    settings = {}
-                    settings['num_cells'] = self.jobs[jobid]['num_cells']
-                    settings['sample_size'] = gsamp.get('sample_size', 100)
-                    settings['outPrefix'] = str(self.jobs[jobid]['outprefix'])
-                    settings['nDatasets'] = gsamp.get('nDatasets', 1)
-                    settings['name'] = self.jobs[jobid]['name']
-                    settings['nClusters'] = self.jobs[jobid]['nClusters']
-                    generatedPaths[jobid] = po.genSamples(settings)
+                    generatedPaths[jobid] = []
+                    # The unperturbed cells, and the cells of each perturbation
+                    for outPrefix in utils.getOutputFolders(self.jobs[jobid]['outprefix']):
+                        settings = {}
+                        settings['num_cells'] = self.jobs[jobid]['num_cells']
+                        settings['sample_size'] = gsamp.get('sample_size', 100)
+                        settings['outPrefix'] = outPrefix
+                        settings['nDatasets'] = gsamp.get('nDatasets', 1)
+                        settings['name'] = self.jobs[jobid]['name']
+                        settings['nClusters'] = self.jobs[jobid]['nClusters']
+                        settings['jacobian_format'] = gsamp.get('jacobian_format', 'sparse')
+                        if settings['jacobian_format'] not in ['sparse', 'dense']:
+                            print("Error in GenSamples settings")
+                            print("jacobian_format should be one of 'sparse' or 'dense'")
+                            sys.exit()
+                        generatedPaths[jobid].extend(po.genSamples(settings))
         
         if self.post_settings.dropout_jobs is not None:
             print('Starting genDropouts...')
@@ -0,0 +1,309 @@
+import re
+import ast
+import numpy as np
+import pandas as pd
+from scipy.integrate import odeint
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, breadth_first_order
+
+def booleanUpdate(mg):
+    """
+    Returns a function that evaluates the Boolean rules of the model on
+    a batch of states. Each rule is evaluated with bitwise operators on
+    the states packed eight to a byte, so that a single operation updates
+    eight states at once.
+
+    Nodes without a rule that are parameter inputs are held constant, ON
+    if their input value is above the Hill threshold.
+
+    :param mg: Model details obtained by instantiating an object of GenerateModel
+    :type mg: BoolODE.GenerateModel
+    :returns:
+        - nodes: List of the nodes of the Boolean model
+        - update: Function mapping a boolean array of shape (states, nodes) to the states after applying every rule
+    """
+    nodes = list(mg.df['Gene'].values)
+    rules = []
+    for rule in mg.df['Rule'].values:
+        rule = re.sub(r'\bnot\b', '~', rule)
+        rule = re.sub(r'\band\b', '&', rule)
+        rule = re.sub(r'\bor\b', '|', rule)
+        rules.append(compile(rule, '<rule>', 'eval'))
+    hillThreshold = mg.kineticParameterDefaults['hillThreshold']
+    inputs = {i:mg.par[i] > hillThreshold for i in mg.inputs if i in mg.par}
+
+    def update(states):
+        numStates = len(states)
+        packed = np.packbits(states, axis=0, bitorder='little')
+        namespace = {node:packed[:, i] for i, node in enumerate(nodes)}
+        for i, on in inputs.items():
+            namespace[i] = np.full(len(packed), 255 if on else 0, dtype=np.uint8)
+        newStates = np.empty_like(states)
+        for i, rule in enumerate(rules):
+            newStates[:, i] = np.unpackbits(np.broadcast_to(eval(rule, {}, namespace), len(packed)).astype(np.uint8),
+                                            count=numStates, bitorder='little')
+        return newStates
+    return nodes, update
+
+def booleanAttractors(mg, initialStates=None, maxNodes=18, numWalks=1000):
+    """
+    Find the attractors of the asynchronous Boolean dynamics, in which a
+    single node changes state at a time. These are the terminal strongly
+    connected components of the state transition graph. If initialStates
+    are given, only the attractors reachable from them are returned,
+    otherwise those of the whole state space.
+
+    The graph is built over the states reachable from initialStates, or
+    over all states, as long as they number at most 2^maxNodes. Otherwise,
+    numWalks random walks are started from initialStates, or from random
+    states, and only the fixed points they reach are returned.
+
+    Without initialStates, a state is also chosen from which the largest
+    number of attractors is reachable, with as few nodes ON as possible.
+    Only the attractors reachable from it are returned.
+
+    :param mg: Model details obtained by instantiating an object of GenerateModel
+    :type mg: BoolODE.GenerateModel
+    :param initialStates: Boolean array of shape (states, nodes), or None
+    :type initialStates: ndarray
+    :param maxNodes: Largest size of the state transition graph, as a number of nodes
+    :type maxNodes: int
+    :param numWalks: Number of random walks, if the graph is too large
+    :type numWalks: int
+    :returns:
+        - nodes: List of the nodes of the Boolean model
+        - attractors: List of boolean arrays of shape (states, nodes), the states of each attractor
+        - root: Boolean array of the chosen initial state, or None
+    """
+    nodes, update = booleanUpdate(mg)
+    numNodes = len(nodes)
+    bits = np.left_shift(1, np.arange(numNodes, dtype=np.int64)) if numNodes < 63 else None
+
+    def decode(codes):
+        return (codes[:, np.newaxis] & bits) > 0
+
+    def successors(codes):
+        states = decode(codes)
+        rows, cols = np.nonzero(update(states) != states)
+        return rows, codes[rows] ^ bits[cols]
+
+    codes = None
+    if initialStates is None:
+        if numNodes <= maxNodes:
+            codes = np.arange(2**numNodes, dtype=np.int64)
+    elif bits is not None:
+        # Breadth-first search of the states reachable from initialStates
+        codes = np.unique(initialStates.astype(np.int64) @ bits)
+        frontier = codes
+        while len(frontier) > 0 and len(codes) <= 2**maxNodes:
+            frontier = np.setdiff1d(np.unique(successors(frontier)[1]), codes, assume_unique=True)
+            codes = np.union1d(codes, frontier)
+        if len(codes) > 2**maxNodes:
+            codes = None
+
+    if codes is None:
+        print('The Boolean state space is too large to search, starting %d random walks' % numWalks)
+        rng = np.random.default_rng(0)
+        if initialStates is None:
+            states = rng.random((numWalks, numNodes)) < 0.5
+        else:
+            states = initialStates[rng.integers(len(initialStates), size=numWalks)].copy()
+        for _ in range(100*numNodes):
+            mismatch = update(states) != states
+            moving = mismatch.any(axis=1)
+            if not moving.any():
+                break
+            # Flip one of the nodes whose rule disagrees with its state
+            pick = (rng.random(mismatch.shape)*mismatch).argmax(axis=1)
+            states[moving, pick[moving]] = ~states[moving, pick[moving]]
+        moving = (update(states) != states).any(axis=1)
+        if moving.any():
+            print('%d random walks did not reach a fixed point' % moving.sum())
+        attractors = [fp[np.newaxis] for fp in np.unique(states[~moving], axis=0)]
+        return nodes, attractors, None
+
+    rows, targets = successors(codes)
+    rows = rows.astype(np.int64)
+    targets = np.searchsorted(codes, targets)
+    graph = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, targets)), shape=(len(codes), len(codes)))
+    numComponents, labels = connected_components(graph, directed=True, connection='strong')
+    leaving = np.unique(labels[rows][labels[rows] != labels[targets]])
+    terminal = np.setdiff1d(np.arange(numComponents), leaving)
+    members = [np.flatnonzero(labels == c) for c in terminal]
+    root = None
+    if initialStates is None:
+        # Number of attractors reachable from each state
+        reverse = graph.T.tocsr()
+        basins = []
+        for m in members:
+            basin = np.zeros(len(codes), dtype=bool)
+            basin[breadth_first_order(reverse, m[0], directed=True, return_predecessors=False)] = True
+            basins.append(basin)
+        reachable = np.sum(basins, axis=0)
+        candidates = np.flatnonzero(reachable == reachable.max())
+        states = decode(codes[candidates])
+        rootIndex = candidates[np.lexsort((codes[candidates], states.sum(axis=1)))[0]]
+        root = decode(codes[[rootIndex]])[0]
+        members = [m for m, basin in zip(members, basins) if basin[rootIndex]]
+    attractors = [decode(codes[m]) for m in sorted(members, key=lambda m: codes[m].min())]
+    return nodes, attractors, root
+
+def booleanLevels(mg, nodes, states, parValues):
+    """
+    Map Boolean states to the levels of the model variables: ON genes
+    are set to the steady state of their mRNA and protein at full
+    activation, ON proteins to y_max, and OFF nodes to 0.
+
+    :returns:
+        - Y: Array of shape (states, variables)
+    """
+    revvarmapper = {v:k for k,v in mg.varmapper.items()}
+    Y = np.zeros((len(states), len(mg.varmapper)))
+    for i, node in enumerate(nodes):
+        on = states[:, i].astype(float)
+        if node in mg.genelist:
+            x = on*parValues['m_' + node]/parValues['l_x_' + node]
+            Y[:, revvarmapper['x_' + node]] = x
+            Y[:, revvarmapper['p_' + node]] = x*parValues['r_' + node]/parValues['l_p_' + node]
+        elif node in mg.proteinlist:
+            Y[:, revvarmapper['p_' + node]] = on*parValues['y_max']
+    return Y
+
+def fullJacobian(mg, Jacobian, JacobianIndex, pars):
+    """
+    Returns a function computing the full Jacobian matrix of the model.
+    Jacobian() holds the derivatives along the edges of the network,
+    to which the linear degradation and translation terms are added.
+    """
+    parValues = dict(zip(sorted(mg.ModelSpec['pars'].keys()), pars))
+    revvarmapper = {v:k for k,v in mg.varmapper.items()}
+    linear = np.zeros((len(mg.varmapper), len(mg.varmapper)))
+    for i, var in mg.varmapper.items():
+        linear[i, i] -= parValues[mg.ModelSpec['decay'][var]]
+    for g in mg.genelist:
+        linear[revvarmapper['p_' + g], revvarmapper['x_' + g]] += parValues['r_' + g]
+    index = np.array(JacobianIndex, dtype=int).reshape(-1, 2)
+
+    def jacobian(Y):
+        J = linear.copy()
+        np.add.at(J, (index[:, 0], index[:, 1]), Jacobian(Y, 0, pars))
+        return J
+    return jacobian
+
+def newtonFixedPoint(Model, jacobian, pars, y0, tol=1e-8, maxIter=100):
+    """
+    Solve Model(Y) = 0 by damped Newton iterations starting from y0,
+    keeping the variables non-negative.
+
+    :returns:
+        - y: The last iterate
+        - converged: True if the largest derivative at y is below tol
+    """
+    y = np.asarray(y0, dtype=float)
+    f = np.asarray(Model(y, 0, pars))
+    for _ in range(maxIter):
+        if np.abs(f).max() < tol:
+            return y, True
+        step = np.linalg.lstsq(jacobian(y), -f, rcond=None)[0]
+        damping = 1.
+        while damping > 1e-4:
+            yNew = np.maximum(y + damping*step, 0.)
+            fNew = np.asarray(Model(yNew, 0, pars))
+            if np.linalg.norm(fNew) < np.linalg.norm(f):
+                break
+            damping /= 2
+        else:
+            break
+        y, f = yNew, fNew
+    return y, np.abs(f).max() < tol
+
+def findAttractors(mg, Model, Jacobian, JacobianIndex, settings, icsDF):
+    """
+    Precompute the attractors of the model. The attractors of the
+    Boolean model reachable from the initial conditions in icsDF are
+    found with booleanAttractors(), or if icsDF is empty, all of them
+    together with an initial state from which they are reachable.
+    Each attractor is then refined to a stable fixed point of the ODE
+    model by Newton iterations from its Boolean states, after relaxing
+    the deterministic dynamics if needed. Attractors that refine to the
+    same fixed point are merged, and those without a stable fixed point
+    are kept at the mean level of their Boolean states, as 'oscillating'
+    if they hold several states, or 'unresolved' otherwise.
+
+    The attractors are written to Attractors.csv in the job folder, and
+    the initial state, if one is chosen, to InitialConditions.txt in the
+    format of model_initial_conditions.
+
+    :param mg: Model details obtained by instantiating an object of GenerateModel
+    :type mg: BoolODE.GenerateModel
+    :param Model: Function defining ODE model
+    :type Model: function
+    :param Jacobian: Function returning the Jacobian entries along the edges of the network
+    :type Jacobian: function
+    :param JacobianIndex: List of (target, regulator) variable indices of the entries returned by Jacobian
+    :type JacobianIndex: list
+    :param settings: The job settings dictionary
+    :type settings: dict
+    :param icsDF: Dataframe specifying initial condition for simulation
+    :type icsDF: pandas DataFrame
+    :returns:
+        - attractorDF: DataFrame of the attractors, with their kind and the gene expression levels
+        - rootDF: Dataframe of the chosen initial condition, or None
+    """
+    parNames = sorted(mg.ModelSpec['pars'].keys())
+    pars = [mg.ModelSpec['pars'][k] for k in parNames]
+    parValues = dict(zip(parNames, pars))
+    nodes = list(mg.df['Gene'].values)
+    x_max = mg.kineticParameterDefaults['x_max']
+    y_max = mg.kineticParameterDefaults['y_max']
+    initialStates = None
+    if not icsDF.empty:
+        # Species at least half their maximum level are ON
+        initialStates = np.zeros((len(icsDF), len(nodes)), dtype=bool)
+        for row, (_, icsspec) in enumerate(icsDF.iterrows()):
+            icsmap = dict(zip(ast.literal_eval(icsspec['Genes']), ast.literal_eval(icsspec['Values'])))
+            for i, node in enumerate(nodes):
+                level = x_max if node in mg.genelist else y_max
+                initialStates[row, i] = icsmap.get(node, 0.) >= level/2
+    nodes, boolAttractors, root = booleanAttractors(mg, initialStates,
+                                                    maxNodes=settings['attractor_max_nodes'],
+                                                    numWalks=settings['attractor_walks'])
+    jacobian = fullJacobian(mg, Jacobian, JacobianIndex, pars)
+    rnaIndex = [i for i in range(len(mg.varmapper)) if 'x_' in mg.varmapper[i]]
+    rows = []
+    levels = []
+    with np.errstate(under='ignore', over='ignore'):
+        for states in boolAttractors:
+            y0 = booleanLevels(mg, nodes, states, parValues).mean(axis=0)
+            y, converged = newtonFixedPoint(Model, jacobian, pars, y0)
+            stable = converged and np.linalg.eigvals(jacobian(y)).real.max() < 0
+            if not stable:
+                relaxed = odeint(Model, y0, np.linspace(0, settings['simulation_time'], 100), args=(pars,))[-1]
+                y, converged = newtonFixedPoint(Model, jacobian, pars, relaxed)
+                stable = converged and np.linalg.eigvals(jacobian(y)).real.max() < 0
+            if not stable:
+                y = y0
+            x = y[rnaIndex]
+            if stable and any(kind == 'fixed point' and np.abs(x - other).max() < 0.05*x_max\
+                              for (kind, _), other in zip(rows, levels)):
+                continue
+            if stable:
+                kind = 'fixed point'
+            else:
+                kind = 'oscillating' if len(states) > 1 else 'unresolved'
+            rows.append((kind, len(states)))
+            levels.append(x)
+    attractorDF = pd.DataFrame(levels, columns=[mg.varmapper[i].replace('x_','') for i in rnaIndex],
+                               index=pd.Index(['A' + str(i) for i in range(len(rows))]))
+    attractorDF.insert(0, 'boolean_states', [n for _, n in rows])
+    attractorDF.insert(0, 'kind', [kind for kind, _ in rows])
+    attractorDF.to_csv(str(settings['outprefix']) + '/Attractors.csv')
+    print('Found %d attractors' % len(attractorDF))
+    rootDF = None
+    if root is not None:
+        on = [node for node, b in zip(nodes, root) if b]
+        rootDF = pd.DataFrame({'Genes':[str(on)],
+                               'Values':[str([x_max if node in mg.genelist else y_max for node in on])]})
+        rootDF.to_csv(str(settings['outprefix']) + '/InitialConditions.txt', sep='\t', index=False)
+        print('Initial conditions: ' + (', '.join(on) if len(on) > 0 else 'all nodes OFF'))
+    return attractorDF, rootDF
@@ -1,26 +1,11 @@
 #!/usr/bin/env python
 # coding: utf-8
 __author__ = 'Amogh Jalihal'
-import os
-import sys
-import ast
-import yaml
-import time
-import warnings
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from pathlib import Path
-import multiprocessing as mp
-from optparse import OptionParser
 from itertools import combinations
-from scipy.integrate import odeint
-from sklearn.cluster import KMeans
-from typing import Dict, List
 # local imports
 from BoolODE import utils
-from BoolODE import simulator 
-from importlib.machinery import SourceFileLoader
 
 class GenerateModel:
     """Class that holds model attributes. Provides helper functions to convert a Boolean model
@@ -55,10 +40,13 @@ class GenerateModel:
         self.withoutRules = list()
         self.allnodes = set()
         self.varspecs = dict()
+        self.decay = dict()
+        self.jacobian = dict()
         self.varmapper = dict()
         self.par = dict()
         self.parmapper = dict()
         self.kineticParameterDefaults = dict()
+        self.kineticParameters = list()
         self.inputs = list()
         self.genelist = list()
         self.proteinlist = list()
@@ -107,7 +95,7 @@ class GenerateModel:
             reg = [t for t in tokens if t not in ['not','and','or','']]
             self.allnodes.update(set(reg))
     
-        self.withoutRules = list(self.allnodes.difference(set(self.withRules)))
+        self.withoutRules = sorted(self.allnodes.difference(set(self.withRules)))
 
         ## Every node without a rule is treated as follows:
         ## If the user has specified a Parameter Input file treat as parameter, else 
@@ -269,6 +257,12 @@ class GenerateModel:
         else:
             self.assignDefaultParameterValues(parameterNamePrefixAndDefaultsAll,
                                      parameterNamePrefixAndDefaultsGenes)
+        ## Names of the kinetic parameters, which may vary between cells
+        self.kineticParameters = [parPrefix + node\
+                                  for parPrefix in list(parameterNamePrefixAndDefaultsAll.keys())\
+                                  + list(parameterNamePrefixAndDefaultsGenes.keys())\
+                                  for node in self.withRules\
+                                  if parPrefix + node in self.par]
 
         # Final check:
         # Update user defined parameter values
@@ -396,7 +390,7 @@ class GenerateModel:
                     self.par[parPrefix + node] = sparval
 
     def createRegulatoryTerms(self, currgene, combinationOfRegulators,
-                              regSpecies):
+                              regSpecies, derivativeOf=None):
         """Creates the terms in the activation function which governs
         the transcriptional state of the gene. 
         If modeltype is 'hill', each term is composed of products of Hill functions, ranging over
@@ -409,6 +403,8 @@ class GenerateModel:
         :type currgene: str
         :param combinationOfRegulators: a list of all combinations of regulators of currgene
         :type combinationOfRegulators: list
+        :param derivativeOf: If specified, returns the partial derivative of the term with respect to the protein of this regulator
+        :type derivativeOf: str
         """
         strengthSpecified = False
         if not self.interactionStrengthDF.empty:
@@ -426,7 +422,9 @@ class GenerateModel:
                 else:
                     hillThresholdName = 'k_' + reg
 
-                if reg in regSpecies:
+                if reg == derivativeOf:
+                    hills.append('n_' + reg + '/' + hillThresholdName + '*(p_'+ reg +'/'+hillThresholdName+')^(n_'+ reg + '-1)')
+                elif reg in regSpecies:
                     hills.append('(p_'+ reg +'/'+hillThresholdName+')^n_'+ reg)
                 else:
                     # Note: Only proteins can be regulators
@@ -436,7 +434,10 @@ class GenerateModel:
         elif self.settings['modeltype'] == 'heaviside':
             terms = []
             for reg in combinationOfRegulators:
-                terms.append('p_' + reg)
+                if reg == derivativeOf:
+                    terms.append('1.')
+                else:
+                    terms.append('p_' + reg)
             mult = '*'.join(terms)
             return mult        
                     
@@ -502,6 +503,11 @@ class GenerateModel:
                 den = '( 1'
             elif self.settings['modeltype'] == 'heaviside':
                exponent = '- sigmaH_' + currgene +'*( omega_' + currgene
+            # Partial derivatives of the regulatory terms with respect
+            # to each regulator that is a variable of the model
+            dnum = {reg:'( 0' for reg in regSpecies}
+            dden = {reg:'( 0' for reg in regSpecies}
+            dexponent = {reg:'( 0' for reg in regSpecies}
 
             # Loop over combinations of regulators        
             for i in range(1,len(allreg) + 1):
@@ -514,6 +520,17 @@ class GenerateModel:
                         num += ' + a_' + currgene +'_'  + '_'.join(list(combinationOfRegulators)) + '*' + regulatorExpression
                     elif self.settings['modeltype'] == 'heaviside':
                         exponent += ' + w_' + currgene + '_' + '_'.join(list(combinationOfRegulators)) +'*' + regulatorExpression
+
+                    for reg in regSpecies:
+                        if reg not in combinationOfRegulators:
+                            continue
+                        dregulatorExpression = self.createRegulatoryTerms(currgene, combinationOfRegulators,
+                                                                           regSpecies, derivativeOf=reg)
+                        if self.settings['modeltype'] == 'hill':
+                            dden[reg] += ' +' + dregulatorExpression
+                            dnum[reg] += ' + a_' + currgene +'_'  + '_'.join(list(combinationOfRegulators)) + '*' + dregulatorExpression
+                        elif self.settings['modeltype'] == 'heaviside':
+                            dexponent[reg] += ' + w_' + currgene + '_' + '_'.join(list(combinationOfRegulators)) +'*' + dregulatorExpression
     
                     # evaluate rule to assign values to parameters
                     ##################################################
@@ -539,19 +556,30 @@ class GenerateModel:
                 num += ' )'
                 den += ' )'
                 f = '(' + num + '/' + den + ')'
+                # Quotient rule
+                df = {reg:'((' + dnum[reg] + ' ))*' + den + ' - ' + num + '*(' + dden[reg] + ' )))/' + den + '^2'
+                      for reg in regSpecies}
             elif self.settings['modeltype'] == 'heaviside':
                 # In the case of heaviside expressions, to prevent
                 # numerical blowup, we trucate the magnitude of the
                 # regulatory terms
                 exponent += ')'
                 maxexp = '10.' # '100'
-                f = '(1./(1. + np.exp(np.sign('+exponent+')*min(' +maxexp +',abs(' + exponent+ ')))))'
+                # np.minimum keeps the expression valid for a batch of states
+                f = '(1./(1. + np.exp(np.sign('+exponent+')*np.minimum(' +maxexp +',abs(' + exponent+ ')))))'
+                # The derivative vanishes where the exponent is truncated
+                df = {reg:'(-' + f + '*(1. - ' + f + ')*(abs(' + exponent + ') < ' + maxexp + ')' \
+                      + '*(- sigmaH_' + currgene + '*' + dexponent[reg] + ' )))'
+                      for reg in regSpecies}
             
             if currgene in self.proteinlist:
                 Production =  f
                 Degradation = 'p_' + currgene
                 self.varspecs['p_' + currgene] = 'signalingtimescale*(y_max*' + Production \
                                            + '-' + Degradation + ')'
+                self.decay['p_' + currgene] = 'signalingtimescale'
+                for reg in regSpecies:
+                    self.jacobian[('p_' + currgene, 'p_' + reg)] = 'signalingtimescale*y_max*' + df[reg]
             else:
                 
                 Production = 'm_'+ currgene + '*' + f
@@ -560,6 +588,10 @@ class GenerateModel:
                                            + '-' + Degradation
                 # Create the corresponding translated protein equation
                 self.varspecs['p_' + currgene] = 'r_'+currgene+'*'+'x_' +currgene + '- l_p_'+currgene+'*'+'p_' + currgene
+                self.decay['x_' + currgene] = 'l_x_' + currgene
+                self.decay['p_' + currgene] = 'l_p_' + currgene
+                for reg in regSpecies:
+                    self.jacobian[('x_' + currgene, 'p_' + reg)] = 'm_' + currgene + '*' + df[reg]
                 
         ##########################################################                                       
             
@@ -577,6 +609,8 @@ class GenerateModel:
         self.ModelSpec['varspecs'] = self.varspecs
         self.ModelSpec['pars'] = self.par
         self.ModelSpec['ics'] = ics
+        self.ModelSpec['decay'] = self.decay
+        self.ModelSpec['jacobian'] = self.jacobian
         
         self.varmapper = {i:var for i,var in enumerate(self.ModelSpec['varspecs'].keys())}
         self.parmapper = {i:par for i,par in enumerate(self.ModelSpec['pars'].keys())}
@@ -592,14 +626,16 @@ class GenerateModel:
         3. A list of parameters pars
 
         The function returns a vector of time derivatives computed from the ODEs.
-        Model() is written model.py in the directory of the current job
+        Model() is written model.py in the directory of the current job.
+        Jacobian() takes the same arguments, and returns the derivatives of each
+        variable with respect to the proteins regulating it, in the order
+        of the (target, regulator) variable indices listed in JacobianIndex.
         """
         self.path_to_ode_model = self.settings['outprefix'] / 'model.py'
 
         with open(self.path_to_ode_model,'w') as out:
             out.write('#####################################################\n')
-            # SZ: use autograd.numpy here for computing jacobian later 
-            out.write('import autograd.numpy as np\n')
+            out.write('import numpy as np\n')
             out.write('# This file is created automatically\n')
             out.write('def Model(Y,t,pars):\n')
             out.write('    # Parameters\n')
@@ -618,6 +654,35 @@ class GenerateModel:
 
             out.write('    dY = np.array([' + outstr+ '])\n')
             out.write('    return(dY)\n')
+            out.write('#####################################################\n')
+            # Jacobian entries along the edges of the network, i.e. the
+            # derivative of each target variable with respect to the
+            # protein of each of its regulators
+            varindex = {var:i for i, var in self.varmapper.items()}
+            edges = sorted(self.ModelSpec['jacobian'].keys(),
+                           key=lambda e: (varindex[e[0]], varindex[e[1]]))
+            out.write('JacobianIndex = [' + ', '.join('(' + str(varindex[target]) + ', '
+                                                    + str(varindex[reg]) + ')'
+                                                    for target, reg in edges) + ']\n')
+            out.write('def Jacobian(Y,t,pars):\n')
+            out.write('    # Parameters\n')
+            for i,p in enumerate(par_names):
+                out.write('    ' + p + ' = pars[' + str(i) + ']\n')
+            out.write('    # Variables\n')
+            for i in range(len(self.varmapper.keys())):
+                out.write('    ' + self.varmapper[i] + ' = Y[' + str(i) + ']\n')
+            outstr = ''
+            for j, edge in enumerate(edges):
+                jdef = self.ModelSpec['jacobian'][edge]
+                jdef = jdef.replace('^','**')
+                out.write('    J' + str(j) + ' = ' + jdef + '\n')
+                # Broadcast constant entries to the shape of a variable
+                outstr += 'J' + str(j) + '+0.*Y[0],'
+            if len(edges) > 0:
+                out.write('    dJ = np.array([' + outstr + '])\n')
+            else:
+                out.write('    dJ = np.zeros((0,) + np.shape(Y[0]))\n')
+            out.write('    return(dJ)\n')
             out.write('#####################################################')
 
     
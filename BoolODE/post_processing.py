@@ -1,20 +1,27 @@
 import os
 from tqdm import tqdm
-import autograd.numpy as np
-from autograd import jacobian
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from sklearn.cluster import KMeans
-from sklearn.manifold import TSNE
-import matplotlib.pyplot as plt
 from itertools import product
-from BoolODE import model_generator as mg
+from BoolODE import utils
 from importlib.machinery import SourceFileLoader
 
 def genSamples(opts):
     """
     Generate samples of cells from a given set of simulations. This sample
     will then be used for other post processing steps. 
+    If the simulations were carried out in snapshot mode, cells are sampled
+    from the captured states of each trajectory in simulations/Snapshots.csv.
+    The velocities and Jacobians of the sampled cells are read from the
+    files written with record_velocity and record_jacobian if present, and
+    otherwise computed for all sampled cells at once using the Model() and
+    Jacobian() functions in model.py, with the parameters of each cell in
+    simulations/CellParameters.csv if present.
+    If opts['jacobian_format'] is 'sparse', only the entries along the edges
+    between genes are written to JacobianData.npz, see utils.readJacobianData().
+    If it is 'dense', the entries of all pairs of genes are written to
+    JacobianData.csv.
     """
 
     numclusters = opts['nClusters']
@@ -28,9 +35,32 @@ def genSamples(opts):
         print('sample_size should be less than num of experiments')
         sample_size = num_simulations
         
-    df = pd.read_csv(opts['outPrefix'] + '/simulations/E0.csv',index_col=0)
-    df_full = pd.read_csv(opts['outPrefix'] + '/simulations/Efull0.csv',index_col=0)
-    maxtime = len(df.columns)
+    snapshotPath = opts['outPrefix'] + '/simulations/Snapshots.csv'
+    snapshots = os.path.isfile(snapshotPath)
+    if snapshots:
+        snapshotDF = pd.read_csv(snapshotPath, index_col=0)
+        capturesOf = {}
+        for c in snapshotDF.columns:
+            capturesOf.setdefault(int(c.split('_')[0][1:]), []).append(c)
+        velocityPath = opts['outPrefix'] + '/simulations/SnapshotVelocity.csv'
+        jacobianPath = opts['outPrefix'] + '/simulations/SnapshotJacobian.csv'
+        recordedV = os.path.isfile(velocityPath)
+        recordedJ = os.path.isfile(jacobianPath)
+        if recordedV:
+            snapshotVDF = pd.read_csv(velocityPath, index_col=0)
+        if recordedJ:
+            snapshotJDF = pd.read_csv(jacobianPath, index_col=0)
+    else:
+        df = pd.read_csv(opts['outPrefix'] + '/simulations/E0.csv',index_col=0)
+        df_full = pd.read_csv(opts['outPrefix'] + '/simulations/Efull0.csv',index_col=0)
+        maxtime = len(df.columns)
+        recordedV = os.path.isfile(opts['outPrefix'] + '/simulations/V0.csv')
+        recordedJ = os.path.isfile(opts['outPrefix'] + '/simulations/J0.csv')
+    parDF = pd.read_csv(opts['outPrefix'] + '/simulations/param.csv', index_col=0)
+    pars = parDF.to_numpy().flatten()
+    cellParPath = opts['outPrefix'] + '/simulations/CellParameters.csv'
+    cellParDF = pd.read_csv(cellParPath, index_col=0) if os.path.isfile(cellParPath) else None
+    model = SourceFileLoader("model", opts['outPrefix'] + '/model.py').load_module()
 
     generatedPaths = []
     for did in range(1, opts['nDatasets'] + 1):
@@ -46,52 +76,93 @@ def genSamples(opts):
         simids = np.random.choice(range(num_simulations), size=sample_size, replace=False)
         fids = ['E'+ str(sid) + '.csv' for sid in simids]            
         fids_full = ['Efull'+ str(sid) + '.csv' for sid in simids]            
-        timepoints = np.random.choice(range(1,maxtime), size=sample_size)
+        if snapshots:
+            cellids = [np.random.choice(capturesOf[sid]) for sid in simids]
+            timepoints = [int(cid.split('_')[1]) for cid in cellids]
+        else:
+            timepoints = np.random.choice(range(1,maxtime), size=sample_size)
+            cellids = ['E' + str(sid) + '_' + str(t) for sid, t in zip(simids, timepoints)] 
         min_t = min(timepoints)
         max_t = max(timepoints)
-        pts = [(t - min_t)/(max_t - min_t) for t in timepoints]
-        cellids = ['E' + str(sid) + '_' + str(t) for sid, t in zip(simids, timepoints)] 
+        # All cells may have been captured at the same time point in snapshot mode
+        pts = [(t - min_t)/max(max_t - min_t, 1) for t in timepoints]
         # Read simulations from input dataset #psetid
         # to build a sample
         sample = []
         sample_full = []
-        # SZ: store Jacobians and velocity vectors
+        # Recorded Jacobians and velocity vectors
         sample_jac = []
         sample_v = []
-        # SZ: autograd for Jacobian
-        pars=list(pd.read_csv(opts['outPrefix'] + '/simulations/param.csv', index_col=0).to_numpy().flatten())
-        print('Prefix: ', opts['outPrefix'])
-        model = SourceFileLoader("model", opts['outPrefix'] + '/model.py').load_module()
-        model_f = lambda x: model.Model(x, None, pars)
-        JModel = jacobian(model_f)
-        for fid, fid_full, cid in tqdm(zip(fids, fids_full, cellids)):
-            df = pd.read_csv( opts['outPrefix'] + '/simulations/' + fid, index_col=0)
+        for sid, fid, fid_full, cid in tqdm(zip(simids, fids, fids_full, cellids)):
+            if snapshots:
+                df_full = snapshotDF[[cid]]
+                df = df_full.loc[[i for i in df_full.index if i.startswith('x_')]]
+                df.index = pd.Index([i[2:] for i in df.index])
+            else:
+                df = pd.read_csv( opts['outPrefix'] + '/simulations/' + fid, index_col=0)
             df.sort_index(inplace=True)
             sample.append(df[cid].to_frame())
             # SZ: sample full gene+protein expr state for Jacobian calculation
             # janky code but it works??
-            df_full = pd.read_csv( opts['outPrefix'] + '/simulations/' + fid_full, index_col=0)
+            if not snapshots:
+                df_full = pd.read_csv( opts['outPrefix'] + '/simulations/' + fid_full, index_col=0)
             sample_full.append(df_full[cid].to_frame())
-            # don't sort index for Jacobian calculation
-            J = JModel(df_full[cid].to_numpy().flatten())
-            x_id = [i for (i, x) in enumerate(df_full.index) if 'x_' in x]
-            p_id = [i for (i, x) in enumerate(df_full.index) if 'p_' in x]
-            g_list = [x.split('_')[1] for (i, x) in enumerate(df_full.index) if 'x_' in x]
-            interactionlist = list([x + '_' + y for (x, y) in product(g_list, repeat = 2)])
-            sample_jac.append(pd.DataFrame(J[x_id, :][:, p_id].flatten(), index = pd.Index(interactionlist)))
-            # calculate velocity
-            sample_v.append(pd.DataFrame(model_f(df_full[cid].to_numpy().flatten())[x_id], index = pd.Index(g_list)))
+            if recordedJ:
+                Jdf = snapshotJDF if snapshots else pd.read_csv(opts['outPrefix'] + '/simulations/J' + str(sid) + '.csv', index_col=0)
+                sample_jac.append(Jdf[cid].to_frame())
+            if recordedV:
+                Vdf = snapshotVDF if snapshots else pd.read_csv(opts['outPrefix'] + '/simulations/V' + str(sid) + '.csv', index_col=0)
+                sample_v.append(Vdf[cid].to_frame())
             
         sampledf = pd.concat(sample,axis=1)
         sampledf.to_csv(outfpath + '/ExpressionData.csv')
+        # The full state keeps the order of the variables in model.py
         sampledf_full = pd.concat(sample_full,axis=1)
+        samplePars = pars
+        if cellParDF is not None:
+            # The parameters of the trajectory of each sampled cell
+            samplePars = list(pars)
+            parIndex = list(parDF.index)
+            for k in cellParDF.columns:
+                samplePars[parIndex.index(k)] = cellParDF.loc[['E' + str(sid) for sid in simids], k].values
         sampledf_full.to_csv(outfpath + '/ExpressionData_full.csv')
-        sampledf_jac = pd.concat(sample_jac,axis=1)
+        species = list(sampledf_full.index)
+        g_list = [x[2:] for x in species if x.startswith('x_')]
+        if recordedJ:
+            sampledf_jac = pd.concat(sample_jac,axis=1)
+        else:
+            # Evaluate the Jacobian of every sampled cell in one call
+            edgelist = [species[i][2:] + '_' + species[j][2:] for i, j in model.JacobianIndex]
+            with np.errstate(under='ignore'):
+                J = model.Jacobian(sampledf_full.values, None, samplePars)
+            sampledf_jac = pd.DataFrame(J, index=pd.Index(edgelist))
         sampledf_jac.columns = sampledf.columns
-        sampledf_jac.to_csv(outfpath + '/JacobianData.csv')
-        sampledf_v = pd.concat(sample_v,axis=1)
+        if opts['jacobian_format'] == 'sparse':
+            # Regulator->target interactions between genes
+            interactions = set([x + '_' + y for (x, y) in product(g_list, repeat = 2)])
+            edges = [e for e in sampledf_jac.index if e in interactions]
+            utils.writeJacobianData(outfpath + '/JacobianData.npz', sampledf_jac.loc[edges], g_list)
+        else:
+            # Dense regulator->target interactions between genes. Only the edges
+            # of the network are nonzero
+            interactionlist = list([x + '_' + y for (x, y) in product(g_list, repeat = 2)])
+            sampledf_jac = sampledf_jac.reindex(interactionlist, fill_value=0.)
+            sampledf_jac.to_csv(outfpath + '/JacobianData.csv')
+        if recordedV:
+            sampledf_v = pd.concat(sample_v,axis=1).reindex(g_list)
+        else:
+            x_id = [i for (i, x) in enumerate(species) if x.startswith('x_')]
+            with np.errstate(under='ignore'):
+                V = model.Model(sampledf_full.values, None, samplePars)[x_id]
+            sampledf_v = pd.DataFrame(V, index=pd.Index(g_list))
         sampledf_v.columns = sampledf.columns
         sampledf_v.to_csv(outfpath + '/VelocityData.csv')
+        if os.path.isfile(opts['outPrefix'] + '/simulations/CellWeights.csv'):
+            # Weights of the sampled cells, see adaptive_allocation
+            weightDF = pd.read_csv(opts['outPrefix'] + '/simulations/CellWeights.csv', index_col=0)
+            weightDF = weightDF.loc[['E' + str(sid) for sid in simids], ['weight']]
+            weightDF.index = pd.Index(cellids)
+            weightDF.to_csv(outfpath + '/CellWeights.csv')
         ## Read refNetwork.csv
         refdf = pd.read_csv(opts['outPrefix'] + '/refNetwork.csv')
         refdf.to_csv(outfpath + '/refNetwork.csv',index=False)
@@ -157,6 +228,8 @@ def doDimRed(opts):
     """
     Carry out dimensionality reduction
     """
+    from sklearn.manifold import TSNE
+    import matplotlib.pyplot as plt
     ExpDF = pd.read_csv(opts['expr'],index_col=0, header = 0)
     ptDF = pd.read_csv(opts['pseudo'],index_col=0, header = 0)
     perplexity = opts['perplexity']
@@ -185,6 +258,8 @@ def computeSSPT(opts):
     E.g., Bifurcating: k=3 (1 initial and 2 terminal)
     E.g., Trifurcating: k=4 (1 initial and 3 terminal)
     '''
+    from sklearn.cluster import KMeans
+    import matplotlib.pyplot as plt
     ExpDF = pd.read_csv(opts['expr'],index_col=0, header = 0)
     ptDF = pd.read_csv(opts['pseudo'],index_col=0, header = 0)
     nClust = opts['nClusters']
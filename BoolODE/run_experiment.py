@@ -4,35 +4,36 @@ __author__ = 'Amogh Jalihal'
 import os
 import sys
 import ast
+import json
 import time
-import warnings
-# import numpy as np
+import hashlib
+import shutil
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from pathlib import Path
-from optparse import OptionParser
-from itertools import combinations, product
-from scipy.integrate import odeint
-from sklearn.cluster import KMeans
+from itertools import combinations
 from importlib.machinery import SourceFileLoader
 import multiprocessing as mp
 # local imports
 from BoolODE import utils
 from BoolODE.model_generator import GenerateModel
 from BoolODE import simulator
-
-# SZ: import autograd
-import autograd.numpy as np
-from autograd import elementwise_grad, grad, jacobian
+from BoolODE.writer import AsyncWriter, STATS, combineStats
 
 np.seterr(all='raise')
 
+# Background writer of this process, see startWriter()
+outputWriter = None
+
 def Experiment(mg, Model,
                tspan,
                settings,
                icsDF,
                writeProtein=False,
-               normalizeTrajectory=False):
+               normalizeTrajectory=False,
+               Jacobian=None,
+               JacobianIndex=None):
     """
     Carry out an `in-silico` experiment. This function takes as input 
     an ODE model defined as a python function and carries out stochastic
@@ -58,6 +59,12 @@ def Experiment(mg, Model,
     :type writeProtein: bool
     :param normalizeTrajectory: Bool specifying if the gene expression values should be scaled between 0 and 1.
     :type normalizeTrajectory: bool 
+    :param Jacobian: Function returning the Jacobian entries along the edges of the network, required if settings['record_jacobian']
+    :type Jacobian: function
+    :param JacobianIndex: List of (target, regulator) variable indices of the entries returned by Jacobian
+    :type JacobianIndex: list
+    :returns:
+        - results: Dictionary mapping the output folder of the unperturbed cells, and of each perturbation in settings['perturbations'], to a DataFrame of the simulated gene expression values. When simulated in chunks (see max_memory), the DataFrame only holds the columns of ExpressionData.csv, see finishFold().
     """
     ####################    
     allParameters = dict(mg.ModelSpec['pars'])
@@ -82,22 +89,40 @@ def Experiment(mg, Model,
                 # TODO: try setting to threshold < v < y_max
                 ss[i] = 20.
             
-    if not icsDF.empty:
-        icsspec = icsDF.loc[0]
+    # Each row of the initial conditions file is a separate set of
+    # initial conditions. The cells are split evenly between them.
+    ssList = []
+    for _, icsspec in icsDF.iterrows():
         genes = ast.literal_eval(icsspec['Genes'])
         values = ast.literal_eval(icsspec['Values'])
         icsmap = {g:v for g,v in zip(genes,values)}
-        for i,k in mg.varmapper.items():
-            for p in mg.proteinlist:
-                if p in icsmap.keys():
-                    ss[revvarmapper['p_'+p]] = icsmap[p]
-                else:
-                    ss[revvarmapper['p_'+p]] = 0.01
-            for g in mg.genelist:
-                if g in icsmap.keys():
-                    ss[revvarmapper['x_'+g]] = icsmap[g]
-                else:
-                    ss[revvarmapper['x_'+g]] = 0.01
+        ssi = ss.copy()
+        for p in mg.proteinlist:
+            if p in icsmap.keys():
+                ssi[revvarmapper['p_'+p]] = icsmap[p]
+            else:
+                ssi[revvarmapper['p_'+p]] = 0.01
+        for g in mg.genelist:
+            if g in icsmap.keys():
+                ssi[revvarmapper['x_'+g]] = icsmap[g]
+            else:
+                ssi[revvarmapper['x_'+g]] = 0.01
+        ssList.append(ssi)
+    if len(ssList) == 0:
+        ssList.append(ss)
+    ss = ssList[0]
+    if settings['adaptive_allocation']:
+        # Size of the first round, the remaining cells are split off from it
+        pilotSize = min(settings['num_cells'],
+                        max(settings['nClusters'], int(round(settings['allocation_pilot']*settings['num_cells']))))
+    else:
+        pilotSize = settings['num_cells']
+    # Set of initial conditions of each cell
+    if settings['stop_on_convergence']:
+        # Any number of cells is split evenly
+        icsIndex = np.arange(settings['num_cells']) % len(ssList)
+    else:
+        icsIndex = ((np.arange(settings['num_cells']) % pilotSize)*len(ssList))//pilotSize
             
     if len(mg.proteinlist) == 0:
         result = pd.DataFrame(index=pd.Index([mg.varmapper[i] for i in rnaIndex]))
@@ -106,9 +131,14 @@ def Experiment(mg, Model,
         speciesoi.extend([revvarmapper['x_' + g] for g in mg.genelist])
         result = pd.DataFrame(index=pd.Index([mg.varmapper[i] for i in speciesoi]))
         
-    # Index of every possible time point. Sample from this list
+    # Only every recordStride-th integration step is written to file
+    if settings['record_step_size'] is None:
+        recordStride = 1
+    else:
+        recordStride = max(1, int(round(settings['record_step_size']/settings['integration_step_size'])))
+    # Index of every possible recorded time point. Sample from this list
     startat = 0
-    timeIndex = [i for i in range(startat, len(tspan))]        
+    timeIndex = [i for i in range(startat, len(tspan[::recordStride]))]
 
     ## Construct dictionary of arguments to be passed
     ## to simulateAndSample(), done in parallel
@@ -121,6 +151,7 @@ def Experiment(mg, Model,
     argdict['tspan'] = tspan
     argdict['varmapper'] = mg.varmapper
     argdict['timeIndex'] = timeIndex
+    argdict['recordStride'] = recordStride
     argdict['genelist'] = mg.genelist
     argdict['proteinlist'] = mg.proteinlist
     argdict['writeProtein'] = writeProtein
@@ -133,6 +164,71 @@ def Experiment(mg, Model,
     argdict['proteinIndex'] = proteinIndex
     argdict['revvarmapper'] = revvarmapper
     argdict['x_max'] = mg.kineticParameterDefaults['x_max']
+    if settings['steady_state']:
+        # Steady state tolerances are relative to the maximum level of each species
+        argdict['steadyStateWindow'] = int(round(settings['steady_state_window']/(tspan[1] - tspan[0])))
+        argdict['steadyStateScale'] = np.array([mg.kineticParameterDefaults['x_max'] if 'x_' in mg.varmapper[i]\
+                                                else mg.kineticParameterDefaults['y_max']\
+                                                for i in range(len(mg.varmapper.keys()))])
+    else:
+        argdict['steadyStateWindow'] = None
+        argdict['steadyStateScale'] = 1.
+    argdict['steadyStateTol'] = settings['steady_state_tol']
+    argdict['steadyStateFill'] = settings['steady_state_fill']
+    argdict['integrator'] = settings['integrator']
+    argdict['noiseStep'] = settings['noise_step_size']
+    # Rate of the linear degradation term of each variable
+    argdict['decay'] = np.array([allParameters[mg.ModelSpec['decay'][mg.varmapper[i]]]\
+                                 for i in range(len(mg.varmapper.keys()))])
+    argdict['decayIndex'] = [parNames.index(mg.ModelSpec['decay'][mg.varmapper[i]])\
+                             for i in range(len(mg.varmapper.keys()))]
+    argdict['adaptiveOptions'] = {'atol': settings['adaptive_atol'],
+                                  'rtol': settings['adaptive_rtol'],
+                                  'maxStep': settings['adaptive_max_step']}
+
+    if settings['snapshot']:
+        # Sampling plan: the recorded time points at which each trajectory
+        # is captured. Only these states are kept by the integrator.
+        if settings['snapshot_times'] is not None:
+            recordTimes = tspan[::recordStride]
+            captureAt = np.unique(np.clip(np.round(np.array(settings['snapshot_times'], dtype=float)\
+                                                   /(recordTimes[1] - recordTimes[0])).astype(int),
+                                          1, len(recordTimes) - 1))
+            captures = np.tile(captureAt, (settings['num_cells'], 1))
+        else:
+            captures = np.array([np.sort(np.random.choice(timeIndex[1:],
+                                                          size=settings['snapshots_per_cell'],
+                                                          replace=False))\
+                                 for _ in range(settings['num_cells'])])
+        if settings['steady_state']:
+            print('Steady state detection is not carried out in snapshot mode')
+    argdict['snapshot'] = settings['snapshot']
+    argdict['sharedBuffers'] = None
+    argdict['initialStates'] = None
+    argdict['splitIndex'] = 0
+    argdict['prefixStates'] = None
+    argdict['streams'] = None
+    icsSets = np.array([simulator.getInitialCondition(ssi, mg.ModelSpec, rnaIndex, proteinIndex,
+                                                      mg.genelist, mg.proteinlist,
+                                                      mg.varmapper, revvarmapper)\
+                        for ssi in ssList])
+    if len(icsSets) > 1:
+        print('Splitting %d cells between %d sets of initial conditions' % (settings['num_cells'], len(icsSets)))
+    if settings['burnin']:
+        # One pool per set of initial conditions
+        pools = np.array([burnIn(argdict, y0, settings) for y0 in icsSets])
+        # Each cell starts from a state drawn from the pool of its set
+        burnInIndex = np.random.choice(pools.shape[1], size=settings['num_cells'])
+        cellStates = pools[icsIndex, burnInIndex]
+    elif len(icsSets) > 1:
+        cellStates = icsSets[icsIndex]
+    else:
+        cellStates = None
+    argdict['recordVelocity'] = settings['record_velocity']
+    argdict['Jacobian'] = Jacobian if settings['record_jacobian'] else None
+    # Edges are labelled target_regulator
+    argdict['edgelist'] = [mg.varmapper[i][2:] + '_' + mg.varmapper[j][2:]\
+                           for i, j in (JacobianIndex or [])]
 
     if settings['sample_cells']:
         # pre-define the time points from which a cell will be sampled
@@ -143,48 +239,756 @@ def Experiment(mg, Model,
                   zip(range(settings['num_cells']), sampleAt)]
         
         argdict['header'] = header
+    # Column of each cell written to ExpressionData.csv when there are too
+    # many to write them all. Chosen before any cell is simulated, so that
+    # the choice does not depend on how the cells are simulated.
+    if settings['snapshot']:
+        columnsPerCell = captures.shape[1]
+    elif settings['sample_cells']:
+        columnsPerCell = 1
     else:
-        # initialize dictionary to hold raveled values, used to cluster
-        # This will be useful later.
-        groupedDict = {}         
-
-    simfilepath = Path(outPrefix, './simulations/')
-    if not os.path.exists(simfilepath):
-        print(simfilepath, "does not exist, creating it...")
-        os.makedirs(simfilepath)
+        columnsPerCell = len(timeIndex) - 1
+    columnPicks = np.random.randint(columnsPerCell, size=settings['num_cells'])
+
+    if settings['async_write']:
+        startWriter(settings['write_queue_size'])
+    cells = setUpPerturbations(mg, settings, cellStates, icsSets[icsIndex])
+    variantPrefixes = cells['prefixes']
+    argdict['cellPars'] = None
+    argdict['cellParNames'] = cells['parNames']
+    # With the shared and thread backends, the recorded states of every
+    # cell are written by the workers into one shared array, and only
+    # written to file by this process once all cells are simulated
+    shared = settings['parallel_backend'] in ['shared', 'thread'] and not settings['snapshot']
+    gid = [i for i, n in mg.varmapper.items() if 'x_' in n]
+    numStored = len(timeIndex) - 1
+    # With max_memory, the cells are simulated in chunks, each of which is
+    # folded into the outputs before the next one starts
+    chunkSize = None
+    if settings['max_memory'] is not None:
+        chunkSize = memoryChunkSize(settings, numStored, len(mg.varmapper), len(mg.genelist),
+                                    len(argdict['edgelist']), shared)
+        if chunkSize < cells['total']:
+            print('Simulating %d cells in chunks of %d to stay within max_memory=%g GB'\
+                  % (cells['total'], chunkSize, settings['max_memory']))
+            folds = {prefix: startFold() for prefix in variantPrefixes}
+        else:
+            chunkSize = None
+    chunked = chunkSize is not None
+    if shared:
+        # When chunked, the array holds one chunk at a time
+        sharedHandles, argdict['sharedBuffers'], sharedArrays, writeBlock =\
+            startSharedBuffers(settings, chunkSize if chunked else cells['total'], numStored,
+                               mg, argdict['edgelist'])
     print('Starting simulations')
     start = time.time()
 
-    if settings['doParallel']:
-        with mp.Pool() as pool:
-            jobs = []
-            for cellid in range(settings['num_cells']):
-                cell_args = dict(argdict, seed=cellid, cellid=cellid)
-                job = pool.apply_async(simulateAndSample, args=(cell_args,))
-                jobs.append(job)
-                
-            for job in jobs:
-                job.wait()
-    else:
-        for cellid in tqdm(range(settings['num_cells'])):
-            argdict['seed'] = cellid
-            argdict['cellid'] = cellid
-            simulateAndSample(argdict)
+    # Cells are simulated in blocks of batch_size, which are integrated together
+    simulated = pilotSize if settings['adaptive_allocation'] else cells['total']
+    waves, checkpoints = planWaves(settings, simulated, cells['numCells'], chunkSize, cells['crn'])
+    convergence = {'endpoints': [], 'checks': [], 'passed': 0}
+    results = []
+    done = 0
+    for waveEnd in waves:
+        # Row of the first cell of the wave in the shared array
+        rowOffset = done if chunked else 0
+        blocks = [np.arange(i, min(i + settings['batch_size'], waveEnd))\
+                  for i in range(done, waveEnd, settings['batch_size'])]
+        blockArgs = [blockArguments(cells, block, rowOffset, captures if settings['snapshot'] else None)\
+                     for block in blocks]
+        waveResults = simulateBlocks(argdict, blockArgs, settings['doParallel'],
+                                     settings['parallel_backend'] == 'thread',
+                                     writeBlock if shared else None)
+        results.extend(waveResults)
+        for (summary, _, _, _), block in zip(waveResults, blocks):
+            # Seed of the accepted trajectory, after any restarts
+            cells['seeds'][block] = summary['seed'].values
+        if chunked:
+            foldWave(folds, cells, np.arange(done, waveEnd), mg.genelist, gid, columnPicks,
+                     sharedArrays['states'] if shared else None, rowOffset)
+        if settings['stop_on_convergence']:
+            convergence['endpoints'].append(waveEndpoints(waveResults, blocks, mg.genelist, gid, outPrefix,
+                                                          captures if settings['snapshot'] else None,
+                                                          sharedArrays['states'] if shared else None,
+                                                          rowOffset))
+            if waveEnd in checkpoints:
+                if settings['snapshot']:
+                    captureTimes = captures[:waveEnd]/(len(timeIndex) - 1)
+                elif settings['sample_cells']:
+                    captureTimes = sampleAt[:waveEnd, np.newaxis]/(len(timeIndex) - 1)
+                else:
+                    captureTimes = None
+                checkConvergence(convergence, waveEnd, captureTimes, settings, mg.genelist)
+        done = waveEnd
+        if settings['stop_on_convergence'] and done < simulated and convergence['passed'] >= 2:
+            print('Statistics converged within %g after %d cells' % (settings['convergence_tol'], done))
+            break
+    if settings['stop_on_convergence']:
+        pd.DataFrame(convergence['checks']).set_index('cells').to_csv(outPrefix + '/simulations/Convergence.csv')
+        if done < simulated:
+            # The remaining cells are not simulated
+            cells['numCells'] = cells['total'] = settings['num_cells'] = done
+            cells['localIndex'] = cells['localIndex'][:done]
+            cells['variantIndex'] = cells['variantIndex'][:done]
+            if cells['pars'] is not None:
+                cells['pars'] = cells['pars'][:done]
+            icsIndex = icsIndex[:done]
+            if settings['burnin']:
+                burnInIndex = burnInIndex[:done]
+    if settings['adaptive_allocation']:
+        # Spend the rest of the cells on the under-represented branches
+        cellStart = cells['states'] if cells['states'] is not None else icsSets[icsIndex]
+        splitResults, origin = allocateToBranches(argdict, settings, pilotSize, cellStart, cells['pars'],
+                                                  sharedArrays['states'] if shared else None,
+                                                  writeBlock if shared else None)
+        results.extend(splitResults)
+        # Split trajectories share the initial state of the pilot trajectory they descend from
+        icsIndex = icsIndex[origin]
+        if settings['burnin']:
+            burnInIndex = burnInIndex[origin]
 
+    writer = stopWriter()
     print("Simulations took %0.3f s"%(time.time() - start))
+    if writer is not None:
+        writer.report()
+    variants = cells['variants']
+    numCells = cells['numCells']
+    if settings['cell_parameters']:
+        for v, prefix in enumerate(variantPrefixes):
+            cellParDF = pd.DataFrame(cells['pars'][cells['variantIndex'] == v], columns=cells['parNames'],
+                                     index=pd.Index(['E' + str(cellid) for cellid in range(numCells)]))
+            cellParDF.to_csv(prefix + '/simulations/CellParameters.csv')
+    summaries, snapshots, snapshotsV, snapshotsJ = zip(*results)
+    summaryDF = pd.concat(summaries)
+    if settings['burnin']:
+        summaryDF['burnin_state'] = burnInIndex[cells['localIndex']]
+    print('%d model evaluations per trajectory on average' % summaryDF['nfev'].mean())
+    if settings['snapshot']:
+        snapshotDF = pd.concat(snapshots, axis=1)
+        if settings['record_velocity']:
+            snapshotVDF = pd.concat(snapshotsV, axis=1)
+        if settings['record_jacobian']:
+            snapshotJDF = pd.concat(snapshotsJ, axis=1)
+    results = {}
+    for v, (variant, prefix) in enumerate(zip(variants, variantPrefixes)):
+        if len(variants) > 1:
+            print('Perturbation:', variant['name'] if v > 0 else 'none')
+        variantSummaryDF = summaryDF.iloc[v*numCells:(v + 1)*numCells]
+        variantSummaryDF.to_csv(prefix + '/simulations/CellSummary.csv')
+        if len(icsSets) > 1:
+            # The set of initial conditions each cell was started from, numbered
+            # by row of the initial conditions file
+            icsIdDF = pd.DataFrame(data=icsIndex, index=variantSummaryDF.index, columns=['ics'])
+            icsIdDF.to_csv(prefix + '/ICSetIds.csv')
+        if settings['steady_state']:
+            print('%d of %d trajectories reached a steady state before t=%g' %\
+                  (variantSummaryDF['settled'].notna().sum(), len(variantSummaryDF), tspan[-1]))
+        if settings['snapshot']:
+            # The captured states are the dataset, no simulation files are read back
+            columns = slice(v*numCells*captures.shape[1], (v + 1)*numCells*captures.shape[1])
+            snapshotDF.iloc[:, columns].to_csv(prefix + '/simulations/Snapshots.csv')
+            if settings['record_velocity']:
+                snapshotVDF.iloc[:, columns].to_csv(prefix + '/simulations/SnapshotVelocity.csv')
+            if settings['record_jacobian']:
+                snapshotJDF.iloc[:, columns].to_csv(prefix + '/simulations/SnapshotJacobian.csv')
+            results[prefix] = collectSnapshots(snapshotDF.iloc[:, columns], captures,
+                                               mg, settings, prefix)
+        elif chunked:
+            results[prefix] = finishFold(folds[prefix], settings, prefix)
+        elif shared and not settings['sample_cells']:
+            results[prefix] = collectTrajectories(mg, settings, prefix,
+                                                  sharedArrays['states'][v*numCells:(v + 1)*numCells][:, :, gid])
+        else:
+            results[prefix] = collectTrajectories(mg, settings, prefix)
+        if not chunked:
+            results[prefix].attrs['columnPicks'] = columnPicks[:numCells]
+    if shared:
+        # The blocks cannot be closed while the arrays are referenced
+        del sharedArrays, writeBlock
+        releaseSharedBuffers(sharedHandles, unlink=True)
+    if len(variants) > 1:
+        # When chunked, the mean expression of each cell was kept instead
+        # of its trajectory
+        expression = {prefix: folds[prefix]['means'] if chunked else results[prefix]\
+                      for prefix in variantPrefixes}
+        writePairedStatistics(expression, summaryDF, cells, outPrefix)
+    return results
+
+def setUpPerturbations(mg, settings, cellStates, icsStates):
+    """
+    Set up the cells of the unperturbed model and of each perturbation in
+    settings['perturbations'], see definePerturbations(). The unperturbed
+    cells are written to the job folder, and the cells of each perturbation
+    to a folder of the same name in it, along with its parameters and a
+    copy of model.py. Cell c of a perturbation starts from the state, and
+    takes the parameters, of unperturbed cell c, except for the knocked out
+    genes and the changed parameters.
+
+    Cell c is seeded with c + 1000, as in eulersde(). With
+    common_random_numbers, a perturbed cell takes the seed of the
+    trajectory accepted for unperturbed cell c instead, see Experiment().
+
+    :param mg: Model details obtained by instantiating an object of GenerateModel
+    :type mg: BoolODE.GenerateModel
+    :param settings: The job settings dictionary
+    :type settings: dict
+    :param cellStates: Array of shape (num_cells, d) holding the initial state of each cell, or None if every cell starts from the initial conditions of the model
+    :type cellStates: ndarray
+    :param icsStates: Array of shape (num_cells, d) holding the initial conditions of each cell, used with perturbations if cellStates is None
+    :type icsStates: ndarray
+    :returns:
+        - cells: Dictionary of the perturbations ('variants') and their folders ('prefixes'), the number of cells of each ('numCells') and in all ('total'), and, for every simulated cell, its perturbation ('variantIndex'), its id within it ('localIndex'), its initial state ('states', or None), the values of the parameters in 'parNames' ('pars', or None if there are none), and the index into 'seeds' ('seedIndex') and stream ('streams') of its seed. 'crn' is True if the perturbed cells take the seeds of the unperturbed cells.
+    """
+    outPrefix = str(settings['outprefix'])
+    allParameters = dict(mg.ModelSpec['pars'])
+    parNames = sorted(allParameters.keys())
+    variants = [{'name': '', 'set': {}, 'scale': {}, 'zero': []}]
+    if settings['perturbations']:
+        variants.extend(definePerturbations(settings['perturbations'], mg))
+    prefixes = [outPrefix] + [outPrefix + '/' + v['name'] for v in variants[1:]]
+    numCells = settings['num_cells']
+    totalCells = numCells*len(variants)
+    # Perturbation and cell id within it of every simulated cell
+    variantIndex = np.arange(totalCells)//numCells
+    localIndex = np.arange(totalCells) % numCells
+    for prefix in prefixes:
+        simfilepath = Path(prefix, './simulations/')
+        if not os.path.exists(simfilepath):
+            print(simfilepath, "does not exist, creating it...")
+            os.makedirs(simfilepath)
+    if len(variants) > 1:
+        print('Simulating %d cells for each of %d perturbations and the unperturbed model'\
+              % (numCells, len(variants) - 1))
+        pd.DataFrame({'set': [str(v['set']) for v in variants[1:]],
+                      'scale': [str(v['scale']) for v in variants[1:]],
+                      'zero': [str([mg.varmapper[i] for i in v['zero']]) for v in variants[1:]]},
+                     index=pd.Index([v['name'] for v in variants[1:]], name='perturbation'))\
+          .to_csv(outPrefix + '/Perturbations.csv')
+        if cellStates is None:
+            cellStates = icsStates
+        cellStates = cellStates[localIndex]
+        for v, variant in enumerate(variants):
+            # Knocked out genes start without mRNA and protein
+            cellStates[np.ix_(variantIndex == v, variant['zero'])] = 0.
+    # Parameters which differ between cells: the sampled kinetic parameters,
+    # and the parameters changed by a perturbation
+    cellParNames = []
+    if settings['cell_parameters']:
+        cellParNames = [k for k in parNames if k in mg.kineticParameters]
+    changed = set(k for v in variants for k in list(v['set'].keys()) + list(v['scale'].keys()))
+    cellParNames = [k for k in parNames if k in cellParNames or k in changed]
+    cellPars = None
+    if len(cellParNames) > 0:
+        if settings['cell_parameters']:
+            # One row of kinetic parameters per cell
+            baseCellPars = utils.sampleParameterMatrix(numCells,
+                                                       [allParameters[k] for k in cellParNames],
+                                                       settings['cell_parameters_std'],
+                                                       method=settings['cell_parameters'])
+            print('Sampled %d kinetic parameters per cell' % len(mg.kineticParameters))
+        else:
+            baseCellPars = np.tile([allParameters[k] for k in cellParNames], (numCells, 1))
+        cellPars = baseCellPars[localIndex]
+        for v, variant in enumerate(variants):
+            for k, factor in variant['scale'].items():
+                cellPars[variantIndex == v, cellParNames.index(k)] *= factor
+            for k, value in variant['set'].items():
+                cellPars[variantIndex == v, cellParNames.index(k)] = value
+    for v, (variant, prefix) in enumerate(zip(variants, prefixes)):
+        variantPars = dict(allParameters)
+        for k, factor in variant['scale'].items():
+            variantPars[k] *= factor
+        variantPars.update(variant['set'])
+        writeCSV(pd.DataFrame([variantPars[k] for k in parNames], index=pd.Index(parNames)),
+                 prefix + '/simulations/param.csv')
+        if v > 0:
+            # Used by GenSamples
+            shutil.copy(mg.path_to_ode_model, prefix + '/model.py')
+    # As in eulersde(), cell c is seeded with c + 1000, and restarted with
+    # seed + 1000 each time it collapses
+    cellSeeds = localIndex + 1000
+    crn = settings['common_random_numbers'] and len(variants) > 1
+    if crn:
+        # A perturbed cell takes the seed of the trajectory accepted for the
+        # unperturbed cell with the same id, so the two share their noise
+        seedIndex = localIndex
+        cellStreams = np.zeros(totalCells, dtype=int)
+    else:
+        # Otherwise each perturbation draws from its own stream of seeds,
+        # which never meets the seeds of the unperturbed cells and their restarts
+        seedIndex = np.arange(totalCells)
+        cellStreams = variantIndex
+    return {'variants': variants,
+            'prefixes': prefixes,
+            'numCells': numCells,
+            'total': totalCells,
+            'variantIndex': variantIndex,
+            'localIndex': localIndex,
+            'states': cellStates,
+            'parNames': cellParNames,
+            'pars': cellPars,
+            'seeds': cellSeeds,
+            'seedIndex': seedIndex,
+            'streams': cellStreams,
+            'crn': crn}
+
+def planWaves(settings, simulated, numCells, chunkSize=None, crn=False):
+    """
+    Split the first `simulated` cells into waves, which are simulated one
+    after the other. With stop_on_convergence, the statistics are checked
+    after each wave of convergence_step cells, from min_cells on. A wave
+    also ends at the end of each chunk of chunkSize cells, and, with common
+    random numbers, after the numCells unperturbed cells, whose accepted
+    seeds are taken by the perturbed cells.
+
+    :returns:
+        - waves: Sorted list of the number of cells simulated by the end of each wave
+        - checkpoints: Set of the waves after which convergence is checked
+    """
+    if settings['stop_on_convergence']:
+        step = settings['convergence_step']
+        if step is None:
+            step = settings['batch_size']*(mp.cpu_count() if settings['doParallel'] else 1)
+        waves = list(range(min(settings['min_cells'], simulated), simulated, step)) + [simulated]
+    else:
+        waves = [simulated]
+    # Convergence is only checked at the end of its own waves
+    checkpoints = set(waves)
+    if chunkSize is not None:
+        waves = sorted(set(waves).union(range(chunkSize, simulated, chunkSize)))
+    if crn:
+        waves = sorted(set(waves).union([numCells]))
+    return waves, checkpoints
+
+def blockArguments(cells, block, rowOffset=0, captures=None):
+    """
+    Arguments of simulateAndSample() specific to a block of cells.
+
+    :param cells: The simulated cells, see setUpPerturbations()
+    :type cells: dict
+    :param block: Indices of the cells of the block
+    :type block: ndarray
+    :param rowOffset: Row of the shared array holding cell 0, i.e. minus the first cell of the current chunk
+    :type rowOffset: int
+    :param captures: Array of the indices of the recorded time points captured for each cell id in snapshot mode, or None
+    :type captures: ndarray
+    :returns:
+        - args: Dictionary of arguments, added to those shared by every block
+    """
+    localIndex = cells['localIndex']
+    args = {'seeds': cells['seeds'][cells['seedIndex'][block]],
+            'streams': cells['streams'][block],
+            'cellids': localIndex[block],
+            'cellPrefixes': [cells['prefixes'][v] for v in cells['variantIndex'][block]],
+            'perturbed': cells['variantIndex'][block] > 0,
+            'rows': block - rowOffset}
+    if captures is not None:
+        args['captureIndex'] = captures[localIndex[block]]
+    if cells['states'] is not None:
+        args['initialStates'] = cells['states'][block]
+    if cells['pars'] is not None:
+        args['cellPars'] = cells['pars'][block]
+    return args
+
+def startSharedBuffers(settings, bufferCells, numStored, mg, edgelist):
+    """
+    Create the shared arrays into which the workers of the shared and
+    thread backends write the recorded states, and if requested the
+    velocities and Jacobian entries, of bufferCells cells.
+
+    :returns:
+        - handles: Dictionary of the SharedMemory blocks, see releaseSharedBuffers()
+        - specs: Passed to the workers, see attachSharedBuffers()
+        - arrays: Dictionary of the shared arrays, which must be deleted before the blocks are released
+        - writeBlock: Function writing the cells of a block to file from the shared arrays, passed to simulateBlocks()
+    """
+    shapes = {'states': (bufferCells, numStored, len(mg.varmapper))}
+    if settings['record_velocity']:
+        shapes['velocity'] = (bufferCells, numStored, len(mg.genelist))
+    if settings['record_jacobian']:
+        shapes['jacobian'] = (bufferCells, numStored, len(edgelist))
+    handles, specs = createSharedBuffers(shapes)
+    # The arrays are views of the blocks created here, which must stay open
+    # as long as the arrays are in use
+    arrays = {key: np.ndarray(shape, dtype=float, buffer=handles[key].buf)\
+              for key, (_, shape) in specs.items()}
+
+    def writeBlock(args):
+        # Write the cells of each block as soon as it is simulated,
+        # while the workers go on with the next blocks
+        for cellid, row, prefix in zip(args['cellids'], args['rows'], args['cellPrefixes']):
+            writeTrajectory(prefix + '/simulations/', cellid, arrays['states'][row],
+                            mg.genelist, mg.varmapper, edgelist,
+                            arrays['velocity'][row] if settings['record_velocity'] else None,
+                            arrays['jacobian'][row] if settings['record_jacobian'] else None)
+    return handles, specs, arrays, writeBlock
+
+def foldWave(folds, cells, waveCells, genelist, gid, columnPicks, sharedStates=None, rowOffset=0):
+    """
+    Fold the trajectories of the cells of a wave into the outputs of their
+    folders, see foldTrajectories(). The trajectories are taken from
+    sharedStates, where cell i is held at row i - rowOffset, or otherwise
+    read back from file.
+
+    :param folds: Dictionary mapping each folder to the state of its fold, see startFold()
+    :type folds: dict
+    :param cells: The simulated cells, see setUpPerturbations()
+    :type cells: dict
+    :param waveCells: Indices of the cells of the wave
+    :type waveCells: ndarray
+    :param gid: Indices of the mRNA variables, in the order of genelist
+    :type gid: list
+    :param columnPicks: Column of each cell id to keep for ExpressionData.csv, see foldTrajectories()
+    :type columnPicks: ndarray
+    """
+    for v, prefix in enumerate(cells['prefixes']):
+        members = waveCells[cells['variantIndex'][waveCells] == v]
+        if len(members) == 0:
+            continue
+        if sharedStates is not None:
+            trajectories = sharedStates[members - rowOffset][:, :, gid]
+        else:
+            trajectories = readTrajectories(prefix, cells['localIndex'][members])
+        foldTrajectories(folds[prefix], cells['localIndex'][members], trajectories, genelist, prefix,
+                         columnPicks[cells['localIndex'][members]])
+
+def waveEndpoints(waveResults, blocks, genelist, gid, outPrefix, captures=None, sharedStates=None, rowOffset=0):
+    """
+    Final gene expression of the cells of a wave, monitored by
+    stop_on_convergence: the last captured state in snapshot mode, and
+    otherwise the last recorded state, taken from sharedStates, where cell
+    i is held at row i - rowOffset, or read back from file.
+
+    :param waveResults: Return values of simulateAndSample() for the blocks of the wave
+    :type waveResults: list
+    :param blocks: Indices of the cells of each block of the wave
+    :type blocks: list
+    :returns:
+        - endpoints: Array of shape (cells, genes), in the order of genelist
+    """
+    if captures is not None:
+        return np.vstack([snapshot.loc[['x_' + g for g in genelist],
+                                       ['E' + str(cellid) + '_' + str(captures[cellid, -1]) for cellid in block]]\
+                          .values.T for (_, snapshot, _, _), block in zip(waveResults, blocks)])
+    waveCells = np.concatenate(blocks)
+    if sharedStates is not None:
+        return sharedStates[waveCells - rowOffset, -1][:, gid]
+    return np.array([pd.read_csv(outPrefix + '/simulations/E' + str(cellid) + '.csv',
+                                 index_col=0).values[:, -1] for cellid in waveCells])
+
+def checkConvergence(convergence, numSimulated, captureTimes, settings, genelist):
+    """
+    Check the statistics monitored by stop_on_convergence once numSimulated
+    cells are simulated, see convergencePrecision(). The precision is
+    appended to convergence['checks'], and convergence['passed'] counts the
+    consecutive checks within convergence_tol.
+
+    :param convergence: Dictionary holding the final expression of the cells of each wave ('endpoints'), the checks so far ('checks') and the number of consecutive checks passed ('passed')
+    :type convergence: dict
+    :param captureTimes: Array of the capture times of each cell, relative to the simulation time, or None
+    :type captureTimes: ndarray
+    """
+    precision = convergencePrecision(np.vstack(convergence['endpoints']), captureTimes, settings['nClusters'],
+                                     settings['clusterSeeds'], genelist)
+    within = max(precision.values()) <= settings['convergence_tol']
+    # A single check may fall within the tolerance by chance
+    convergence['passed'] = convergence['passed'] + 1 if within else 0
+    convergence['checks'].append(dict(cells=numSimulated, **precision, within_tol=within))
+    print('%d cells: precision' % numSimulated,
+          ', '.join(['%s %.4f' % (k, v) for k, v in precision.items()]))
+
+def writePairedStatistics(expression, summaryDF, cells, outPrefix):
+    """
+    Compare each perturbed cell to the unperturbed cell with the same id,
+    see utils.pairedStatistics(), and write the statistics of every
+    perturbation to PairedStatistics.csv in outPrefix. Unperturbed cells
+    which were restarted are selected for not collapsing, which their
+    perturbed partners are not, so these pairs are left out.
+
+    :param expression: Dictionary mapping the folder of each perturbation to a DataFrame of the gene expression of its cells
+    :type expression: dict
+    :param summaryDF: Summary of every simulated cell, see simulateAndSample()
+    :type summaryDF: pandas DataFrame
+    :param cells: The simulated cells, see setUpPerturbations()
+    :type cells: dict
+    """
+    numCells = cells['numCells']
+    restarted = list(summaryDF.index[:numCells][summaryDF['tries'].values[:numCells] > 1])
+    if len(restarted) > 0:
+        print('Leaving out of the paired statistics %d pairs whose unperturbed cell was restarted'\
+              % len(restarted))
+    statsDF = pd.concat([utils.pairedStatistics(expression[outPrefix], expression[prefix], restarted)\
+                         for prefix in cells['prefixes'][1:]],
+                        keys=[v['name'] for v in cells['variants'][1:]], names=['perturbation'])
+    statsDF.to_csv(outPrefix + '/PairedStatistics.csv')
+
+def memoryChunkSize(settings, numStored, numVariables, numGenes, numEdges, shared):
+    """
+    Number of cells to simulate per chunk, such that the memory used stays
+    within settings['max_memory'] GB. Counted are the integration arrays
+    of the blocks being simulated at once, the shared array of a chunk if
+    shared is True, and the trajectories of a chunk while they are folded
+    into the outputs, see foldTrajectories(), on top of the memory this
+    process holds when the job starts. The chunk size is a multiple of
+    batch_size.
+
+    :returns:
+        - chunkSize: Number of cells per chunk
+    """
+    batchSize = settings['batch_size']
+    workers = mp.cpu_count() if settings['doParallel'] else 1
+    # States, velocities and Jacobian entries of a block being integrated
+    blockBytes = 8*batchSize*(numStored + 2)*(numVariables + numGenes*settings['record_velocity']\
+                                              + numEdges*bool(settings['record_jacobian']))
+    # Trajectories of a cell read back or copied from the shared array,
+    # sorted, and formatted for PseudoTime.csv
+    cellBytes = 5*8*numStored*numGenes
+    if shared:
+        cellBytes += 8*numStored*(numVariables + numGenes*settings['record_velocity']\
+                                  + numEdges*bool(settings['record_jacobian']))
+    if settings['nClusters'] > 1:
+        # Loaded before measuring the memory in use
+        from sklearn.cluster import KMeans
+    # Memory in use by this process now, rather than at its peak, which may
+    # have been reached by an earlier job
+    usedBytes = residentBytes()
+    # A tenth of the budget is kept for pandas and file buffers
+    available = 0.9*settings['max_memory']*1e9 - usedBytes - workers*blockBytes
+    chunkSize = int(available//cellBytes)//batchSize*batchSize
+    if chunkSize < batchSize:
+        print('max_memory=%g GB leaves room for fewer than batch_size cells per chunk,'\
+              ' simulating %d cells at a time' % (settings['max_memory'], batchSize))
+        chunkSize = batchSize
+    return chunkSize
+
+def residentBytes():
+    """
+    Memory currently resident in this process, read from /proc/self/statm,
+    or with psutil if it is installed. The memory freed by earlier jobs is
+    first returned to the system, where the C library allows it, so that it
+    is not counted.
+
+    :returns:
+        - residentBytes: Resident memory in bytes, or 0 if it cannot be measured
+    """
+    import gc
+    import ctypes
+    gc.collect()
+    try:
+        # glibc keeps freed memory mapped until asked to release it
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return 0
+    return psutil.Process().memory_info().rss
+
+def readTrajectories(outPrefix, cellids):
+    """
+    Read back the gene expression of the cells in cellids from the files
+    E[cellid].csv in outPrefix/simulations/.
+
+    :returns:
+        - trajectories: Array of shape (cells, recorded time points, genes)
+    """
+    return np.array([pd.read_csv(outPrefix + '/simulations/E' + str(cellid) + '.csv',
+                                 index_col=0).values.T for cellid in cellids])
+
+def startFold():
+    """
+    Start folding the trajectories of a job, which are simulated in
+    chunks, into its outputs. See foldTrajectories().
+
+    :returns:
+        - fold: Dictionary of the state of the fold
+    """
+    fold = {'cells': 0,
+            'columns': 0,
+            'genes': None,
+            # Every column, dropped once there are too many for ExpressionData.csv
+            'all': [],
+            # One column of each trajectory
+            'sampled': [],
+            'means': [],
+            'final': []}
+    return fold
+
+def foldTrajectories(fold, cellids, trajectories, genelist, outPrefix, picks):
+    """
+    Fold a chunk of trajectories into the outputs, so that they need not be
+    kept in memory. The rows of PseudoTime.csv of every column are
+    appended to outPrefix/PseudoTime.csv. Kept are the column picks[i] of
+    cell i for ExpressionData.csv (every column as long as there are fewer
+    than 1000), and the mean and final expression of each cell. The cells of each output folder must be folded in order of their
+    ids.
+
+    :param fold: State of the fold, see startFold()
+    :type fold: dict
+    :param cellids: Ids of the cells of the chunk
+    :type cellids: ndarray
+    :param trajectories: Array of shape (cells, recorded time points, genes), in the order of genelist
+    :type trajectories: ndarray
+    :param picks: Index of the recorded time point of each cell to keep for ExpressionData.csv
+    :type picks: ndarray
+    """
+    # Same layout as the DataFrame returned by collectTrajectories(), with the genes sorted
+    order = np.argsort(genelist)
+    genes = pd.Index(np.array(genelist)[order])
+    trajectories = trajectories[:, :, order]
+    numCells, numStored, numGenes = trajectories.shape
+    fold['genes'] = list(genes)
+    # Every trajectory is recorded at the same time points, so the
+    # pseudotime does not depend on the other chunks. The rows are
+    # written a few cells at a time, as they take more memory as text
+    # than the trajectories.
+    times = np.arange(1, numStored + 1, dtype=float)
+    step = max(1, int(1e5//numStored))
+    for first in range(0, numCells, step):
+        rows = cellids[first:first + step]
+        pd.DataFrame({'Cell ID': ['E' + str(cellid) + '_' + str(i) for cellid in rows for i in range(1, numStored + 1)],
+                      'PseudoTime': np.tile((times - 1.)/(numStored - 1.), len(rows)),
+                      'Time': np.tile(times, len(rows)),
+                      'Experiment': np.repeat(rows, numStored)})\
+          .to_csv(outPrefix + '/PseudoTime.csv', sep=',', index=False,
+                  mode='w' if fold['cells'] + first == 0 else 'a', header=fold['cells'] + first == 0)
+    fold['cells'] += numCells
+    fold['columns'] += numCells*numStored
+    if fold['columns'] < 1e3:
+        fold['all'].append(pd.DataFrame(trajectories.reshape(-1, numGenes).T, index=genes,
+                                        columns=['E' + str(cellid) + '_' + str(i)\
+                                                 for cellid in cellids for i in range(1, numStored + 1)]))
+    else:
+        fold['all'] = None
+    fold['sampled'].append(pd.DataFrame(trajectories[np.arange(numCells), picks].T, index=genes,
+                                        columns=['E' + str(cellid) + '_' + str(i + 1)\
+                                                 for cellid, i in zip(cellids, picks)]))
+    fold['means'].append(pd.DataFrame(trajectories.mean(axis=1).T, index=genes,
+                                      columns=['E' + str(cellid) for cellid in cellids]))
+    fold['final'].append(trajectories[:, -1].copy())
+
+def finishFold(fold, settings, outPrefix):
+    """
+    Finish the fold of the trajectories written to outPrefix/simulations/.
+    If settings['nClusters'] > 1, the trajectories are clustered by k-means
+    clustering of their final states, see clusterStates(), and the clusters
+    are written to ClusterIds.csv, as without chunks.
+
+    :returns:
+        - result: DataFrame of the columns written to ExpressionData.csv: every column if there are fewer than 1000, otherwise one column of each cell. result.attrs['numColumns'] is the number of columns of all the cells, whose PseudoTime.csv has already been written.
+    """
+    if fold['all'] is not None:
+        result = pd.concat(fold['all'], axis=1)
+    else:
+        result = pd.concat(fold['sampled'], axis=1)
+        # Only the picked column of each cell was kept
+        result.attrs['columnPicks'] = np.zeros(fold['cells'], dtype=int)
+    result.attrs['numColumns'] = fold['columns']
+    fold['means'] = pd.concat(fold['means'], axis=1)
+    if settings['nClusters'] > 1:
+        print('Clustering the final states of the simulations...')
+        start = time.time()
+        labels = clusterStates(np.vstack(fold['final']), settings['nClusters'],
+                               settings['clusterSeeds'], fold['genes'])
+        print('Clustering took %0.3fs' % (time.time() - start))
+        clusterDF = pd.DataFrame(data=labels, columns=['cl'],
+                                 index=pd.Index(['E' + str(cellid) for cellid in range(fold['cells'])]))
+        clusterDF.to_csv(outPrefix + '/ClusterIds.csv')
+    else:
+        print('Requested nClusters=1, not performing k-means clustering')
+    return result
+
+def collectSnapshots(snapshotDF, captures, mg, settings, outPrefix):
+    """
+    Returns the gene expression values of the captured states, and clusters
+    the trajectories on their last captured state if settings['nClusters'] > 1.
+    """
+    result = snapshotDF.loc[['x_' + g for g in mg.genelist]]
+    result.index = pd.Index(mg.genelist)
+    result = result.sort_index()
+    if settings['nClusters'] > 1:
+        # Cluster the trajectories on their last captured state
+        lastCapture = ['E' + str(cellid) + '_' + str(captures[cellid, -1])\
+                       for cellid in range(settings['num_cells'])]
+        groupedDF = result[lastCapture]
+        groupedDF.columns = pd.Index(['E' + str(cellid) for cellid in range(settings['num_cells'])])
+        clusterLabels = clusterStates(groupedDF.T.values, settings['nClusters'],
+                                      settings['clusterSeeds'], list(result.index))
+        clusterDF = pd.DataFrame(data=clusterLabels, index =\
+                                 groupedDF.columns, columns=['cl'])
+        clusterDF.to_csv(outPrefix + '/ClusterIds.csv')
+    return result
+
+def clusterStates(states, nClusters, seeds=None, genes=None):
+    """
+    k-means clustering of cell states. If seeds, the precomputed attractors,
+    are given, they are used as the initial cluster centers.
+
+    :param states: Array of shape (cells, genes) of gene expression values
+    :type states: ndarray
+    :param nClusters: Number of clusters
+    :type nClusters: int
+    :param seeds: DataFrame of the gene expression of each attractor, or None
+    :type seeds: pandas DataFrame
+    :param genes: List of the genes in the columns of states
+    :type genes: list
+    :returns:
+        - labels: Array of the cluster of each cell
+    """
+    from sklearn.cluster import KMeans
+    with np.errstate(under='ignore'):
+        if seeds is not None and len(seeds) == nClusters:
+            kmeans = KMeans(n_clusters=nClusters, init=seeds[genes].values, n_init=1)
+        else:
+            kmeans = KMeans(n_clusters=nClusters)
+        return kmeans.fit(states).labels_
+
+def collectTrajectories(mg, settings, outPrefix, trajectories=None):
+    """
+    Reads back the simulated trajectories, or sampled cells, written to
+    outPrefix/simulations/. If settings['nClusters'] > 1, the trajectories
+    are clustered by k-means clustering of their final states, see
+    clusterStates(), as when they are simulated in chunks, and the clusters
+    are written to ClusterIds.csv.
+
+    :param trajectories: Array of shape (num_cells, recorded time points, genes) holding the trajectories, which are then not read back from file
+    :type trajectories: ndarray
+    :returns:
+        - result: DataFrame of the gene expression values, columns are cells
+    """
+    # Final state of each trajectory, used to cluster
+    finalStates = []
     frames = []
     print('starting to concat files')
     start = time.time()
 
-    for cellid in tqdm(range(settings['num_cells'])):
-        if settings['sample_cells']:
-            df = pd.read_csv(outPrefix + '/simulations/E'+str(cellid) + '-cell.csv',index_col=0)
-            df = df.sort_index()                
-        else:
-            df = pd.read_csv(outPrefix + '/simulations/E'+str(cellid) + '.csv',index_col=0)
-            df = df.sort_index()
-            groupedDict['E' + str(cellid)] = df.values.ravel()
-        frames.append(df.T)
+    if trajectories is not None:
+        # Same layout as the files read back below, with the genes sorted
+        order = np.argsort(mg.genelist)
+        trajectories = trajectories[:, :, order]
+        numCells, numStored, numGenes = trajectories.shape
+        finalStates = list(trajectories[:, -1])
+        frames.append(pd.DataFrame(trajectories.reshape(-1, numGenes),
+                                   index=['E' + str(cellid) + '_' + str(i)\
+                                          for cellid in range(numCells)\
+                                          for i in range(1, numStored + 1)],
+                                   columns=pd.Index(np.array(mg.genelist)[order])))
+    else:
+        for cellid in tqdm(range(settings['num_cells'])):
+            if settings['sample_cells']:
+                df = pd.read_csv(outPrefix + '/simulations/E'+str(cellid) + '-cell.csv',index_col=0)
+                df = df.sort_index()                
+            else:
+                df = pd.read_csv(outPrefix + '/simulations/E'+str(cellid) + '.csv',index_col=0)
+                df = df.sort_index()
+                finalStates.append(df.values[:, -1])
+            frames.append(df.T)
     stop = time.time()
     print("Concating files took %.2f s" %(stop-start))
     result = pd.concat(frames,axis=0)
@@ -193,25 +997,145 @@ def Experiment(mg, Model,
     newindices = [i.replace('x_','') for i in indices]
     result.index = pd.Index(newindices)
     
-    if settings['nClusters'] > 1:
+    if settings['nClusters'] > 1 and not settings['sample_cells']:
         ## Carry out k-means clustering to identify which
         ## trajectory a simulation belongs to
-        print('Starting k-means clustering')
-        groupedDF = pd.DataFrame.from_dict(groupedDict)
-        print('Clustering simulations...')
-        start = time.time()            
-        # Find clusters in the experiments
-        clusterLabels= KMeans(n_clusters=settings['nClusters']).fit(groupedDF.T.values).labels_
+        print('Clustering the final states of the simulations...')
+        start = time.time()
+        clusterLabels = clusterStates(np.array(finalStates), settings['nClusters'],
+                                      settings['clusterSeeds'], list(result.index))
         print('Clustering took %0.3fs' % (time.time() - start))
-        clusterDF = pd.DataFrame(data=clusterLabels, index =\
-                                 groupedDF.columns, columns=['cl'])
+        clusterDF = pd.DataFrame(data=clusterLabels, columns=['cl'],
+                                 index=pd.Index(['E' + str(cellid) for cellid in range(len(finalStates))]))
         clusterDF.to_csv(outPrefix + '/ClusterIds.csv')
+    elif settings['sample_cells']:
+        print('sample_cells keeps a single state of each trajectory, not performing k-means clustering')
     else:
         print('Requested nClusters=1, not performing k-means clustering')
     ##################################################
     
     return result
     
+def definePerturbations(perturbations, mg):
+    """
+    Translate the perturbations of a job into changes of the parameters and
+    initial conditions of the model. Each perturbation is a dictionary with
+    the optional keys
+
+    1. 'knockout': List of genes. Their transcription rate is set to 0, and they start without mRNA and protein. Knocking out a parameter input sets it to 0.
+    2. 'overexpression': List of genes. Their transcription rate is multiplied by 'factor', Default=2.
+    3. 'clamp': Dictionary of parameter inputs and the value, between 0 and 1, they are set to.
+    4. 'parameters': Dictionary of parameter names and the value they are set to.
+    5. 'name': Name of the folder the perturbed cells are written to. Default: the perturbed genes, with suffixes -KO, -OE and -clamp.
+
+    perturbations may also be 'knockouts' or 'overexpressions', for a screen
+    of single gene knockouts or overexpressions.
+
+    :param perturbations: List of perturbations, or the name of a screen
+    :type perturbations: list
+    :param mg: Model details obtained by instantiating an object of GenerateModel
+    :type mg: BoolODE.GenerateModel
+    :returns:
+        - variants: List of dictionaries with keys 'name', 'set' (parameter values), 'scale' (factors multiplying parameter values) and 'zero' (indices of the variables starting at 0)
+    """
+    pars = mg.ModelSpec['pars']
+    revvarmapper = {v:k for k,v in mg.varmapper.items()}
+    if perturbations == 'knockouts':
+        perturbations = [{'knockout': [g]} for g in mg.genelist]
+    elif perturbations == 'overexpressions':
+        perturbations = [{'overexpression': [g]} for g in mg.genelist]
+    elif not isinstance(perturbations, list):
+        print("perturbations should be a list, 'knockouts' or 'overexpressions'")
+        sys.exit()
+    variants = []
+    for pert in perturbations:
+        variant = {'set': {}, 'scale': {}, 'zero': []}
+        label = []
+        for g in pert.get('knockout', []):
+            if 'm_' + g in pars:
+                variant['set']['m_' + g] = 0.
+                variant['zero'].extend([revvarmapper[v + g] for v in ['x_', 'p_']\
+                                        if v + g in revvarmapper])
+            elif g in pars and g in mg.withoutRules:
+                variant['set'][g] = 0.
+            else:
+                print("Cannot knock out " + str(g) + ": not a gene with a rule or a parameter input")
+                sys.exit()
+            label.append(str(g) + '-KO')
+        for g in pert.get('overexpression', []):
+            if 'm_' + g not in pars:
+                print("Cannot overexpress " + str(g) + ": not a gene with a rule")
+                sys.exit()
+            variant['scale']['m_' + g] = pert.get('factor', 2.)
+            label.append(str(g) + '-OE')
+        for g, value in pert.get('clamp', {}).items():
+            if g not in pars or g not in mg.withoutRules:
+                print("Cannot clamp " + str(g) + ": not a parameter input")
+                sys.exit()
+            # As in GenerateModel.addParameterInputs()
+            variant['set'][g] = min(max(value, 0.), 1.)*2*mg.kineticParameterDefaults['hillThreshold']
+            label.append(str(g) + '-clamp')
+        for k, value in pert.get('parameters', {}).items():
+            if k not in pars:
+                print("Cannot set parameter " + str(k) + ": not a parameter of the model")
+                sys.exit()
+            variant['set'][k] = value
+            label.append(str(k))
+        variant['name'] = str(pert.get('name', '_'.join(label)))
+        variants.append(variant)
+    names = [v['name'] for v in variants]
+    for name in names:
+        if name in ['', 'simulations'] or names.count(name) > 1:
+            print("Perturbation names should be unique, found '" + name + "'")
+            sys.exit()
+    return variants
+
+def checkSettings(settings):
+    """
+    Check the settings of a job before it is run. Exits if a setting is
+    invalid, or if the job combines modes which cannot be carried out
+    together.
+    """
+    def invalid(message):
+        print("Error in definition of job " + settings['name'])
+        print(message)
+        sys.exit()
+    if Path(settings['outprefix']) == Path(settings['burnInCachePath']):
+        invalid("A job cannot be named " + Path(settings['burnInCachePath']).name\
+                + ", the folder of the burn-in cache")
+    if settings['simulation_time'] != 'auto' and not (isinstance(settings['simulation_time'], (int, float))\
+                                                      and settings['simulation_time'] > 0):
+        invalid("simulation_time should be a positive number or 'auto'")
+    if settings['simulation_time'] == 'auto':
+        if not (isinstance(settings['auto_time_max'], (int, float)) and settings['auto_time_max'] > 0):
+            invalid("auto_time_max should be a positive number")
+        # The range of the means over the last quarter of the pilot needs
+        # at least one full steady_state_window. The last recorded time
+        # point is not written.
+        recordedTimes, window = pilotGrid(settings)[1:]
+        if (len(recordedTimes) - 1)//4 < window:
+            invalid("auto_time_max should be more than 4*steady_state_window")
+    if settings['integrator'] not in ['euler', 'semi-implicit', 'exponential', 'adaptive']:
+        invalid("integrator should be one of 'euler', 'semi-implicit', 'exponential' or 'adaptive'")
+    if settings['cell_parameters'] not in [False, 'normal', 'lhs']:
+        invalid("cell_parameters should be one of 'normal' or 'lhs'")
+    if settings['parallel_backend'] not in ['files', 'shared', 'thread']:
+        invalid("parallel_backend should be one of 'files', 'shared' or 'thread'")
+    if settings['nClusters'] != 'auto' and not (isinstance(settings['nClusters'], int) and settings['nClusters'] >= 1):
+        invalid("nClusters should be a positive integer or 'auto'")
+    if settings['adaptive_allocation']:
+        if settings['nClusters'] != 'auto' and settings['nClusters'] < 2:
+            invalid("adaptive_allocation requires nClusters > 1")
+        if settings['snapshot'] or settings['sample_cells'] or settings['perturbations']:
+            invalid("adaptive_allocation cannot be combined with snapshot, sample_cells or perturbations")
+    if settings['stop_on_convergence'] and (settings['perturbations'] or settings['adaptive_allocation']):
+        invalid("stop_on_convergence cannot be combined with perturbations or adaptive_allocation")
+    if settings['max_memory'] is not None and (settings['snapshot'] or settings['sample_cells']\
+                                               or settings['adaptive_allocation']):
+        invalid("max_memory cannot be combined with snapshot, sample_cells or adaptive_allocation")
+    if settings['snapshot'] and settings['sample_cells']:
+        invalid("sample_cells cannot be combined with snapshot")
+
 def startRun(settings):
     """
     Start a simulation run. Loads model file, starts an Experiment(),
@@ -238,9 +1162,8 @@ def startRun(settings):
     ##########################################
 
     # Simulator settings
-    tmax = settings['simulation_time']    
     integration_step_size = settings['integration_step_size']
-    tspan = np.linspace(0,tmax,int(tmax/integration_step_size))
+    checkSettings(settings)
 
     # Generate the ODE model from the specified boolean model
     mg = GenerateModel(settings,
@@ -248,34 +1171,846 @@ def startRun(settings):
                        parameterSetDF,
                        interactionStrengthDF)
     genesDict = {}
+    # The noise of each cell is seeded by its id. Every other random choice
+    # of the simulations, such as the sampled time points and the columns
+    # of ExpressionData.csv, draws from the global generator, which is
+    # seeded here with the seed of the job, so that the same job gives the
+    # same output. Parameters sampled by GenerateModel() are left to differ
+    # between the jobs.
+    np.random.seed(settings['seed'])
 
     # Load the ODE model file
     model = SourceFileLoader("model", mg.path_to_ode_model.as_posix()).load_module()
 
+    # Precompute the attractors of the model, to set the number of
+    # clusters, their k-means seeds, or the initial conditions
+    settings['clusterSeeds'] = None
+    if settings['nClusters'] == 'auto' or settings['auto_ics']:
+        from BoolODE import attractors
+        start = time.time()
+        attractorDF, rootDF = attractors.findAttractors(mg, model.Model,
+                                                        model.Jacobian, model.JacobianIndex,
+                                                        settings,
+                                                        pd.DataFrame() if settings['auto_ics'] else icsDF)
+        if settings['auto_ics']:
+            if rootDF is not None:
+                icsDF = rootDF
+            else:
+                print('Could not choose initial conditions, using the defaults')
+        if settings['nClusters'] == 'auto':
+            settings['nClusters'] = max(1, len(attractorDF))
+            if settings['nClusters'] > 1:
+                settings['clusterSeeds'] = attractorDF[mg.genelist]
+            print('Setting nClusters=%d' % settings['nClusters'])
+            if settings['adaptive_allocation'] and settings['nClusters'] < 2:
+                print("Error in definition of job " + settings['name'])
+                print("adaptive_allocation requires nClusters > 1, but the model has a single attractor")
+                sys.exit()
+        print('Attractor analysis took %0.2f s' % (time.time() - start))
+
+    if settings['simulation_time'] == 'auto':
+        settings['simulation_time'] = chooseSimulationTime(mg, model, settings, icsDF)
+    tmax = settings['simulation_time']
+    tspan = np.linspace(0,tmax,int(tmax/integration_step_size))
+
     ## Function call - do the in silico experiment
-    resultDF = Experiment(mg, model.Model,
+    results = Experiment(mg, model.Model,
                           tspan,
                           settings,
                           icsDF,
                           writeProtein=settings['writeProtein'],
-                          normalizeTrajectory=settings['normalizeTrajectory'])
+                          normalizeTrajectory=settings['normalizeTrajectory'],
+                          Jacobian=model.Jacobian,
+                          JacobianIndex=model.JacobianIndex)
     
     # Write simulation output. Creates ground truth files.
     print('Generating input files for pipline...')
     start = time.time()
-    utils.generateInputFiles(resultDF, mg.df,
-                             mg.withoutRules,
-                             parameterInputsDF,
-                             tmax,
-                             settings['num_cells'],
-                             outPrefix=settings['outprefix'])
+    for outPrefix, resultDF in results.items():
+        utils.generateInputFiles(resultDF, mg.df,
+                                 mg.withoutRules,
+                                 parameterInputsDF,
+                                 tmax,
+                                 settings['num_cells'],
+                                 outPrefix=outPrefix)
     print('Input file generation took %0.2f s' % (time.time() - start))
     print("BoolODE.py took %0.2fs"% (time.time() - startfull))
 
+def pilotGrid(settings):
+    """
+    Time points of the pilot simulated by chooseSimulationTime.
+
+    :param settings: The job settings dictionary
+    :type settings: dict
+    :returns:
+        - tspan: The time points of the pilot
+        - recordedTimes: The time points recorded in the pilot
+        - window: The number of recorded time points in steady_state_window
+    """
+    tmax = settings['auto_time_max']
+    h = settings['integration_step_size']
+    tspan = np.linspace(0, tmax, int(tmax/h))
+    if settings['record_step_size'] is None:
+        stride = 1
+    else:
+        stride = max(1, int(round(settings['record_step_size']/h)))
+    recordedTimes = tspan[::stride]
+    if len(recordedTimes) < 2:
+        return tspan, recordedTimes, 1
+    window = max(1, int(round(settings['steady_state_window']/(recordedTimes[1] - recordedTimes[0]))))
+    return tspan, recordedTimes, window
+
+def chooseSimulationTime(mg, model, settings, icsDF):
+    """
+    Choose the simulation time of a job with simulation_time: auto. A pilot
+    of auto_time_pilot cells is simulated for auto_time_max, with the
+    initial conditions and parameters of the job, and the time by which
+    each trajectory has settled is found: the end of the first window of
+    steady_state_window over which the mean expression of every gene is
+    within steady_state_tol*x_max of the range of these means over the last
+    quarter of the pilot. Trajectories which first reach this range in the
+    last quarter have not settled. Later excursions, such as noise driven
+    switches between attractors, are not taken into account. The
+    simulation time is the time by which a fraction auto_time_quantile of
+    the pilot cells have settled, lengthened by auto_time_margin, or
+    auto_time_max if fewer pilot cells settled.
+
+    The settling time of each pilot cell is written to PilotSettling.csv,
+    and the chosen simulation time to SimulationTime.csv, in the job folder.
+
+    :param mg: Model details obtained by instantiating an object of GenerateModel
+    :type mg: BoolODE.GenerateModel
+    :param model: The loaded model.py module
+    :type model: module
+    :param settings: The job settings dictionary
+    :type settings: dict
+    :param icsDF: Dataframe specifying initial condition for simulation
+    :type icsDF: pandas DataFrame
+    :returns:
+        - simulationTime: The chosen simulation time
+    """
+    import tempfile
+    start = time.time()
+    tmax = settings['auto_time_max']
+    h = settings['integration_step_size']
+    tspan, recordedTimes, window = pilotGrid(settings)
+    numPilot = min(settings['auto_time_pilot'], settings['num_cells'])
+    print('Simulating %d pilot cells for %g to choose simulation_time' % (numPilot, tmax))
+    pilotSettings = dict(settings, simulation_time=tmax, num_cells=numPilot,
+                         nClusters=1, clusterSeeds=None, perturbations=None,
+                         adaptive_allocation=False, stop_on_convergence=False,
+                         snapshot=False, sample_cells=False, steady_state=False,
+                         record_velocity=False, record_jacobian=False)
+    tol = settings['steady_state_tol']*mg.kineticParameterDefaults['x_max']
+    settled = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pilotSettings['outprefix'] = Path(tmpdir)
+        Experiment(mg, model.Model, tspan, pilotSettings, icsDF)
+        for cellid in range(numPilot):
+            df = pd.read_csv(tmpdir + '/simulations/E' + str(cellid) + '.csv', index_col=0)
+            times = recordedTimes[[int(c.split('_')[1]) for c in df.columns]]
+            # Mean expression over every window, and their range over the last quarter
+            cumulative = np.concatenate([np.zeros((len(df), 1)), np.cumsum(df.values, axis=1)], axis=1)
+            means = (cumulative[:, window:] - cumulative[:, :-window])/window
+            tailStart = len(times) - len(times)//4
+            lo = means[:, tailStart:].min(axis=1, keepdims=True) - tol
+            hi = means[:, tailStart:].max(axis=1, keepdims=True) + tol
+            first = np.flatnonzero(np.all((means >= lo) & (means <= hi), axis=0))[0]
+            # A trajectory that first reaches this range in the last quarter
+            # may still be moving
+            settled.append(times[first + window - 1] if first < tailStart else np.nan)
+    settled = np.array(settled)
+    # Time by which auto_time_quantile of the pilot cells have settled
+    needed = int(np.ceil(settings['auto_time_quantile']*numPilot))
+    settlingTime = np.sort(np.where(np.isnan(settled), np.inf, settled))[max(needed, 1) - 1]
+    if np.isnan(settled).any():
+        print('%d of %d pilot cells did not settle by auto_time_max=%g'\
+              % (np.isnan(settled).sum(), numPilot, tmax))
+    if np.isinf(settlingTime):
+        settlingTime = np.nan
+        simulationTime = tmax
+    else:
+        simulationTime = min(tmax, np.ceil(settlingTime*(1. + settings['auto_time_margin'])/h)*h)
+    pd.DataFrame({'settled': settled},
+                 index=pd.Index(['E' + str(cellid) for cellid in range(numPilot)]))\
+      .to_csv(str(settings['outprefix']) + '/PilotSettling.csv')
+    pd.DataFrame([{'pilot_cells': numPilot,
+                   'pilot_time': tmax,
+                   'settled_cells': int((~np.isnan(settled)).sum()),
+                   'quantile': settings['auto_time_quantile'],
+                   'settling_time': settlingTime,
+                   'margin': settings['auto_time_margin'],
+                   'simulation_time': simulationTime}])\
+      .to_csv(str(settings['outprefix']) + '/SimulationTime.csv', index=False)
+    print('Setting simulation_time=%g, the pilot took %0.2f s' % (simulationTime, time.time() - start))
+    return float(simulationTime)
+
+def planRun(settings, gensampleJobs=None):
+    """
+    Estimate the cost of a job without running it. The model is generated
+    in a temporary folder, and one step of the integrator, a single
+    evaluation of the model on a batch of batch_size cells together with
+    its noise term, is timed. Also timed is writing one trajectory to
+    CSV, which gives the size of each stored value. The estimates are
+    upper bounds when the number of steps depends on the dynamics, with
+    steady_state, stop_on_convergence, simulation_time: auto or the
+    adaptive integrator.
+
+    :param settings: The job settings dictionary
+    :type settings: dict
+    :param gensampleJobs: List of GenSamples settings, or None
+    :type gensampleJobs: list
+    :returns:
+        - plan: Dictionary of the estimated number of simulated cells, species, steps, CPU time (s), disk use of the simulations and post-processing (bytes), peak memory of the shared arrays and of collecting and clustering the cells, at most max_memory (bytes), and memory of each worker (bytes)
+    """
+    import io
+    import timeit
+    import tempfile
+    if not utils.checkValidModelDefinitionPath(settings['modelpath'], settings['name']):
+        return None
+    checkSettings(settings)
+    parameterInputsDF = utils.checkValidInputPath(settings['parameter_inputs_path'])
+    parameterSetDF = utils.checkValidInputPath(settings['parameter_set'])
+    interactionStrengthDF = utils.checkValidInputPath(settings['interaction_strengths'])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mg = GenerateModel(dict(settings, outprefix=Path(tmpdir)),
+                           parameterInputsDF,
+                           parameterSetDF,
+                           interactionStrengthDF)
+        model = SourceFileLoader("model", mg.path_to_ode_model.as_posix()).load_module()
+    parNames = sorted(mg.ModelSpec['pars'].keys())
+    pars = [mg.ModelSpec['pars'][k] for k in parNames]
+    numVariables = len(mg.varmapper)
+    numGenes = len(mg.genelist)
+    numEdges = len(model.JacobianIndex)
+
+    # With simulation_time: auto, the cells are simulated for at most auto_time_max
+    tmax = settings['auto_time_max'] if settings['simulation_time'] == 'auto' else settings['simulation_time']
+    h = settings['integration_step_size']
+    numSteps = int(tmax/h)
+    if settings['record_step_size'] is None:
+        recordStride = 1
+    else:
+        recordStride = max(1, int(round(settings['record_step_size']/h)))
+    numRecorded = len(np.arange(numSteps)[::recordStride])
+    numVariants = 1
+    if settings['perturbations']:
+        numVariants += len(definePerturbations(settings['perturbations'], mg))
+    numCells = settings['num_cells']*numVariants
+    batchSize = min(settings['batch_size'], numCells)
+    numBatches = int(np.ceil(numCells/batchSize))
+
+    # Time one evaluation of the model, and one integration step, of a batch
+    rng = np.random.default_rng(0)
+    Y = rng.uniform(0., mg.kineticParameterDefaults['x_max'], (batchSize, numVariables))
+    def evaluate():
+        with np.errstate(under='ignore'):
+            return simulator.evaluateBatch(model.Model, Y, 0., pars)
+    def step():
+        return Y + evaluate()*h + simulator.noise(Y, 0.)*rng.normal(0., np.sqrt(h), Y.shape)
+    calls, elapsed = timeit.Timer(evaluate).autorange()
+    evaluationTime = elapsed/calls
+    calls, elapsed = timeit.Timer(step).autorange()
+    stepTime = elapsed/calls
+    # Evaluations of the model per step beyond the first
+    extra = {'euler': 0, 'semi-implicit': 0, 'exponential': 1, 'adaptive': 1}[settings['integrator']]
+    cpuTime = numBatches*numSteps*(stepTime + extra*evaluationTime)
+    if settings['simulation_time'] == 'auto':
+        cpuTime += np.ceil(min(settings['auto_time_pilot'], settings['num_cells'])/batchSize)*numSteps*(stepTime + extra*evaluationTime)
+    if settings['burnin']:
+        burnInSteps = int(settings['burn_in_time']/(settings['burn_in_step_size'] or h))
+        cpuTime += np.ceil(settings['burn_in_pool_size']/batchSize)*burnInSteps*stepTime
+
+    # Size of a value written to CSV, and time spent writing and reading it
+    trajectory = pd.DataFrame(rng.uniform(0., mg.kineticParameterDefaults['x_max'], (numGenes, numRecorded)),
+                              index=pd.Index(mg.genelist),
+                              columns=['E0_' + str(i) for i in range(numRecorded)])
+    start = time.time()
+    text = trajectory.to_csv()
+    writeTime = (time.time() - start)/trajectory.size
+    start = time.time()
+    pd.read_csv(io.StringIO(text), index_col=0)
+    readTime = (time.time() - start)/trajectory.size
+    valueBytes = len(text)/trajectory.size
+
+    # Values stored by the simulations, and kept in memory by the main process
+    sharedBytes = 0
+    if settings['snapshot']:
+        captures = len(settings['snapshot_times']) if settings['snapshot_times'] is not None\
+            else settings['snapshots_per_cell']
+        columns = numCells*captures
+        simValues = columns*(numVariables + numGenes*settings['record_velocity']\
+                             + numEdges*bool(settings['record_jacobian']))
+        collectBytes = 2*8*columns*numVariables
+        clusterBytes = 2*8*settings['num_cells']*numGenes
+    else:
+        columns = numCells*(numRecorded - 1)
+        simValues = columns*(numGenes + numVariables + numGenes*settings['record_velocity']\
+                             + numEdges*bool(settings['record_jacobian']))
+        # The frames of every cell and their concatenation, and the final states
+        collectBytes = 2*8*settings['num_cells']*(numRecorded - 1)*numGenes
+        clusterBytes = 2*8*settings['num_cells']*numGenes
+        if settings['parallel_backend'] in ['shared', 'thread']:
+            # Every recorded state is held in shared memory until written,
+            # and the trajectories are collected from it
+            sharedBytes = 8*columns*(numVariables + numGenes*settings['record_velocity']\
+                                     + numEdges*bool(settings['record_jacobian']))
+        else:
+            # The trajectories are read back to be collected
+            cpuTime += columns*numGenes*readTime
+    if settings['nClusters'] == 1:
+        clusterBytes = 0
+    # ExpressionData.csv holds every column, unless there are too many
+    postValues = numVariants*numGenes*(columns//numVariants if columns//numVariants < 1e3 else settings['num_cells'])
+    for gsamp in gensampleJobs or []:
+        sampleSize = min(gsamp.get('sample_size', 100), settings['num_cells'])
+        postValues += numVariants*gsamp.get('nDatasets', 1)*sampleSize\
+                      *(numGenes + numVariables + numEdges + numGenes*settings['record_velocity'])
+    cpuTime += simValues*writeTime
+    peakBytes = sharedBytes + max(collectBytes, clusterBytes)
+    if settings['max_memory'] is not None:
+        # Simulated in chunks, see memoryChunkSize()
+        peakBytes = min(peakBytes, settings['max_memory']*1e9)
+    workerBytes = 8*batchSize*(numRecorded + 1)*numVariables\
+                  *(1 + settings['record_velocity'] + numEdges/numVariables*bool(settings['record_jacobian']))
+    return {'cells': numCells,
+            'species': numVariables,
+            'steps': numSteps,
+            'batches': numBatches,
+            'evaluation_time': evaluationTime,
+            'cpu_time': cpuTime,
+            'simulation_bytes': simValues*valueBytes,
+            'post_processing_bytes': postValues*valueBytes,
+            'peak_memory_bytes': peakBytes,
+            'worker_memory_bytes': workerBytes}
+
+def convergencePrecision(endpoints, captureTimes, nClusters, seeds=None, genes=None, numSplits=20):
+    """
+    Estimate the precision of the statistics monitored by
+    stop_on_convergence: the proportion of cells in each k-means cluster of
+    the final states (if nClusters > 1), the distribution of the final
+    expression of each gene, and the fraction of the captured states in each
+    tenth of the simulation time (if the cells are captured at sampled time
+    points). The cells are split at random into two halves, each statistic
+    is computed separately for the two, and half the largest difference
+    between them is averaged over numSplits splits, so that the estimate
+    does not hinge on one split. Distributions are compared by the largest
+    difference of their cumulative distribution functions.
+
+    :param endpoints: Array of shape (cells, genes) of the final gene expression of each cell
+    :type endpoints: ndarray
+    :param captureTimes: Array of shape (cells, captures) of the times of the captured states, as a fraction of the simulation time, or None
+    :type captureTimes: ndarray
+    :param nClusters: Number of clusters
+    :type nClusters: int
+    :param seeds: DataFrame of the gene expression of each attractor, used to seed k-means, or None
+    :type seeds: pandas DataFrame
+    :param genes: List of the genes in the columns of endpoints
+    :type genes: list
+    :param numSplits: Number of random splits
+    :type numSplits: int
+    :returns:
+        - precision: Dictionary of the precision of each statistic
+    """
+    numCells = len(endpoints)
+    # The splits only depend on the number of cells
+    rng = np.random.default_rng(numCells)
+    estimates = {}
+    with np.errstate(under='ignore'):
+        if nClusters > 1:
+            labels = clusterStates(endpoints, nClusters, seeds, genes)
+        for _ in range(numSplits):
+            first = np.zeros(numCells, dtype=bool)
+            first[rng.permutation(numCells)[:numCells//2]] = True
+            halves = [first, ~first]
+            if nClusters > 1:
+                proportions = [np.bincount(labels[h], minlength=nClusters)/h.sum() for h in halves]
+                estimates.setdefault('cluster_proportions', []).append(np.abs(proportions[0] - proportions[1]).max()/2)
+            distance = 0.
+            for values in endpoints.T:
+                cdfs = [np.searchsorted(np.sort(values[h]), values, side='right')/h.sum() for h in halves]
+                distance = max(distance, np.abs(cdfs[0] - cdfs[1]).max())
+            estimates.setdefault('endpoint_distributions', []).append(distance/2)
+            if captureTimes is not None:
+                coverage = [np.histogram(captureTimes[h], bins=10, range=(0., 1.))[0]/captureTimes[h].size\
+                            for h in halves]
+                estimates.setdefault('pseudotime_coverage', []).append(np.abs(coverage[0] - coverage[1]).max()/2)
+    return {k: float(np.mean(v)) for k, v in estimates.items()}
+
+def simulateBlocks(argdict, blockArgs, doParallel, threads=False, onBlock=None):
+    """
+    Call simulateAndSample() for each block of cells, in parallel if
+    doParallel is True. The blocks are run by a pool of worker processes,
+    or, if threads is True, by a pool of threads of this process, which
+    share the model and the arguments without copying them. The batched
+    kernels spend most of their time in NumPy, which releases the GIL.
+
+    If a background writer was started with startWriter(), each worker
+    process writes its files with its own, and every file has been written
+    when this function returns.
+
+    :param argdict: Arguments shared by all blocks
+    :type argdict: dict
+    :param blockArgs: List of dictionaries of the arguments of each block
+    :type blockArgs: list
+    :param threads: Use a pool of threads instead of processes
+    :type threads: bool
+    :param onBlock: Function called in this process with the arguments of each block, in order, once it is simulated
+    :type onBlock: function
+    :returns:
+        - results: List of the return values of simulateAndSample()
+    """
+    results = []
+    if doParallel and threads:
+        from multiprocessing.pool import ThreadPool
+        def simulateBlock(args):
+            # The floating point error handling set at import is not
+            # inherited by new threads
+            with np.errstate(all='raise'):
+                return simulateAndSample(dict(argdict, **args))
+        with ThreadPool() as pool:
+            jobs = [pool.apply_async(simulateBlock, args=(args,)) for args in blockArgs]
+            for job, args in zip(jobs, blockArgs):
+                results.append(job.get())
+                if onBlock is not None:
+                    onBlock(args)
+    elif doParallel:
+        poolArgs = {}
+        if outputWriter is not None:
+            # Statistics of the writers of the workers
+            totals = mp.Array('d', len(STATS))
+            poolArgs = {'initializer': startWriter,
+                        'initargs': (outputWriter.queueSize, totals)}
+        with mp.Pool(**poolArgs) as pool:
+            jobs = []
+            for args in blockArgs:
+                job = pool.apply_async(simulateAndSample, args=(dict(argdict, **args),))
+                jobs.append(job)
+            for job, args in zip(jobs, blockArgs):
+                results.append(job.get())
+                if onBlock is not None:
+                    onBlock(args)
+            # The workers close their writers when they exit
+            pool.close()
+            pool.join()
+        if outputWriter is not None:
+            outputWriter.addStats(totals[:])
+    else:
+        for args in tqdm(blockArgs):
+            results.append(simulateAndSample(dict(argdict, **args)))
+            if onBlock is not None:
+                onBlock(args)
+    if outputWriter is not None:
+        outputWriter.flush()
+    return results
+
+def allocateToBranches(argdict, settings, pilotSize, cellStart, cellPars, sharedStates=None, onBlock=None):
+    """
+    Spend the cells that were not simulated in the pilot round on the
+    branches reached by few trajectories. The remaining cells are split
+    between allocation_rounds rounds. Before each round, the trajectories are
+    assigned to branches by k-means clustering of their final states, and
+    each branch is allotted new trajectories in proportion to the number of
+    cells it lacks to hold an equal share of num_cells.
+
+    New trajectories are split off from existing ones at split_time, which is
+    by default estimated as the time at which the mean trajectories of the
+    branches in the pilot round start to separate. A split trajectory shares
+    the states of its parent up to split_time, and continues with new noise.
+    Parents are drawn with a probability given by the fraction of the nearest
+    neighbours of their state at split_time which reached the branch, so the
+    choice does not depend on how the parent itself continued. Splitting a
+    trajectory of weight w into c + 1 trajectories of weight w/(c + 1) then
+    leaves weighted averages over the cells unbiased.
+
+    The weight of each cell, relative to a cell of a sample of num_cells
+    independent trajectories, its parent (-1 for the pilot trajectories),
+    the time at which it was split off, and its branch are written to
+    simulations/CellWeights.csv.
+
+    :param argdict: Arguments of simulateAndSample()
+    :type argdict: dict
+    :param settings: The job settings dictionary
+    :type settings: dict
+    :param pilotSize: Number of pilot trajectories, cell ids 0 to pilotSize - 1
+    :type pilotSize: int
+    :param cellStart: Array of shape (num_cells, d), whose first pilotSize rows are the initial states of the pilot trajectories
+    :type cellStart: ndarray
+    :param cellPars: Array of the per-cell parameters, or None. The rows of the split trajectories are set to those of their parents.
+    :type cellPars: ndarray
+    :param sharedStates: The shared array of the recorded states of every cell, with the shared backend. The trajectories are then not read back from file.
+    :type sharedStates: ndarray
+    :param onBlock: Passed on to simulateBlocks()
+    :type onBlock: function
+    :returns:
+        - results: List of the return values of simulateAndSample() for the split trajectories
+        - origin: Array holding, for each cell, the pilot trajectory it descends from
+    """
+    from sklearn.neighbors import NearestNeighbors
+    numCells = settings['num_cells']
+    nClusters = settings['nClusters']
+    simPrefix = argdict['outPrefix'] + '/simulations/'
+    tspan = argdict['tspan']
+    stride = argdict['recordStride']
+    numRecorded = len(tspan[::stride])
+    # The branch point is located on a grid of at most 100 recorded time points
+    grid = np.unique(np.linspace(1, numRecorded - 1, min(numRecorded - 1, 100)).astype(int))
+    weights = np.ones(numCells)
+    parent = np.full(numCells, -1)
+    origin = np.arange(numCells)
+    splitAt = np.zeros(numCells, dtype=int)
+    # Gene expression of each trajectory on the grid
+    gridStates = np.zeros((numCells, len(grid), len(argdict['genelist'])))
+
+    gid = [i for i, n in argdict['varmapper'].items() if 'x_' in n]
+
+    def readGrid(cellids):
+        for cellid in cellids:
+            if sharedStates is not None:
+                gridStates[cellid] = sharedStates[cellid][grid - 1][:, gid]
+                continue
+            df = pd.read_csv(simPrefix + 'E' + str(cellid) + '.csv', index_col=0)
+            gridStates[cellid] = df.values[:, grid - 1].T
+
+    def branches(count):
+        return clusterStates(gridStates[:count, -1], nClusters, settings['clusterSeeds'], argdict['genelist'])
+
+    readGrid(range(pilotSize))
+    labels = branches(pilotSize)
+    if settings['split_time'] is not None:
+        splitIndex = int(round(settings['split_time']/(tspan[stride] - tspan[0])))
+    else:
+        # First time point at which the mean trajectories of two branches
+        # are a quarter of their largest distance apart
+        means = np.array([gridStates[:pilotSize][labels == k].mean(axis=0) for k in range(nClusters)])
+        separation = np.max([np.linalg.norm(means[a] - means[b], axis=1)\
+                             for a, b in combinations(range(nClusters), 2)], axis=0)
+        splitIndex = grid[np.argmax(separation >= 0.25*separation.max())]
+    splitIndex = min(max(splitIndex, 1), numRecorded - 2)
+    gridIndex = np.argmin(np.abs(grid - splitIndex))
+    print('Splitting trajectories at t=%g' % tspan[splitIndex*stride])
+
+    rounds = max(settings['allocation_rounds'], 1)
+    simulated = pilotSize
+    results = []
+    for r in range(rounds):
+        budget = (numCells - pilotSize)*(r + 1)//rounds - (simulated - pilotSize)
+        counts = np.bincount(labels, minlength=nClusters)
+        print('Round %d: cells per branch' % (r + 1), counts.tolist())
+        if budget <= 0:
+            continue
+        # Allot the round to the branches in proportion to the cells they lack
+        deficit = np.maximum((simulated + budget)/nClusters - counts, 0.)
+        share = budget*deficit/deficit.sum()
+        allotted = np.floor(share).astype(int)
+        allotted[np.argsort(allotted - share)[:budget - allotted.sum()]] += 1
+        # Score of each trajectory: the fraction of the nearest neighbours of
+        # its state at the split time which reached each branch
+        X = gridStates[:simulated, gridIndex]
+        numNeighbours = min(10, simulated - 1)
+        neighbours = NearestNeighbors(n_neighbors=numNeighbours + 1).fit(X).kneighbors(X, return_distance=False)
+        scores = np.zeros((simulated, nClusters))
+        for i, row in enumerate(neighbours):
+            others = row[row != i][:numNeighbours]
+            scores[i] = np.bincount(labels[others], minlength=nClusters)/len(others)
+        chosen = []
+        for k in range(nClusters):
+            if allotted[k] == 0:
+                continue
+            p = scores[:, k]
+            p = p/p.sum() if p.sum() > 0 else None
+            chosen.extend(np.random.choice(simulated, size=allotted[k], p=p))
+        chosen = np.array(chosen, dtype=int)
+        children = np.arange(simulated, simulated + len(chosen))
+        # Each parent and its children share the weight of the parent
+        copies = np.bincount(chosen, minlength=simulated)
+        weights[:simulated] /= copies + 1
+        weights[children] = weights[chosen]
+        parent[children] = chosen
+        origin[children] = origin[chosen]
+        splitAt[children] = splitIndex
+        if cellPars is not None:
+            # Split trajectories keep the parameters of their parent
+            cellPars[children] = cellPars[chosen]
+        # States of the parents up to the split time
+        prefixStates = np.zeros((len(chosen), splitIndex + 1, len(argdict['varmapper'])))
+        for c, p in enumerate(chosen):
+            prefixStates[c, 0] = cellStart[origin[p]]
+            if sharedStates is not None:
+                prefixStates[c, 1:] = sharedStates[p, :splitIndex]
+                continue
+            full = pd.read_csv(simPrefix + 'Efull' + str(p) + '.csv', index_col=0,
+                               float_precision='round_trip').values
+            prefixStates[c, 1:] = full[:, :splitIndex].T
+        blockArgs = []
+        for i in range(0, len(chosen), settings['batch_size']):
+            block = np.arange(i, min(i + settings['batch_size'], len(chosen)))
+            args = {'seeds': children[block] + 1000,
+                    'cellids': children[block],
+                    'cellPrefixes': [argdict['outPrefix']]*len(block),
+                    'perturbed': np.zeros(len(block), dtype=bool),
+                    'rows': children[block],
+                    'initialStates': prefixStates[block, splitIndex],
+                    'prefixStates': prefixStates[block, :splitIndex],
+                    'splitIndex': splitIndex}
+            if cellPars is not None:
+                args['cellPars'] = cellPars[children[block]]
+            blockArgs.append(args)
+        results.extend(simulateBlocks(argdict, blockArgs, settings['doParallel'],
+                                      settings['parallel_backend'] == 'thread', onBlock))
+        readGrid(children)
+        simulated += len(chosen)
+        labels = branches(simulated)
+    counts = np.bincount(labels, minlength=nClusters)
+    weights *= numCells/pilotSize
+    print('Cells per branch', counts.tolist(), 'weighted',
+          [round(weights[labels == k].sum()) for k in range(nClusters)])
+    weightDF = pd.DataFrame({'weight': weights,
+                             'parent': parent,
+                             'split_time': np.where(parent >= 0, tspan[splitAt*stride], np.nan),
+                             'branch': labels},
+                            index=pd.Index(['E' + str(cellid) for cellid in range(numCells)]))
+    weightDF.to_csv(simPrefix + 'CellWeights.csv')
+    return results, origin
+
+def getIntegrator(argdict):
+    """
+    Returns the batch integrator selected by argdict['integrator'], and
+    a dictionary of the options it is called with.
+    """
+    if argdict['integrator'] == 'adaptive':
+        integrate = simulator.adaptivesdeBatch
+        options = dict(argdict['adaptiveOptions'])
+    else:
+        integrate = simulator.eulersdeBatch
+        options = {'scheme': argdict['integrator'],
+                   'decay': argdict['decay']}
+    options['noiseStep'] = argdict['noiseStep']
+    return integrate, options
+
+def burnIn(argdict, y0, settings):
+    """
+    Integrate a pool of burn_in_pool_size trajectories from y0 for
+    burn_in_time, with a step size of burn_in_step_size, and return their
+    final states. Cells are then started from these states instead of y0.
+    The amount of noise is that of the simulations, see noise_step_size.
+
+    The pool is cached in [output_dir]/burnin-cache/, in a file named by a
+    hash of the model, the parameters, y0 and the burn-in settings, so that
+    it is only integrated once for all the jobs and runs that share these.
+
+    :param argdict: Arguments of simulateAndSample()
+    :type argdict: dict
+    :param y0: Initial condition
+    :type y0: list
+    :param settings: The job settings dictionary
+    :type settings: dict
+    :returns:
+        - states: Array of shape (burn_in_pool_size, d) containing the burnt in states
+    """
+    poolSize = min(settings['burn_in_pool_size'], settings['num_cells'])
+    burnInTime = settings['burn_in_time']
+    burnInStep = settings['burn_in_step_size']
+    if burnInStep is None:
+        burnInStep = settings['integration_step_size']
+    noiseStep = argdict['noiseStep']
+    if noiseStep is None:
+        noiseStep = settings['integration_step_size']
+    with open(argdict['mg'].path_to_ode_model, 'r') as f:
+        modelDefinition = f.read()
+    key = {'model': modelDefinition,
+           'pars': [float(p) for p in argdict['pars']],
+           'y0': [float(v) for v in y0],
+           'time': burnInTime,
+           'step': burnInStep,
+           'noise': noiseStep,
+           'integrator': argdict['integrator'],
+           'adaptive': argdict['adaptiveOptions'] if argdict['integrator'] == 'adaptive' else None,
+           'size': poolSize}
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    cachepath = Path(settings['burnInCachePath'])
+    cachefile = cachepath / (digest + '.npy')
+    if cachefile.is_file():
+        print('Using cached burn-in states', cachefile)
+        return np.load(cachefile)
+
+    print('Burn-in: integrating %d trajectories for t=%g' % (poolSize, burnInTime))
+    start = time.time()
+    tspan = np.linspace(0, burnInTime, max(2, int(burnInTime/burnInStep)))
+    integrate, options = getIntegrator(argdict)
+    options['noiseStep'] = noiseStep
+    # Only the final state of each trajectory is kept
+    options['captureIndex'] = np.full((poolSize, 1), len(tspan) - 1)
+    gid = [i for i, n in argdict['varmapper'].items() if 'x_' in n]
+    with np.errstate(under='ignore'):
+        Y, info = integrate(argdict['Model'], simulator.noise,
+                            [y0 for _ in range(poolSize)],
+                            tspan, argdict['pars'],
+                            # Seeds which are not used by the cells
+                            [10**7 + i for i in range(poolSize)],
+                            deadIndex=gid,
+                            deadThreshold=0.1*argdict['x_max'],
+                            **options)
+    states = Y[:, 0]
+    print('Burn-in took %0.3f s' % (time.time() - start))
+    os.makedirs(cachepath, exist_ok=True)
+    np.save(cachefile, states)
+    return states
+
+def startWriter(queueSize, totals=None):
+    """
+    Start a background writer for the files written by this process, see
+    writeCSV(). In a worker process, totals is a shared array to which the
+    statistics of the writer are added when the worker exits.
+
+    :param queueSize: Largest number of files waiting to be written
+    :type queueSize: int
+    :param totals: Shared array of the statistics of the workers, in the order of writer.STATS
+    :type totals: multiprocessing.Array
+    """
+    global outputWriter
+    outputWriter = AsyncWriter(queueSize)
+    if totals is not None:
+        import multiprocessing.util
+        multiprocessing.util.Finalize(None, stopWriter, args=(totals,), exitpriority=10)
+
+def stopWriter(totals=None):
+    """
+    Write the files queued by the background writer of this process, if
+    one was started, and stop it.
+
+    :returns:
+        - writer: The stopped writer, or None
+    """
+    global outputWriter
+    writer, outputWriter = outputWriter, None
+    if writer is not None:
+        writer.close()
+        if totals is not None:
+            with totals.get_lock():
+                totals[:] = combineStats(totals[:], writer.values())
+    return writer
+
+def writeCSV(df, path, **kwargs):
+    """
+    Write df to the CSV file path, in the background if a writer was
+    started with startWriter().
+    """
+    if outputWriter is not None:
+        outputWriter.write(path, df, **kwargs)
+    else:
+        df.to_csv(path, **kwargs)
+
+def createSharedBuffers(shapes):
+    """
+    Allocate a shared memory block for each array of floats in shapes,
+    which worker processes can attach to with attachSharedBuffers().
+
+    :param shapes: Dictionary mapping the name of each array to its shape
+    :type shapes: dict
+    :returns:
+        - handles: Dictionary of the SharedMemory blocks, to be released with releaseSharedBuffers()
+        - specs: Dictionary mapping the name of each array to the name of its block and its shape
+    """
+    from multiprocessing import shared_memory
+    handles = {}
+    specs = {}
+    for key, shape in shapes.items():
+        handles[key] = shared_memory.SharedMemory(create=True, size=max(1, 8*int(np.prod(shape))))
+        specs[key] = (handles[key].name, tuple(shape))
+    return handles, specs
+
+def attachSharedBuffers(specs):
+    """
+    Attach to the shared memory blocks created by createSharedBuffers().
+    The arrays must be deleted before the blocks are released.
+
+    :param specs: Dictionary mapping the name of each array to the name of its block and its shape
+    :type specs: dict
+    :returns:
+        - handles: Dictionary of the SharedMemory blocks
+        - arrays: Dictionary of the arrays backed by the blocks
+    """
+    from multiprocessing import shared_memory
+    handles = {key: shared_memory.SharedMemory(name=name) for key, (name, _) in specs.items()}
+    arrays = {key: np.ndarray(shape, dtype=float, buffer=handles[key].buf)\
+              for key, (_, shape) in specs.items()}
+    return handles, arrays
+
+def releaseSharedBuffers(handles, unlink=False):
+    """
+    Close the shared memory blocks, and free them if unlink is True.
+    """
+    for handle in handles.values():
+        handle.close()
+        if unlink:
+            handle.unlink()
+
+def writeTrajectory(outPrefix, cellid, states, genelist, varmapper, edgelist,
+                    velocity=None, jacobian=None):
+    """
+    Write the recorded states of a cell to E[cellid].csv (genes) and
+    Efull[cellid].csv (every species), and the velocities and Jacobian
+    entries, if given, to V[cellid].csv and J[cellid].csv in outPrefix.
+
+    :param states: Array of shape (recorded time points, species)
+    :type states: ndarray
+    :param velocity: Array of shape (recorded time points, genes), or None
+    :type velocity: ndarray
+    :param jacobian: Array of shape (recorded time points, edges), or None
+    :type jacobian: ndarray
+    """
+    gid = [i for i, n in varmapper.items() if 'x_' in n]
+    columns = ['E' + str(cellid) + '_' + str(i) for i in range(1, len(states) + 1)]
+    df = pd.DataFrame(states[:, gid].T,
+                      index=pd.Index(genelist),
+                      columns=columns)
+    writeCSV(df, outPrefix + 'E' + str(cellid) + '.csv')
+    df_full = pd.DataFrame(states.T,
+                           index=pd.Index([n for (i, n) in varmapper.items()]),
+                           columns=columns)
+    writeCSV(df_full, outPrefix + 'Efull' + str(cellid) + '.csv')
+    if velocity is not None:
+        vdf = pd.DataFrame(velocity.T,
+                           index=pd.Index(genelist),
+                           columns=columns)
+        writeCSV(vdf, outPrefix + 'V' + str(cellid) + '.csv')
+    if jacobian is not None:
+        Jdf = pd.DataFrame(jacobian.T,
+                           index=pd.Index(edgelist),
+                           columns=columns)
+        writeCSV(Jdf, outPrefix + 'J' + str(cellid) + '.csv')
+
 def simulateAndSample(argdict):
     """
     Handles parallelization of ODE simulations.
-    Calls the simulator with simulation settings.
+    Calls the simulator with simulation settings. The cells in
+    argdict['cellids'] are integrated together as one batch.
+
+    In snapshot mode, only the states at the recorded time points in
+    argdict['captureIndex'] are kept, and nothing is written to file.
+
+    If argdict['splitIndex'] is larger than 0, the cells are split off from
+    other trajectories at that recorded time point: they are integrated from
+    argdict['initialStates'] for the rest of tspan, and the states of the
+    parents at the earlier time points, argdict['prefixStates'], are prepended.
+
+    If argdict['cellPars'] is specified, each cell is integrated with its own
+    row of values of the parameters in argdict['cellParNames']. The files of
+    each cell are written to the simulations/ folder in its entry of
+    argdict['cellPrefixes'].
+
+    If argdict['recordVelocity'] is True, the velocity of each gene, i.e. the
+    drift evaluated by the integrator, is written to V[cellid].csv. If
+    argdict['Jacobian'] is specified, the Jacobian entries along the edges of
+    the network are evaluated at the recorded states and written to
+    J[cellid].csv, with rows labelled target_regulator.
+
+    :returns:
+        - summaryDF: DataFrame with the seed and stream of the accepted trajectory, number of tries, the time at which each cell settled on a steady state (NaN if it did not) and the number of model evaluations
+        - snapshotDF: DataFrame of the captured states, with columns named 'E[cellid]_[time point]', or None if not in snapshot mode
+        - snapshotVDF: DataFrame of the velocities of the captured states, or None
+        - snapshotJDF: DataFrame of the Jacobian entries at the captured states, or None
     """
     mg = argdict['mg']
     allParameters = argdict['allParameters']
@@ -287,7 +2022,7 @@ def simulateAndSample(argdict):
     genelist = argdict['genelist']
     proteinlist = argdict['proteinlist']
     writeProtein=argdict['writeProtein']
-    cellid = argdict['cellid']
+    cellids = argdict['cellids']
     outPrefix = argdict['outPrefix']
     sampleCells = argdict['sampleCells']
     ss = argdict['ss']
@@ -297,13 +2032,10 @@ def simulateAndSample(argdict):
     genelist = argdict['genelist']
     proteinlist = argdict['proteinlist']
     revvarmapper = argdict['revvarmapper']
-    seed = argdict['seed']
+    seeds = argdict['seeds']
     pars = argdict['pars']
     x_max = argdict['x_max']
     
-    # Retained for debugging
-    isStochastic = True
-    
     if sampleCells:
         header = argdict['header']
     pars = {}
@@ -311,91 +2043,148 @@ def simulateAndSample(argdict):
         pars[k] = v
     pars = [pars[k] for k in parNames]
     
-    ## Boolean to check if a simulation is going to a
-    ## 0 steady state, with all genes/proteins dying out
-    retry = True
-    trys = 0
-    ## timepoints
-    tps = [i for i in range(1,len(tspan))]
+    ## recorded timepoints
+    recordStride = argdict['recordStride']
+    tps = [i for i in range(1,len(tspan[::recordStride]))]
     ## gene ids
     gid = np.array([i for i,n in varmapper.items() if 'x_' in n])
-    outPrefix = outPrefix + '/simulations/'
-    # SZ: Jacobian
-    model_f = lambda x: Model(x, None, pars)
-    JModel = jacobian(model_f)
-    pd.DataFrame(pars).to_csv(outPrefix + 'param.csv')
-    # End SZ
-    while retry:
-        seed += 1000
-        y0_exp = simulator.getInitialCondition(ss, ModelSpec, rnaIndex, proteinIndex,
-                                     genelist, proteinlist,
-                                     varmapper,revvarmapper)
-        
-        P = simulator.simulateModel(Model, y0_exp, pars, isStochastic, tspan, seed)
-        # SZ: pull Jacobians
-        # JP = np.stack([JModel(p) for p in P])
-        # dP = np.vstack([model_f(p) for p in P])
-        # dP = dP.T
-        # end SZ
-        P = P.T
-        retry = False
-        ## Extract Time points
-        subset = P[gid,:][:,tps]
-        df = pd.DataFrame(subset,
-                          index=pd.Index(genelist),
-                          columns = ['E' + str(cellid) +'_' +str(i)\
-                                     for i in tps])
-        df.to_csv(outPrefix + 'E' + str(cellid) + '.csv')
-
-        df_full = pd.DataFrame(P[:, tps],
-                          index=pd.Index([n for (i, n) in varmapper.items()]),
-                          columns = ['E' + str(cellid) +'_' +str(i)\
-                                     for i in tps])
-        df_full.to_csv(outPrefix + 'Efull' + str(cellid) + '.csv')
-        ## SZ: save Jacobians and velocity
-        # interactionlist = list([x + '_' + y for (x, y) in product(genelist, repeat = 2)])
-        # JP_reduced = JP[:, gid, :][:, :, gid+1]
-        # Jdf = pd.DataFrame(JP_reduced.reshape(-1, JP_reduced.shape[1]*JP_reduced.shape[2])[tps, :].T,
-        #                    index = pd.Index(interactionlist),
-        #                    columns = ['E' + str(cellid) +'_' +str(i)\
-        #                              for i in tps])
-        # Jdf.to_csv(outPrefix + 'J' + str(cellid) + '.csv')
-        # vdf = pd.DataFrame(dP[gid, :][:, tps],
-        #                    index = pd.Index(genelist),
-        #                    columns = ['E' + str(cellid) +'_' +str(i)\
-        #                              for i in tps])
-        # vdf.to_csv(outPrefix + 'V' + str(cellid) + '.csv')
-
-        ##
-        ## Heuristic:
-        ## If the largest value of a protein achieved in a simulation is
-        ## less than 10% of the y_max, drop the simulation.
-        ## This check stems from the observation that in some simulations,
-        ## all genes go to the 0 steady state in some rare simulations.
-        dfmax = df.max()
-        for col in df.columns:
-            colmax = df[col].max()
-            if colmax < 0.1*x_max:
-                retry= True
-                break
-        
-        if sampleCells:
-            ## Write a single cell to file
-            ## These samples allow for quickly and
-            ## reproducibly testing the output.
-            sampledf = utils.sampleCellFromTraj(cellid,
-                                          tspan, 
-                                          P,
-                                          varmapper, timeIndex,
-                                          genelist, proteinlist,
-                                          header,
-                                          writeProtein=writeProtein)
-            sampledf = sampledf.T
-            sampledf.to_csv(outPrefix + 'E' + str(cellid) + '-cell.csv')            
-            
-        trys += 1
-        # write to file
-        df.to_csv(outPrefix + 'E' + str(cellid) + '.csv')
-        
+    # Output folder of each cell, see perturbations
+    cellPrefixes = argdict['cellPrefixes']
+    cellPars = argdict['cellPars']
+    if cellPars is not None:
+        # Kinetic parameters holding a value per cell of the batch
+        for j, k in enumerate(argdict['cellParNames']):
+            pars[parNames.index(k)] = cellPars[:, j]
+    recordVelocity = argdict['recordVelocity']
+    Jacobian = argdict['Jacobian']
+    edgelist = argdict['edgelist']
+    y0_exp = simulator.getInitialCondition(ss, ModelSpec, rnaIndex, proteinIndex,
+                                           genelist, proteinlist,
+                                           varmapper,revvarmapper)
+    ##
+    ## Heuristic:
+    ## If the largest value of a gene achieved at a time point is
+    ## less than 10% of the x_max, drop the simulation.
+    ## This check stems from the observation that in some simulations,
+    ## all genes go to the 0 steady state in some rare simulations.
+    ## The integrator checks this at every step, and restarts a
+    ## trajectory with a new seed as soon as it collapses.
+    ## Perturbed cells are not checked, a perturbation may
+    ## switch off every gene.
+    integrate, options = getIntegrator(argdict)
+    options['recordStride'] = recordStride
+    options['recordVelocity'] = recordVelocity
+    if cellPars is not None and 'decay' in options:
+        options['decay'] = np.column_stack([np.broadcast_to(pars[j], (len(cellids),))\
+                                            for j in argdict['decayIndex']])
+    if argdict['snapshot']:
+        options['captureIndex'] = argdict['captureIndex']
+    if argdict['initialStates'] is not None:
+        # Start from the burnt in states
+        y0s = argdict['initialStates']
+    else:
+        y0s = [y0_exp for _ in cellids]
+    splitIndex = argdict['splitIndex']
+    # Split trajectories continue from the state at recorded time point
+    # splitIndex. The model does not depend on time.
+    tstart = splitIndex*recordStride
+    # The schemes which integrate degradation exactly drive inactive species
+    # much closer to 0, where the Hill terms underflow harmlessly
+    with np.errstate(under='ignore'):
+        Y, info = integrate(Model, simulator.noise,
+                            y0s,
+                            tspan[tstart:] - tspan[tstart], pars,
+                            seeds, argdict['streams'],
+                            deadIndex=gid,
+                            deadThreshold=np.where(argdict['perturbed'], 0., 0.1*x_max),
+                            steadyStateWindow=argdict['steadyStateWindow'],
+                            steadyStateTol=argdict['steadyStateTol'],
+                            steadyStateScale=argdict['steadyStateScale'],
+                            steadyStateFill=argdict['steadyStateFill'],
+                            **options)
+    if splitIndex > 0:
+        # Prepend the states of the parent trajectories
+        prefixStates = argdict['prefixStates']
+        Y = np.concatenate([prefixStates, Y], axis=1)
+        info['settled'] = np.where(info['settled'] >= 0, info['settled'] + tstart, -1)
+        if recordVelocity:
+            with np.errstate(under='ignore'):
+                prefixV = simulator.evaluateBatch(Model, prefixStates.reshape(-1, prefixStates.shape[2]), 0., pars,
+                                                  np.repeat(np.arange(len(cellids)), splitIndex)\
+                                                  if cellPars is not None else None)
+            info['velocity'] = np.concatenate([prefixV.reshape(prefixStates.shape), info['velocity']], axis=1)
+    # States, and their velocities, at the time points written to file
+    stored = Y if argdict['snapshot'] else Y[:, tps]
+    if recordVelocity:
+        VY = info['velocity'] if argdict['snapshot'] else info['velocity'][:, tps]
+    if Jacobian is not None:
+        # Jacobian entries at every stored state, evaluated in one call
+        with np.errstate(under='ignore'):
+            JY = simulator.evaluateBatch(Jacobian, stored.reshape(-1, stored.shape[2]), 0., pars,
+                                         np.repeat(np.arange(stored.shape[0]), stored.shape[1])\
+                                         if cellPars is not None else None)
+        JY = JY.reshape(stored.shape[0], stored.shape[1], -1)
+    snapshotDF = None
+    snapshotVDF = None
+    snapshotJDF = None
+    if argdict['snapshot']:
+        captureIndex = argdict['captureIndex']
+        columns = ['E' + str(cellid) + '_' + str(i)\
+                   for cellid, capture in zip(cellids, captureIndex)\
+                   for i in capture]
+        snapshotDF = pd.DataFrame(np.concatenate([P.T for P in Y], axis=1),
+                                  index=pd.Index([n for (i, n) in varmapper.items()]),
+                                  columns=columns)
+        if recordVelocity:
+            snapshotVDF = pd.DataFrame(np.concatenate([V.T[gid] for V in VY], axis=1),
+                                       index=pd.Index(genelist),
+                                       columns=columns)
+        if Jacobian is not None:
+            snapshotJDF = pd.DataFrame(np.concatenate([J.T for J in JY], axis=1),
+                                       index=pd.Index(edgelist),
+                                       columns=columns)
+    else:
+        if argdict['sharedBuffers'] is not None:
+            # Hand the stored states to the parent process without copying
+            # them through files
+            handles, arrays = attachSharedBuffers(argdict['sharedBuffers'])
+            rows = argdict['rows']
+            arrays['states'][rows] = stored
+            if recordVelocity:
+                arrays['velocity'][rows] = VY[:, :, gid]
+            if Jacobian is not None:
+                arrays['jacobian'][rows] = JY
+            del arrays
+            releaseSharedBuffers(handles)
+        for b, (cellid, P) in enumerate(zip(cellids, Y)):
+            outPrefix = cellPrefixes[b] + '/simulations/'
+            if argdict['sharedBuffers'] is None:
+                writeTrajectory(outPrefix, cellid, stored[b], genelist, varmapper, edgelist,
+                                VY[b][:, gid] if recordVelocity else None,
+                                JY[b] if Jacobian is not None else None)
+            P = P.T
+            if sampleCells:
+                ## Write a single cell to file
+                ## These samples allow for quickly and
+                ## reproducibly testing the output.
+                sampledf = utils.sampleCellFromTraj(cellid,
+                                              tspan, 
+                                              P,
+                                              varmapper, timeIndex,
+                                              genelist, proteinlist,
+                                              header,
+                                              writeProtein=writeProtein)
+                sampledf = sampledf.T
+                writeCSV(sampledf, outPrefix + 'E' + str(cellid) + '-cell.csv')
+
+    for cellid, trys in zip(cellids, info['tries']):
         if trys > 1:
-            print('try', trys)
+            print('E' + str(cellid), 'try', trys)
+
+    summaryDF = pd.DataFrame({'seed': info['seeds'],
+                              'stream': info['streams'],
+                              'tries': info['tries'],
+                              'settled': [tspan[k] if k >= 0 else np.nan for k in info['settled']],
+                              'nfev': info['nfev']},
+                             index=pd.Index(['E' + str(cellid) for cellid in cellids]))
+    return summaryDF, snapshotDF, snapshotVDF, snapshotJDF
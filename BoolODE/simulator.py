@@ -1,5 +1,4 @@
 import numpy as np
-import autograd.numpy as anp
 
 def noise(x,t):
     # Controls noise proportional to
@@ -63,6 +62,615 @@ def eulersde(f,G,y0,tspan,pars,seed=0.,dW=None):
         n += 1 
     return y
 
+def rowGenerator(seed, stream=0):
+    """
+    Random number generator of a trajectory. Stream 0 is seeded with seed,
+    as in deltaW(). Any other stream is seeded with SeedSequence([seed, stream]),
+    so that it does not share increments with stream 0, or with another
+    stream, whatever the seeds.
+
+    :param seed: Seed of the trajectory
+    :type seed: int
+    :param stream: Stream of seeds the trajectory belongs to
+    :type stream: int
+    :returns:
+        - rng: numpy RandomState
+    """
+    if stream == 0:
+        return np.random.RandomState(seed)
+    return np.random.RandomState(np.random.MT19937(np.random.SeedSequence([seed, stream])))
+
+def hasRowParameters(pars):
+    """
+    Returns True if any entry of pars is an array holding a value per row
+    of the batch, rather than a single value shared by all rows.
+    """
+    return any(np.ndim(p) > 0 for p in pars)
+
+def batchParameters(pars, rows):
+    """
+    Select the parameters of some rows of a batch. Entries of pars are either
+    shared by all rows, or arrays holding a value per row.
+
+    :param pars: List of parameter values
+    :type pars: list
+    :param rows: Indices of the rows
+    :type rows: ndarray
+    :returns:
+        - pars: List of parameter values of the rows. A single row gets scalar values.
+    """
+    if len(rows) == 1:
+        return [p[rows[0]] if np.ndim(p) > 0 else p for p in pars]
+    return [p[rows] if np.ndim(p) > 0 else p for p in pars]
+
+def evaluateBatch(f, Y, t, pars, rows=None):
+    """
+    Evaluate the model function on a batch of states. The generated Model()
+    indexes variables as Y[i], so passing the transposed batch evaluates
+    every equation over all rows at once. A single row is evaluated on a
+    flat vector, which keeps scalar arithmetic for the unbatched case.
+
+    :param f: function defining ODE model
+    :type f: function
+    :param Y: Array of shape (B, d) containing the current states
+    :type Y: ndarray
+    :param rows: If specified, the entries of pars holding a value per row are indexed by rows, see batchParameters()
+    :type rows: ndarray
+    :returns:
+        - dY: Array of shape (B, d) containing the time derivatives
+    """
+    if rows is not None:
+        pars = batchParameters(pars, rows)
+    if Y.shape[0] == 1:
+        return f(Y[0], t, pars)[np.newaxis, :]
+    return f(Y.T, t, pars).T
+
+def fillVelocity(f, y, v, missing, pars):
+    """
+    Evaluate the model function at the recorded states whose velocity
+    was not captured during integration, in a single batched call.
+
+    :param y: Array of shape (B, R, d) containing the recorded states
+    :type y: ndarray
+    :param v: Array of the same shape as y, filled in place
+    :type v: ndarray
+    :param missing: Boolean array of shape (B, R), True where v is to be filled in
+    :type missing: ndarray
+    """
+    rows, cols = np.nonzero(missing)
+    if rows.size > 0:
+        v[rows, cols] = evaluateBatch(f, y[rows, cols], 0., pars,
+                                      rows if hasRowParameters(pars) else None)
+
+def isSteadyState(window, tol):
+    """
+    Windowed drift and variance test. The window is split into two halves,
+    and the trajectory is considered to have settled if, for every variable,
+    both the mean and the standard deviation differ between the two halves
+    by at most tol.
+
+    :param window: Array of shape (2*halfWindow, d) containing the last time points
+    :type window: ndarray
+    :param tol: Tolerance, scalar or array of length d
+    :type tol: ndarray
+    :returns:
+        - steady: True if the trajectory has settled
+        - mean: Mean of the second half window
+        - std: Standard deviation of the second half window
+    """
+    halfWindow = window.shape[0]//2
+    prev = window[:halfWindow]
+    curr = window[halfWindow:]
+    m = curr.mean(axis=0)
+    sd = curr.std(axis=0)
+    steady = np.all(np.abs(m - prev.mean(axis=0)) <= tol)\
+        and np.all(np.abs(sd - prev.std(axis=0)) <= tol)
+    return steady, m, sd
+
+def eulersdeBatch(f,G,y0,tspan,pars,seeds,streams=None,
+                  deadIndex=None,deadThreshold=0.,
+                  steadyStateWindow=None,steadyStateTol=0.05,
+                  steadyStateScale=1.,steadyStateFill='pad',
+                  scheme='euler',decay=None,noiseStep=None,
+                  recordStride=1,captureIndex=None,
+                  recordVelocity=False):
+    """
+    Vectorized counterpart of eulersde() which integrates a batch of
+    trajectories together. Row b uses the Wiener increments generated by
+    deltaW(seed=seeds[b]), so a trajectory does not depend on the batch it
+    was simulated in. Rows may instead draw from other streams of seeds,
+    see rowGenerator().
+
+    The model is split as f(y) = N(y) - decay*y, where decay holds the rate of
+    the linear degradation term of each variable. scheme='euler' is the
+    explicit Euler-Maruyama scheme of eulersde(). The other schemes take the
+    nonlinear part N explicitly, and remain stable for step sizes well above
+    1/decay:
+
+    - 'semi-implicit': the linear part is taken implicitly,
+      y' = (y + h*N(y) + G*dW)/(1 + h*decay). One model evaluation per step.
+    - 'exponential': the linear part is integrated exactly, and N is
+      integrated with the second order exponential Runge-Kutta scheme
+      (ETDRK2, Cox and Matthews 2002). Two model evaluations per step.
+
+    The noise term of these schemes is scaled so that the stationary variance
+    of the linear part matches that of the exact solution.
+
+    Each entry of pars is either a single value shared by all rows, or an
+    array of shape (B,) holding the value of each row. In the latter case,
+    decay may be of shape (B, d) as well.
+
+    eulersde() draws Wiener increments with standard deviation h instead of
+    sqrt(h), so the amount of noise depends on the step size. If noiseStep is
+    specified, increments are drawn with standard deviation sqrt(h*noiseStep)
+    instead, which gives the amount of noise of a step size of noiseStep for
+    any h.
+
+    Only every recordStride-th step is stored, i.e. the states at
+    tspan[::recordStride], so that memory grows with the number of recorded
+    time points rather than with the number of steps.
+
+    If captureIndex is specified, only the states at the recorded time points
+    in captureIndex[b] are kept for row b, and each row is integrated up to
+    its last capture. Steady state detection is not carried out in this mode.
+
+    If recordVelocity is True, the drift f(y) at every stored state is
+    returned as well. The drift at a recorded time point is the model
+    evaluation the integrator makes when stepping from it, so this costs no
+    additional model evaluations, except for states that are not stepped from
+    (the last time point, time points filled in after a trajectory settled,
+    and captured states), which are evaluated together after integration.
+
+    If deadIndex is specified, the integrator checks every step whether all
+    the variables in deadIndex have dropped below deadThreshold. Such a
+    trajectory has collapsed to the 0 steady state, and is restarted in place
+    from its initial value with seed + 1000, in the same stream, while the
+    rest of the batch carries on.
+
+    If steadyStateWindow is specified, each trajectory is tested for having
+    settled on an attractor. The window is split into two halves, and a
+    trajectory has settled if, for every variable, both the mean and the
+    standard deviation differ between the two halves by less than
+    steadyStateTol*steadyStateScale. A settled trajectory is no longer
+    integrated. Its remaining time points are either padded with samples from
+    the mean and standard deviation of the last half window (steadyStateFill='pad'),
+    or set to the mean (steadyStateFill='hold').
+
+    :param f: function defining ODE model.
+    :type f: function
+    :param y0: Array of shape (B, d) containing the initial values of each trajectory
+    :type y0: ndarray
+    :param tspan: Array of timepoints to simulate
+    :type tspan: ndarray
+    :param pars: List of parameter values, see batchParameters()
+    :type pars: list
+    :param seeds: Seed of each trajectory
+    :type seeds: list
+    :param streams: Stream of seeds of each trajectory, see rowGenerator(). Default=None, stream 0.
+    :type streams: list
+    :param deadIndex: Indices of variables used to detect a collapsed trajectory
+    :type deadIndex: list
+    :param deadThreshold: Trajectories in which all deadIndex variables are below this value are restarted. Either one value, or an array of shape (B,) holding the value of each row
+    :type deadThreshold: float
+    :param steadyStateWindow: Number of steps in the window used to detect steady states. Default=None, no detection.
+    :type steadyStateWindow: int
+    :param steadyStateTol: Tolerance of the steady state test, relative to steadyStateScale
+    :type steadyStateTol: float
+    :param steadyStateScale: Typical magnitude of each variable, scalar or array of length d
+    :type steadyStateScale: ndarray
+    :param steadyStateFill: One of 'pad' or 'hold'
+    :type steadyStateFill: str
+    :param scheme: One of 'euler', 'semi-implicit' or 'exponential'
+    :type scheme: str
+    :param decay: Linear degradation rate of each variable, of shape (d,) or (B, d), required by the 'semi-implicit' and 'exponential' schemes
+    :type decay: ndarray
+    :param noiseStep: Step size the amount of noise is calibrated to. Default=None, the step size of tspan.
+    :type noiseStep: float
+    :param recordStride: Number of steps between recorded time points
+    :type recordStride: int
+    :param captureIndex: Array of shape (B, K) containing the sorted indices of the recorded time points to keep for each row. Default=None, keep all.
+    :type captureIndex: ndarray
+    :param recordVelocity: Return the drift at the stored states
+    :type recordVelocity: bool
+    :returns:
+        - y: Array of shape (B, R+1, d) containing the time courses at the R recorded time points, or of shape (B, K, d) containing the captured states
+        - info: Dictionary of arrays containing, for each row, the seed of the accepted trajectory ('seeds'), its stream ('streams'), the number of attempts ('tries'), the index in tspan at which it settled, or -1 ('settled'), and the number of model evaluations ('nfev'). If recordVelocity, 'velocity' holds the drift at the states in y.
+    """
+    N = len(tspan)
+    h = (tspan[N-1] - tspan[0])/(N - 1)
+    stride = int(recordStride)
+    R = (N - 1)//stride + 1
+    nsteps = (R - 1)*stride
+    y0 = np.atleast_2d(np.array(y0, dtype=float))
+    B, d = y0.shape
+    deadThreshold = np.broadcast_to(deadThreshold, (B,))
+    seeds = np.array(seeds, dtype=int)
+    streams = np.zeros(B, dtype=int) if streams is None else np.array(streams, dtype=int)
+    tries = np.ones(B, dtype=int)
+    settled = -np.ones(B, dtype=int)
+    if captureIndex is None:
+        y = np.zeros((B, R+1, d))
+        y[:,0] = y0
+        lastStep = np.full(B, nsteps)
+    else:
+        captureIndex = np.atleast_2d(np.array(captureIndex, dtype=int))
+        K = captureIndex.shape[1]
+        y = np.zeros((B, K, d))
+        captured = np.zeros(B, dtype=int)
+        lastStep = captureIndex[:, -1]*stride
+        steadyStateWindow = None
+    if recordVelocity:
+        v = np.zeros_like(y)
+        haveV = np.zeros(y.shape[:2], dtype=bool)
+    yc = y0.copy()
+    # Wiener increments of each row, identical to deltaW(N, d, h, seed)
+    # unless noiseStep is specified. These are drawn in chunks of
+    # chunkSize steps, so that memory does not grow with the number of steps.
+    sigma = h if noiseStep is None else np.sqrt(h*noiseStep)
+    chunkSize = min(N, 1024)
+    rngs = [rowGenerator(s, k) for s, k in zip(seeds, streams)]
+    dW = np.stack([rng.normal(0.0, sigma, (chunkSize, d)) for rng in rngs])
+    base = np.zeros(B, dtype=int)
+
+    def noiseStream(b, start, count):
+        # The next count increments of row b from step start on
+        Z = dW[b, start - base[b]:start - base[b] + count]
+        if len(Z) < count:
+            Z = np.concatenate([Z, rngs[b].normal(0.0, sigma, (count - len(Z), d))])
+        return Z
+
+    varying = hasRowParameters(pars)
+    if scheme != 'euler':
+        decay = np.array(decay, dtype=float)
+        if decay.ndim < 2:
+            decay = np.broadcast_to(decay, (d,))
+        expDecay = phi = phi2 = None
+        if scheme == 'exponential':
+            expDecay = np.exp(-h*decay)
+            phi = np.where(decay > 0, -np.expm1(-h*decay)/np.where(decay > 0, decay, 1.), h)
+            noiseGain = np.where(decay > 0, np.sqrt(-np.expm1(-2.*h*decay)/np.where(decay > 0, 2.*h*decay, 1.)), 1.)
+            phi2 = np.where(decay > 0, (h*decay + np.expm1(-h*decay))/np.where(decay > 0, h*decay**2, 1.), h/2.)
+        else:
+            noiseGain = np.sqrt(1. + 0.5*h*decay)
+    step = np.zeros(B, dtype=int)
+    nfev = np.zeros(B, dtype=int)
+    active = np.arange(B)[lastStep > 0]
+    if steadyStateWindow is not None:
+        # Window in units of recorded time points
+        halfWindow = max(1, int(steadyStateWindow)//(2*stride))
+        tol = steadyStateTol*np.broadcast_to(steadyStateScale, (d,))
+
+    while active.size > 0:
+        n = step[active]
+        for b in active[n - base[active] >= chunkSize]:
+            dW[b] = rngs[b].normal(0.0, sigma, (chunkSize, d))
+            base[b] += chunkSize
+        dWn = dW[active, n - base[active]]
+        yn = yc[active]
+        rows = active if varying else None
+        Fn = evaluateBatch(f, yn, n*h, pars, rows)
+        if recordVelocity and captureIndex is None:
+            at = n % stride == 0
+            v[active[at], n[at]//stride] = Fn[at]
+            haveV[active[at], n[at]//stride] = True
+        if scheme == 'euler':
+            ynew = yn + Fn*h + np.multiply(G(yn, n*h), dWn)
+        else:
+            if decay.ndim == 2:
+                # Rates of each row
+                dec, gain, eD, ph, ph2 = [a if a is None else a[active]\
+                                          for a in (decay, noiseGain, expDecay, phi, phi2)]
+            else:
+                dec, gain, eD, ph, ph2 = decay, noiseGain, expDecay, phi, phi2
+            nonlinear = Fn + dec*yn
+            noiseTerm = gain*np.multiply(G(yn, n*h), dWn)
+            if scheme == 'semi-implicit':
+                ynew = (yn + nonlinear*h + noiseTerm)/(1. + h*dec)
+            else:
+                # Predictor, then second order correction of the nonlinear part
+                ypred = np.maximum(eD*yn + ph*nonlinear + noiseTerm, 0.)
+                ynew = ypred + ph2*(evaluateBatch(f, ypred, n*h + h, pars, rows) + dec*ypred - nonlinear)
+                nfev[active] += 1
+        # Ensure positive terms
+        ynew = np.where(ynew < 0, yn, ynew)
+        nfev[active] += 1
+        n = n + 1
+        yc[active] = ynew
+        step[active] = n
+        recorded = n % stride == 0
+        if captureIndex is None:
+            y[active[recorded], n[recorded]//stride] = ynew[recorded]
+        else:
+            hit = recorded & (n//stride == captureIndex[active, np.minimum(captured[active], K-1)])
+            y[active[hit], captured[active[hit]]] = ynew[hit]
+            captured[active[hit]] += 1
+        if deadIndex is not None:
+            dead = ynew[:, deadIndex].max(axis=1) < deadThreshold[active]
+            for b in active[dead]:
+                seeds[b] += 1000
+                tries[b] += 1
+                rngs[b] = rowGenerator(seeds[b], streams[b])
+                dW[b] = rngs[b].normal(0.0, sigma, (chunkSize, d))
+                base[b] = 0
+                y[b] = 0.
+                if captureIndex is None:
+                    y[b, 0] = y0[b]
+                else:
+                    captured[b] = 0
+                if recordVelocity:
+                    haveV[b] = False
+                yc[b] = y0[b]
+                step[b] = 0
+        if steadyStateWindow is not None:
+            # Compare the last two half windows every halfWindow recorded time
+            # points, skipping the rows which have just been restarted
+            j = n//stride
+            rows = active[recorded & (j % halfWindow == 0) & (j >= 2*halfWindow) & (step[active] > 0)]
+            for b in rows:
+                k = step[b]//stride
+                steady, m, sd = isSteadyState(y[b, k-2*halfWindow+1:k+1], tol)
+                if steady:
+                    settled[b] = step[b]
+                    if steadyStateFill == 'pad':
+                        # Reuse the unused Wiener increments of this row as standard normal samples
+                        y[b, k+1:R] = np.maximum(m + sd*noiseStream(b, step[b], R-1-k)/sigma, 0.)
+                    else:
+                        y[b, k+1:R] = m
+                    step[b] = nsteps
+        active = active[step[active] < lastStep[active]]
+    info = {'seeds': seeds, 'streams': streams, 'tries': tries, 'settled': settled, 'nfev': nfev}
+    if recordVelocity:
+        if captureIndex is None:
+            haveV[:, R] = True
+        fillVelocity(f, y, v, ~haveV, pars)
+        info['velocity'] = v
+    return y, info
+
+def adaptivesdeBatch(f,G,y0,tspan,pars,seeds,streams=None,
+                     deadIndex=None,deadThreshold=0.,
+                     steadyStateWindow=None,steadyStateTol=0.05,
+                     steadyStateScale=1.,steadyStateFill='pad',
+                     atol=0.05,rtol=0.05,maxStep=0.2,noiseStep=None,
+                     recordStride=1,captureIndex=None,
+                     recordVelocity=False):
+    """
+    Adaptive step size counterpart of eulersdeBatch(). Each step takes a
+    derivative free Milstein step with a trapezoidal (Heun) drift, and
+    compares it to the Euler-Maruyama step driven by the same Wiener
+    increment. Each row chooses its own step size to keep the difference
+    between the two below atol + rtol*|y|.
+
+    When a step is rejected, its Wiener increment is split in two halves
+    using the Brownian bridge, and the second half is kept on a stack so that
+    the noise seen by the trajectory does not depend on the rejected steps.
+    Steps are not constrained to tspan. Instead, the recorded time points,
+    tspan[::recordStride], covered by an accepted step are filled in by
+    sampling the Brownian bridge between the two ends of the step, so that
+    the output is on the same grid as that of eulersdeBatch().
+
+    eulersde() draws Wiener increments with standard deviation h instead of
+    sqrt(h), where h is the spacing of tspan. To keep the amount of noise
+    unchanged, the diffusion term G is scaled by sqrt(h) and driven by
+    standard Wiener increments. If noiseStep is specified, G is scaled by
+    sqrt(noiseStep) instead, see eulersdeBatch().
+
+    Seeds and streams, and the collapsed trajectory and steady state checks
+    behave as in eulersdeBatch(). The collapse check is carried out after every accepted
+    step, and the steady state test at the recorded time points. captureIndex
+    and parameters holding a value per row behave as in eulersdeBatch(). Since the recorded states lie between the
+    steps, recordVelocity evaluates the drift at all of them after integration.
+
+    :param atol: Absolute tolerance of the local error estimate
+    :type atol: float
+    :param rtol: Relative tolerance of the local error estimate
+    :type rtol: float
+    :param maxStep: Largest step size
+    :type maxStep: float
+    :param noiseStep: Step size the amount of noise is calibrated to. Default=None, the step size of tspan.
+    :type noiseStep: float
+    :param recordStride: Spacing of the recorded time points, in units of the spacing of tspan
+    :type recordStride: int
+    :param captureIndex: Array of shape (B, K) containing the sorted indices of the recorded time points to keep for each row. Default=None, keep all.
+    :type captureIndex: ndarray
+    :param recordVelocity: Return the drift at the stored states
+    :type recordVelocity: bool
+    :returns:
+        - y: Array of shape (B, R+1, d) containing the time courses at the R recorded time points, or of shape (B, K, d) containing the captured states
+        - info: Dictionary of arrays, see eulersdeBatch()
+    """
+    N = len(tspan)
+    h = (tspan[N-1] - tspan[0])/(N - 1)
+    stride = int(recordStride)
+    trec = tspan[::stride]
+    R = len(trec)
+    eps = 1e-9*h
+    minStep = 1e-4*h
+    scale = np.sqrt(h if noiseStep is None else noiseStep)
+    y0 = np.atleast_2d(np.array(y0, dtype=float))
+    B, d = y0.shape
+    deadThreshold = np.broadcast_to(deadThreshold, (B,))
+    seeds = np.array(seeds, dtype=int)
+    streams = np.zeros(B, dtype=int) if streams is None else np.array(streams, dtype=int)
+    tries = np.ones(B, dtype=int)
+    settled = -np.ones(B, dtype=int)
+    nfev = np.zeros(B, dtype=int)
+    if captureIndex is None:
+        y = np.zeros((B, R+1, d))
+        y[:,0] = y0
+        tmax = np.full(B, trec[-1])
+    else:
+        captureIndex = np.atleast_2d(np.array(captureIndex, dtype=int))
+        K = captureIndex.shape[1]
+        y = np.zeros((B, K, d))
+        captured = np.zeros(B, dtype=int)
+        tmax = trec[captureIndex[:, -1]]
+        steadyStateWindow = None
+    # Current time, state and drift of each row
+    t = np.zeros(B)
+    yc = y0.copy()
+    F = np.zeros((B, d))
+    haveF = np.zeros(B, dtype=bool)
+    varying = hasRowParameters(pars)
+    # Index of the next time point to be recorded
+    rec = np.ones(B, dtype=int)
+    # Pending halves of rejected steps, as (dt, dW)
+    pending = [[] for _ in range(B)]
+    depth = np.zeros(B, dtype=int)
+    # Each row draws standard normal samples from its own generator
+    poolSize = max(R, 64)
+    rngs = [rowGenerator(s, k) for s, k in zip(seeds, streams)]
+    pool = np.stack([rng.standard_normal((poolSize, d)) for rng in rngs])
+    cursor = np.zeros(B, dtype=int)
+
+    def normals(rows):
+        for b in rows[cursor[rows] >= poolSize]:
+            pool[b] = rngs[b].standard_normal((poolSize, d))
+            cursor[b] = 0
+        Z = pool[rows, cursor[rows]]
+        cursor[rows] += 1
+        return Z
+
+    if steadyStateWindow is not None:
+        halfWindow = max(1, int(steadyStateWindow)//(2*stride))
+        tol = steadyStateTol*np.broadcast_to(steadyStateScale, (d,))
+        nextCheck = np.full(B, 2*halfWindow)
+    dtNext = np.full(B, h)
+    dt = np.full(B, h)
+    dW = np.sqrt(h)*normals(np.arange(B))
+    active = np.arange(B)[tmax > eps]
+
+    while active.size > 0:
+        need = active[~haveF[active]]
+        if need.size > 0:
+            F[need] = evaluateBatch(f, yc[need], t[need], pars, need if varying else None)
+            nfev[need] += 1
+            haveF[need] = True
+        yn = yc[active]
+        Fn = F[active]
+        ta = t[active]
+        dta = dt[active][:, np.newaxis]
+        sqdt = np.sqrt(dta)
+        dWa = dW[active]
+        Gn = G(yn, ta)*scale
+        yEM = yn + Fn*dta + Gn*dWa
+        # Derivative free Milstein correction for diagonal noise
+        ysup = yn + Fn*dta + Gn*sqdt
+        corr = (G(ysup, ta)*scale - Gn)*(dWa**2 - dta)/(2.*sqdt)
+        Fp = evaluateBatch(f, np.maximum(yEM + corr, 0.), ta + dt[active], pars,
+                           active if varying else None)
+        nfev[active] += 1
+        yHigh = yn + 0.5*(Fn + Fp)*dta + Gn*dWa + corr
+        sc = atol + rtol*np.maximum(np.abs(yn), np.abs(yHigh))
+        err = np.sqrt(np.mean((np.abs(yHigh - yEM)/sc)**2, axis=1))
+        ok = (err <= 1.) | (dt[active] <= minStep)
+        # Ensure positive terms
+        yHigh = np.where(yHigh < 0, yn, yHigh)
+
+        ## Rejected steps: retry over the first half of the Wiener increment
+        rej = active[~ok]
+        if rej.size > 0:
+            half = dt[rej]/2.
+            dW1 = dW[rej]/2. + np.sqrt(half/2.)[:, np.newaxis]*normals(rej)
+            for i, b in enumerate(rej):
+                pending[b].append((half[i], dW[b] - dW1[i]))
+            depth[rej] += 1
+            dt[rej] = half
+            dW[rej] = dW1
+
+        ## Accepted steps
+        acc = active[ok]
+        fac = np.clip(0.8*np.power(np.maximum(err[ok], 1e-10), -0.5), 0.2, 1.5)
+        yOld = yn[ok]
+        yNew = yHigh[ok]
+        Gacc = Gn[ok]
+        dWacc = dWa[ok]
+        tOld = t[acc]
+        tNew = tOld + dt[acc]
+        # Fill in the time points covered by the step by sampling the Brownian bridge
+        drift = yNew - yOld - Gacc*dWacc
+        tl = tOld.copy()
+        Wl = np.zeros_like(dWacc)
+        while True:
+            r = rec[acc]
+            sel = np.nonzero((r < R) & (trec[np.minimum(r, R-1)] <= tNew + eps))[0]
+            if sel.size == 0:
+                break
+            b = acc[sel]
+            ti = np.minimum(trec[r[sel]], tNew[sel])
+            span = np.maximum(tNew[sel] - tl[sel], eps)
+            frac = ((ti - tl[sel])/span)[:, np.newaxis]
+            var = ((ti - tl[sel])*(tNew[sel] - ti)/span)[:, np.newaxis]
+            Wi = Wl[sel] + frac*(dWacc[sel] - Wl[sel]) + np.sqrt(var)*normals(b)
+            yi = yOld[sel] + drift[sel]*((ti - tOld[sel])/dt[b])[:, np.newaxis] + Gacc[sel]*Wi
+            if captureIndex is None:
+                y[b, r[sel]] = np.maximum(yi, 0.)
+            else:
+                hit = r[sel] == captureIndex[b, np.minimum(captured[b], K-1)]
+                y[b[hit], captured[b[hit]]] = np.maximum(yi[hit], 0.)
+                captured[b[hit]] += 1
+            Wl[sel] = Wi
+            tl[sel] = ti
+            rec[b] += 1
+        yc[acc] = yNew
+        t[acc] = tNew
+        haveF[acc] = False
+        dtNext[acc] = np.minimum(dt[acc]*fac, maxStep)
+
+        if deadIndex is not None:
+            dead = yNew[:, deadIndex].max(axis=1) < deadThreshold[acc]
+            for b in acc[dead]:
+                seeds[b] += 1000
+                tries[b] += 1
+                rngs[b] = rowGenerator(seeds[b], streams[b])
+                pool[b] = rngs[b].standard_normal((poolSize, d))
+                cursor[b] = 0
+                y[b] = 0.
+                if captureIndex is None:
+                    y[b, 0] = y0[b]
+                else:
+                    captured[b] = 0
+                yc[b] = y0[b]
+                t[b] = 0.
+                rec[b] = 1
+                pending[b] = []
+                depth[b] = 0
+                dtNext[b] = h
+                if steadyStateWindow is not None:
+                    nextCheck[b] = 2*halfWindow
+        if steadyStateWindow is not None:
+            for b in acc[rec[acc] - 1 >= nextCheck[acc]]:
+                k = rec[b] - 1
+                nextCheck[b] = k + halfWindow
+                steady, m, sd = isSteadyState(y[b, k-2*halfWindow+1:k+1], tol)
+                if steady:
+                    settled[b] = k*stride
+                    if steadyStateFill == 'pad':
+                        y[b, k+1:R] = np.maximum(m + sd*rngs[b].standard_normal((R-1-k, d)), 0.)
+                    else:
+                        y[b, k+1:R] = m
+                    rec[b] = R
+                    t[b] = tmax[b]
+
+        ## Wiener increments of the next step
+        acc = acc[t[acc] < tmax[acc] - eps]
+        fresh = acc[depth[acc] == 0]
+        for b in acc[depth[acc] > 0]:
+            dt[b], dW[b] = pending[b].pop()
+            depth[b] -= 1
+        if fresh.size > 0:
+            dt[fresh] = np.minimum(dtNext[fresh], tmax[fresh] - t[fresh])
+            dW[fresh] = np.sqrt(dt[fresh])[:, np.newaxis]*normals(fresh)
+        active = active[t[active] < tmax[active] - eps]
+    info = {'seeds': seeds, 'streams': streams, 'tries': tries, 'settled': settled, 'nfev': nfev}
+    if recordVelocity:
+        v = np.zeros_like(y)
+        missing = np.ones(y.shape[:2], dtype=bool)
+        if captureIndex is None:
+            missing[:, R] = False
+        fillVelocity(f, y, v, missing, pars)
+        info['velocity'] = v
+    return y, info
+
 def simulateModel(Model, y0, parameters,isStochastic, tspan,seed):
     """Call numerical integration functions, either odeint() from Scipy,
     or simulator.eulersde() defined in simulator.py. By default, stochastic simulations are
@@ -71,9 +71,11 @@ def getRegulatorsInRule(rule, species, inputs):
     rhs = rhs.replace(')',' ')
     tokens = rhs.split(' ')
 
-    allreg = set([t for t in tokens if (t in species or t in inputs)])
-    regulatorySpecies = set([t for t in tokens if t in species])
-    inputreg = set([t for t in tokens if t in inputs])
+    # Sorted, so that the model does not depend on the order of iteration
+    # over sets of strings, which changes between processes
+    allreg = sorted(set([t for t in tokens if (t in species or t in inputs)]))
+    regulatorySpecies = sorted(set([t for t in tokens if t in species]))
+    inputreg = sorted(set([t for t in tokens if t in inputs]))
 
     return((allreg, regulatorySpecies, inputreg))
 
@@ -100,19 +102,62 @@ def getSaneNval(size,lo=1.,hi=10.,mu=2.,sig=2.,identicalPars=False):
     """
     
     if identicalPars:
-        k = np.random.normal(mu, sig)
-        while k < lo or k > hi:
-            k = np.random.normal(mu, sig)
+        k = truncatedNormal(1, lo, hi, mu, sig).tolist()[0]
         K = [k for i in range(size)]
     else:
-        K = []
-        for _ in range(size):
-            k = np.random.normal(mu, sig)
-            while k < lo or k > hi:
-                k = np.random.normal(mu, sig)
-            K.append(k)
+        K = truncatedNormal(size, lo, hi, mu, sig).tolist()
     return K
 
+def truncatedNormal(size, lo, hi, mu, sig):
+    """
+    Vectorized rejection sampling from a normal distribution truncated to
+    [lo, hi]. Out of range samples are redrawn together until none are left.
+    The arguments may be arrays broadcastable to size.
+
+    :returns:
+        - K: Array of shape size of sampled values
+    """
+    mu, sig, lo, hi = [np.broadcast_to(np.asarray(a, dtype=float), size) for a in (mu, sig, lo, hi)]
+    K = np.random.normal(mu, sig)
+    redraw = (K < lo) | (K > hi)
+    while redraw.any():
+        K[redraw] = np.random.normal(mu[redraw], sig[redraw])
+        redraw = (K < lo) | (K > hi)
+    return K
+
+def sampleParameterMatrix(size, values, std, method='normal', lomult=0.9, himult=1.1):
+    """
+    Sample a set of parameter values for each of size cells, from normal
+    distributions with mean values and standard deviation std*values,
+    truncated to [lomult*values, himult*values] as in sample_pars.
+
+    :param size: Number of cells
+    :type size: int
+    :param values: Mean value of each parameter
+    :type values: list
+    :param std: Standard deviation, relative to the mean
+    :type std: float
+    :param method: 'normal' draws independent samples. 'lhs' draws a Latin hypercube sample, in which the values of each parameter are spread over size equally likely strata.
+    :type method: str
+    :returns:
+        - P: Array of shape (size, len(values)) of parameter values
+    """
+    values = np.array(values, dtype=float)
+    lo = lomult*values
+    hi = himult*values
+    sig = std*np.abs(values)
+    if method == 'normal':
+        return truncatedNormal((size, len(values)), lo, hi, values, sig)
+    # Latin hypercube: one uniform sample in each of the size strata of every
+    # parameter, shuffled independently, mapped through the inverse CDF of
+    # the truncated normal distribution
+    from scipy.stats import truncnorm
+    strata = np.argsort(np.random.random_sample((size, len(values))), axis=0)
+    U = (strata + np.random.random_sample((size, len(values))))/size
+    scale = np.where(sig > 0, sig, 1.)
+    P = truncnorm.ppf(U, (lo - values)/scale, (hi - values)/scale, loc=values, scale=scale)
+    return np.where(sig > 0, P, values)
+
 def minmaxnorm(X):
     """Scales the values in X
 
@@ -158,6 +203,74 @@ def normalizeExp(DF):
         
     return newDF
 
+def getOutputFolders(outPrefix):
+    """
+    Return the output folders of a job: outPrefix, followed by the folder of
+    each perturbation listed in outPrefix/Perturbations.csv, if present.
+
+    :param outPrefix: Output folder of the job
+    :type outPrefix: str
+    :returns:
+        - folders: List of output folders
+    """
+    folders = [str(outPrefix)]
+    perturbationsPath = Path(outPrefix, 'Perturbations.csv')
+    if perturbationsPath.is_file():
+        names = pd.read_csv(perturbationsPath, index_col=0).index
+        folders.extend([str(Path(outPrefix, str(name))) for name in names])
+    return folders
+
+def getAttractorCount(outPrefix):
+    """
+    Return the number of attractors in outPrefix/Attractors.csv, written
+    when a job with nClusters: auto is simulated, or 1 if it is missing.
+
+    :param outPrefix: Output folder of the job
+    :type outPrefix: str
+    :returns:
+        - count: Number of attractors
+    """
+    attractorsPath = Path(outPrefix, 'Attractors.csv')
+    if not attractorsPath.is_file():
+        print(attractorsPath, "not found, using nClusters=1")
+        return 1
+    return max(1, len(pd.read_csv(attractorsPath, index_col=0)))
+
+def pairedStatistics(controlDF, perturbedDF, exclude=None):
+    """
+    Compare the expression of each gene between control and perturbed cells
+    paired by cell id. The expression of a cell is its mean over the columns
+    'E[cellid]_[time point]' of the cell. With common random numbers, the
+    noise shared by the cells of a pair cancels in the paired difference.
+
+    :param controlDF: Expression of the control cells, rows are genes, columns are cells or time points
+    :type controlDF: pandas DataFrame
+    :param perturbedDF: Expression of the perturbed cells, with the same layout
+    :type perturbedDF: pandas DataFrame
+    :param exclude: Ids 'E[cellid]' of the pairs to leave out, or None
+    :type exclude: list
+    :returns:
+        - statsDF: DataFrame indexed by gene with the number of pairs, the mean expression of each group, the mean, standard deviation and standard error of the paired differences, and the ratio of the variance of the unpaired difference of the means to that of the paired one ('variance_reduction')
+    """
+    def cellMeans(DF):
+        return DF.T.groupby(lambda c: c.split('_')[0]).mean()
+    control = cellMeans(controlDF)
+    if exclude is not None:
+        control = control.drop(index=exclude, errors='ignore')
+    perturbed = cellMeans(perturbedDF).loc[control.index, control.columns]
+    difference = perturbed - control
+    n = len(difference)
+    with np.errstate(divide='ignore', invalid='ignore', under='ignore'):
+        statsDF = pd.DataFrame({'pairs': n,
+                                'control_mean': control.mean(),
+                                'perturbed_mean': perturbed.mean(),
+                                'mean_difference': difference.mean(),
+                                'difference_std': difference.std(),
+                                'difference_sem': difference.std()/np.sqrt(n),
+                                'variance_reduction': (control.var() + perturbed.var())/difference.var()})
+    statsDF.index.name = 'gene'
+    return statsDF
+
 def get_ss(P):
     """
     Return the final time point of the simulated time course
@@ -177,7 +290,7 @@ def generateInputFiles(resultDF, BoolDF, withoutRules,
     """
     Generates input files required from the Beeline pipeline
 
-    :param resultDF: The simulation output, rows are genes, columns are "cells" or timepoints
+    :param resultDF: The simulation output, rows are genes, columns are "cells" or timepoints. If the cells were simulated in chunks, resultDF only holds the columns to write to ExpressionData.csv, resultDF.attrs['numColumns'] is the number of columns of all the cells, and PseudoTime.csv has already been written. If there are too many columns to write them all, resultDF.attrs['columnPicks'], if given, holds the index of the column of each cell to write, among the columns of that cell.
     :type resultDF: pandas DataFrame
     :param outputfilenames: List of filenames generated containing individual time courses
     :type outputfilenames: list
@@ -194,7 +307,7 @@ def generateInputFiles(resultDF, BoolDF, withoutRules,
     print('1. refNetwork')
     refnet = []
     genes = set(BoolDF['Gene'].values)
-    genes = genes.difference(set(withoutRules))
+    genes = sorted(genes.difference(set(withoutRules)))
     inputs = withoutRules
 
     for g in genes:
@@ -236,21 +349,24 @@ def generateInputFiles(resultDF, BoolDF, withoutRules,
     refNetDF.to_csv(str(outPrefix) + '/refNetwork.csv',sep=',',index=False)
     
     # PseudoTime.csv
-    print('2. PseudoTime.csv')
     cellID = list(resultDF.columns)
     time = [float(c.split('_')[1].replace('-','.')) for c in cellID]
     experiment = [int(c.split('_')[0].split('E')[1]) for c in cellID]
-    pseudotime = minmaxnorm(time)
-    cellID = [c.replace('-','_') for c in cellID]
-
-    PseudoTimeDict = {'Cell ID':cellID, 'PseudoTime':pseudotime,
-                      'Time':time,'Experiment':experiment}
-    PseudoTimeDF = pd.DataFrame(PseudoTimeDict)
-    PseudoTimeDF.to_csv(str(outPrefix) + '/PseudoTime.csv',sep=',',index=False)
-    PseudoTimeDF.index = PseudoTimeDF['Cell ID']
+    numColumns = resultDF.attrs.get('numColumns')
+    if numColumns is None:
+        print('2. PseudoTime.csv')
+        pseudotime = minmaxnorm(time)
+        cellID = [c.replace('-','_') for c in cellID]
+
+        PseudoTimeDict = {'Cell ID':cellID, 'PseudoTime':pseudotime,
+                          'Time':time,'Experiment':experiment}
+        PseudoTimeDF = pd.DataFrame(PseudoTimeDict)
+        PseudoTimeDF.to_csv(str(outPrefix) + '/PseudoTime.csv',sep=',',index=False)
+        PseudoTimeDF.index = PseudoTimeDF['Cell ID']
+        numColumns = len(resultDF.columns)
     
     # ExpressionData.csv
-    if len(resultDF.columns) < 1e3:
+    if numColumns < 1e3:
         print('3. ExpressionData.csv')
         columns = list(resultDF.columns)
         columns = [c.replace('-','_') for c in columns]
@@ -261,12 +377,16 @@ def generateInputFiles(resultDF, BoolDF, withoutRules,
     else:
         print("Dataset too large."
               "\nSampling %d cells, one from each simulated trajectory." % numcells)
-        times = np.random.choice([i for i in range(1,tmax*100)],numcells)
-        expdf = pd.DataFrame(columns=['E' + str(i) + '_' + str(times[i])\
-                                      for i in range(numcells)],
-                             index=resultDF.index)
-        for c in expdf.columns:
-            expdf[c] = resultDF[c]
+        # Pick one of the columns of each trajectory, which are either
+        # every recorded time point, or the captured snapshots
+        columnsOf = {}
+        for c, e in zip(resultDF.columns, experiment):
+            columnsOf.setdefault(e, []).append(c)
+        picks = resultDF.attrs.get('columnPicks')
+        if picks is None:
+            expdf = resultDF[[np.random.choice(columnsOf[e]) for e in sorted(columnsOf.keys())]]
+        else:
+            expdf = resultDF[[columnsOf[e][picks[e]] for e in sorted(columnsOf.keys())]]
         expdf.to_csv(str(outPrefix) + '/ExpressionData.csv',sep=',')
 
 def sampleTimeSeries(num_timepoints, expnum,\
@@ -334,7 +454,7 @@ def sampleCellFromTraj(cellid,
             result = pd.DataFrame(index=pd.Index([varmapper[i] for i\
                                                   in speciesoi]))
             for si in speciesoi:
-                sampleDict[varmapper[si]] = {header[cellid]: P[ri][timepoint]}
+                sampleDict[varmapper[si]] = {header[cellid]: P[si][timepoint]}
 
     sampleDF = pd.DataFrame(sampleDict)
     return(sampleDF)
@@ -359,3 +479,45 @@ def checkValidModelDefinitionPath(path, name):
         return False
     return True
     
+
+def writeJacobianData(path, jacDF, genes):
+    """
+    Write the Jacobian entries of a sample of cells in the sparse format,
+    a compressed numpy archive containing the nonzero regulator->target
+    entries only.
+
+    :param path: Path of the .npz file
+    :type path: str
+    :param jacDF: DataFrame with rows labelled by edge, 'target_regulator', and a column per cell
+    :type jacDF: pandas DataFrame
+    :param genes: List of genes, used to expand the entries to all pairs of genes on reading
+    :type genes: list
+    """
+    np.savez_compressed(path,
+                        values=jacDF.values,
+                        edges=np.array(jacDF.index, dtype=str),
+                        cells=np.array(jacDF.columns, dtype=str),
+                        genes=np.array(genes, dtype=str))
+
+def readJacobianData(path, dense=False):
+    """
+    Read the Jacobian entries of a sample of cells written by genSamples(),
+    either in the sparse (.npz) or in the dense (.csv) format.
+
+    :param path: Path to JacobianData.npz or JacobianData.csv
+    :type path: str
+    :param dense: If True, the entries are expanded to all pairs of genes, filling in 0 for pairs without an edge
+    :type dense: bool
+    :returns:
+        - jacDF: DataFrame with rows labelled 'target_regulator' and a column per cell
+    """
+    if str(path).endswith('.csv'):
+        return pd.read_csv(path, index_col=0)
+    with np.load(path) as data:
+        jacDF = pd.DataFrame(data['values'],
+                             index=pd.Index(data['edges']),
+                             columns=pd.Index(data['cells']))
+        genes = list(data['genes'])
+    if dense:
+        jacDF = jacDF.reindex([x + '_' + y for x in genes for y in genes], fill_value=0.)
+    return jacDF
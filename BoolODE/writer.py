@@ -0,0 +1,126 @@
+import time
+import queue
+import threading
+
+# Statistics kept by each writer, see AsyncWriter.values()
+STATS = ['files', 'bytes', 'write_time', 'wait_time', 'stalls', 'max_queued']
+
+def combineStats(a, b):
+    """
+    Combine two lists of writer statistics, in the order of STATS.
+    """
+    return [max(x, y) if name == 'max_queued' else x + y\
+            for name, x, y in zip(STATS, a, b)]
+
+class AsyncWriter:
+    """Writes DataFrames to CSV files on a background thread, so that the
+    caller can go on computing while text is formatted and written. Files
+    are passed through a queue holding at most queueSize of them. When the
+    queue is full, write() blocks until there is room: the time spent
+    waiting, and the number of times this happened, measure the
+    backpressure from the disk.
+
+    The writer thread takes every file queued since its last pass, up to
+    batchSize, formats each as a single string and writes it with one call.
+
+    :param queueSize: Largest number of files waiting to be written
+    :type queueSize: int
+    :param batchSize: Largest number of files written per pass
+    :type batchSize: int
+    """
+    def __init__(self, queueSize=64, batchSize=16):
+        self.queue = queue.Queue(maxsize=max(1, queueSize))
+        self.queueSize = max(1, queueSize)
+        self.batchSize = max(1, batchSize)
+        self.stats = {name: 0 for name in STATS}
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, path, df, **kwargs):
+        """
+        Queue df to be written to path with df.to_csv(path, **kwargs).
+        The DataFrame must not be modified afterwards.
+        """
+        self.check()
+        try:
+            self.queue.put_nowait((path, df, kwargs))
+        except queue.Full:
+            start = time.perf_counter()
+            self.queue.put((path, df, kwargs))
+            self.stats['wait_time'] += time.perf_counter() - start
+            self.stats['stalls'] += 1
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            self.stats['max_queued'] = max(self.stats['max_queued'], self.queue.qsize() + 1)
+            while len(items) < self.batchSize and items[-1] is not None:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in items:
+                if item is not None and self.error is None:
+                    path, df, kwargs = item
+                    start = time.perf_counter()
+                    try:
+                        text = df.to_csv(**kwargs)
+                        with open(path, 'w') as f:
+                            f.write(text)
+                        self.stats['files'] += 1
+                        self.stats['bytes'] += len(text)
+                    except Exception as e:
+                        # Raised in the caller. The remaining files are
+                        # discarded, so that write() cannot block forever.
+                        self.error = e
+                    self.stats['write_time'] += time.perf_counter() - start
+                self.queue.task_done()
+            if items[-1] is None:
+                return
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def flush(self):
+        """
+        Wait until every queued file has been written.
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """
+        Write the queued files and stop the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+    def values(self):
+        """
+        :returns:
+            - values: The statistics of the writer, in the order of STATS
+        """
+        return [self.stats[name] for name in STATS]
+
+    def addStats(self, values):
+        """
+        Add the statistics of another writer, in the order of STATS, such
+        as those of the writers of worker processes.
+        """
+        for name, value in zip(STATS, combineStats(self.values(), values)):
+            self.stats[name] = value
+
+    def report(self):
+        """
+        Print the amount written, and the backpressure on the writers.
+        """
+        s = self.stats
+        print('Wrote %d files (%.1f MB) in the background in %.2f s' %\
+              (s['files'], s['bytes']/1e6, s['write_time']))
+        print('Simulations waited %.2f s on a full write queue, %d times (at most %d files queued of %d)' %\
+              (s['wait_time'], s['stalls'], s['max_queued'], self.queueSize))
+        if s['stalls'] > 0:
+            print('Writing is slower than simulating: a larger write_queue_size absorbs bursts of writes, but not a slow disk')
@@ -13,6 +13,9 @@ def get_parser():
     parser.add_argument('--config', default='config.yaml',
         help='Path to config file')
 
+    parser.add_argument('--plan', action='store_true',
+        help='Estimate the runtime, memory and disk use of each job, without running them')
+
     return parser
 
 def parse_arguments():
@@ -30,7 +33,10 @@ def main():
     config_file = opts.config
     with open(config_file, 'r') as conf:
         boolodejobs = bo.ConfigParser.parse(conf)
-    
+
+    if opts.plan:
+        boolodejobs.plan_jobs()
+        return
     boolodejobs.execute_jobs()
     print('Jobs finished')
 
@@ -0,0 +1,124 @@
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from optparse import OptionParser
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Each stage is timed in a fresh interpreter, so that nothing is cached
+STAGES = {'BoolODE': 'import BoolODE',
+          'run_experiment': 'import BoolODE.run_experiment',
+          'post_processing': 'import BoolODE.post_processing',
+          'attractors': 'import BoolODE.attractors'}
+# Modules that should only be loaded once a step actually needs them
+HEAVY = ['sklearn', 'matplotlib', 'scipy.integrate', 'scipy.sparse']
+# Changes smaller than these are treated as measurement noise
+NOISE_FLOOR = {'time_s': 0.05}
+
+def parseArgs(args):
+    parser = OptionParser()
+
+    parser.add_option('', '--stages', type='str', default=','.join(STAGES) + ',cli',
+                      help='Comma separated list of stages to benchmark. Choose from '
+                      + ', '.join(STAGES) + ', cli (python boolode.py --help)')
+
+    parser.add_option('-r', '--runs', type='int', default=5,
+                      help='Number of fresh interpreters per stage. The median time is reported.')
+
+    parser.add_option('-o', '--out', type='str', default='bench_imports.csv',
+                      help='Write benchmark results to this file')
+
+    parser.add_option('-b', '--baseline', type='str', default=None,
+                      help='Results file from a previous run. Exits with status 1 on regression.')
+
+    parser.add_option('', '--tolerance', type='float', default=0.25,
+                      help='Allowed relative increase in import time over the baseline')
+
+    (opts, args) = parser.parse_args(args)
+
+    return opts, args
+
+def timeImport(statement):
+    """
+    Time `statement` in a fresh interpreter.
+
+    :returns:
+        - elapsed: Import time in seconds
+        - heavy: List of the HEAVY modules that were loaded as a side effect
+    """
+    code = ('import sys, time, json\n'
+            'start = time.perf_counter()\n'
+            + statement + '\n'
+            'elapsed = time.perf_counter() - start\n'
+            'print(json.dumps([elapsed, [m for m in %r if m in sys.modules]]))\n' % HEAVY)
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT,
+                         check=True, capture_output=True, text=True).stdout
+    elapsed, heavy = json.loads(out.strip().split('\n')[-1])
+    return elapsed, heavy
+
+def timeCLI():
+    """
+    Time `python boolode.py --help`, including interpreter startup.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'boolode.py', '--help'], cwd=ROOT,
+                   check=True, capture_output=True)
+    return time.perf_counter() - start, []
+
+def compareToBaseline(resultDF, baselinePath, tolerance):
+    """
+    Report stages that import more slowly than in the baseline
+    results by more than `tolerance`.
+
+    :returns:
+        - regressions: list of (stage, metric, old, new)
+    """
+    baseDF = pd.read_csv(baselinePath).set_index('stage')
+    regressions = []
+    for _, row in resultDF.iterrows():
+        if row['stage'] not in baseDF.index:
+            continue
+        for metric, floor in NOISE_FLOOR.items():
+            old = baseDF.loc[row['stage'], metric]
+            if row[metric] - old > max(tolerance*old, floor):
+                regressions.append((row['stage'], metric, old, row[metric]))
+    return regressions
+
+def main(args):
+    opts, args = parseArgs(args)
+    stages = opts.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES and stage != 'cli':
+            print(stage, 'is not a valid stage. Choose from', ', '.join(STAGES) + ', cli')
+            sys.exit(1)
+    results = []
+    for stage in stages:
+        print('Benchmarking', stage)
+        times = []
+        for _ in range(opts.runs):
+            if stage == 'cli':
+                elapsed, heavy = timeCLI()
+            else:
+                elapsed, heavy = timeImport(STAGES[stage])
+            times.append(elapsed)
+        res = {'stage': stage,
+               'time_s': np.median(times),
+               'heavy_modules': ' '.join(heavy)}
+        print('\t%.3f s, loads: %s' % (res['time_s'], res['heavy_modules'] or 'none'))
+        results.append(res)
+    resultDF = pd.DataFrame(results, columns=['stage', 'time_s', 'heavy_modules'])
+    print(resultDF.to_string(index=False))
+    resultDF.to_csv(opts.out, index=False)
+    if opts.baseline is not None:
+        regressions = compareToBaseline(resultDF, opts.baseline, opts.tolerance)
+        for stage, metric, old, new in regressions:
+            print('REGRESSION: %s, %s %.3f -> %.3f' % (stage, metric, old, new))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import resource
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from optparse import OptionParser
+
+# Make the BoolODE package importable when run as scripts/benchmarkPostProcessing.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+STAGES = ['genSamples', 'genDropouts', 'doDimRed', 'generateInputFiles']
+# Changes smaller than these are treated as measurement noise
+NOISE_FLOOR = {'time_s': 0.05, 'peak_mb': 5.}
+
+def parseArgs(args):
+    parser = OptionParser()
+
+    parser.add_option('-s', '--sizes', type='str', default='1000,10000,100000,1000000',
+                      help='Comma separated list of ensemble sizes (number of cells) to benchmark')
+
+    parser.add_option('', '--stages', type='str', default=','.join(STAGES),
+                      help='Comma separated list of stages to benchmark. Choose from ' + ', '.join(STAGES))
+
+    parser.add_option('-t', '--timepoints', type='int', default=100,
+                      help='Number of timepoints in each synthetic trajectory. '
+                      'An ensemble of N cells is made of N/timepoints trajectories.')
+
+    parser.add_option('-m', '--model', type='str', default='data/dyn-bifurcating.txt',
+                      help='Boolean model used to generate model.py and refNetwork.csv for the fixtures')
+
+    parser.add_option('-f', '--fixtures', type='str', default='bench-fixtures',
+                      help='Folder in which generated fixtures are cached')
+
+    parser.add_option('-p', '--perplexity', type='float', default=30.,
+                      help='tSNE perplexity used by doDimRed')
+
+    parser.add_option('-o', '--out', type='str', default='bench_output.csv',
+                      help='Write benchmark results to this file')
+
+    parser.add_option('-b', '--baseline', type='str', default=None,
+                      help='Results file from a previous run. Exits with status 1 on regression.')
+
+    parser.add_option('', '--tolerance', type='float', default=0.25,
+                      help='Allowed relative increase in time or memory over the baseline')
+
+    parser.add_option('', '--seed', type='int', default=0,
+                      help='Seed for fixture generation and for the benchmarked stages')
+
+    (opts, args) = parser.parse_args(args)
+
+    return opts, args
+
+def syntheticTrajectories(numTraj, timepoints, numSpecies, seed):
+    """
+    Generate smooth, noisy, non-negative time courses resembling
+    BoolODE simulations. Each species switches ON or OFF at a random time.
+
+    :returns:
+        - P: array of shape (numTraj, numSpecies, timepoints)
+    """
+    rng = np.random.RandomState(seed)
+    t = np.linspace(0, 1, timepoints)
+    switch = rng.uniform(0.1, 0.9, (numTraj, numSpecies, 1))
+    on = rng.randint(0, 2, (numTraj, numSpecies, 1))
+    ramp = 1./(1. + np.exp(-20.*(t - switch)))
+    level = np.where(on == 1, ramp, 1. - ramp)
+    P = 2.*level + 0.05*rng.normal(size=(numTraj, numSpecies, timepoints))
+    return np.abs(P)
+
+def loadModel(modelPath, outPrefix):
+    from BoolODE.model_generator import GenerateModel
+    settings = {'modelpath': Path(modelPath),
+                'outprefix': Path(outPrefix),
+                'add_dummy': False,
+                'max_parents': 1,
+                'sample_pars': False,
+                'sample_std': 0.1,
+                'identical_pars': False,
+                'modeltype': 'hill'}
+    return GenerateModel(settings, pd.DataFrame(), pd.DataFrame(), pd.DataFrame())
+
+def makeFixture(size, opts):
+    """
+    Write a synthetic simulation folder of `size` cells to the fixture
+    folder, laid out like the output of a BoolODE job. Fixtures are
+    reused if they have already been generated with the same settings.
+    """
+    fixture = Path(opts.fixtures, 'cells-' + str(size))
+    spec = {'size': size, 'timepoints': opts.timepoints,
+            'model': opts.model, 'seed': opts.seed}
+    specfile = fixture / 'fixture.json'
+    if specfile.is_file():
+        with open(specfile, 'r') as f:
+            if json.load(f) == spec:
+                return fixture
+    print('Generating fixture with', size, 'cells in', fixture)
+    os.makedirs(fixture / 'simulations', exist_ok=True)
+    os.makedirs(fixture / 'dataset', exist_ok=True)
+    mg = loadModel(opts.model, fixture)
+    parNames = sorted(mg.ModelSpec['pars'].keys())
+    pd.DataFrame([mg.ModelSpec['pars'][k] for k in parNames]).to_csv(fixture / 'simulations/param.csv')
+    species = [mg.varmapper[i] for i in range(len(mg.varmapper))]
+    gid = [i for i, n in enumerate(species) if 'x_' in n]
+    numTraj = max(1, size // opts.timepoints)
+    tps = [i for i in range(1, opts.timepoints + 1)]
+    for start in range(0, numTraj, 1000):
+        P = syntheticTrajectories(min(1000, numTraj - start), opts.timepoints,
+                                  len(species), opts.seed + start)
+        for i, traj in enumerate(P):
+            cellid = start + i
+            columns = ['E' + str(cellid) + '_' + str(t) for t in tps]
+            pd.DataFrame(traj[gid], index=pd.Index(mg.genelist),
+                         columns=columns).to_csv(fixture / ('simulations/E' + str(cellid) + '.csv'))
+            pd.DataFrame(traj, index=pd.Index(species),
+                         columns=columns).to_csv(fixture / ('simulations/Efull' + str(cellid) + '.csv'))
+    # A single dataset of `size` cells for genDropouts and doDimRed
+    X = syntheticTrajectories(1, size, len(mg.genelist), opts.seed)[0]
+    cells = ['E' + str(c) + '_' + str(1 + c % opts.timepoints) for c in range(size)]
+    pd.DataFrame(X, index=pd.Index(mg.genelist), columns=cells).to_csv(fixture / 'dataset/ExpressionData.csv')
+    pd.DataFrame({'PseudoTime': np.linspace(0, 1, size)},
+                 index=pd.Index(cells)).to_csv(fixture / 'dataset/PseudoTime.csv')
+    refnet = [{'Gene1': g, 'Gene2': t, 'Type': '+'} for g, t in zip(mg.genelist, mg.genelist[1:])]
+    pd.DataFrame(refnet).to_csv(fixture / 'refNetwork.csv', index=False)
+    pd.DataFrame(refnet).to_csv(fixture / 'dataset/refNetwork.csv', index=False)
+    with open(specfile, 'w') as f:
+        json.dump(spec, f)
+    return fixture
+
+def readIOCounters():
+    """
+    Returns the number of bytes read by this process, or NaN if
+    /proc/self/io is not available.
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar'])
+    except (OSError, KeyError, ValueError):
+        return np.nan
+
+def currentRSS():
+    """
+    Current resident set size in MB.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1e6
+    except (OSError, ValueError):
+        return np.nan
+
+def peakRSS():
+    """
+    Peak resident set size of this process in MB.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on macOS, KiB on Linux
+        return maxrss/1e6
+    return maxrss*1024/1e6
+
+def runStage(stage, fixture, size, opts, queue):
+    """
+    Run a single stage on a fixture. This is executed in a fresh
+    process so that peak memory is measured for this stage alone.
+    """
+    os.environ['MPLBACKEND'] = 'Agg'
+    from BoolODE import post_processing as po
+    from BoolODE import utils
+    np.random.seed(opts.seed)
+    numTraj = max(1, size // opts.timepoints)
+    dataset = fixture / 'dataset'
+    if stage == 'genSamples':
+        settings = {'num_cells': numTraj,
+                    'sample_size': numTraj,
+                    'outPrefix': str(fixture),
+                    'nDatasets': 1,
+                    'name': 'bench',
+                    'nClusters': 1,
+                    'jacobian_format': 'sparse'}
+        call = lambda: po.genSamples(settings)
+    elif stage == 'genDropouts':
+        settings = {'outPrefix': str(fixture / 'dropouts'),
+                    'expr': dataset / 'ExpressionData.csv',
+                    'pseudo': dataset / 'PseudoTime.csv',
+                    'refNet': dataset / 'refNetwork.csv',
+                    'dropout': True,
+                    'sample_size': size,
+                    'num_cells': size,
+                    'drop_cutoff': 0.5,
+                    'drop_prob': 0.5}
+        call = lambda: po.genDropouts(settings)
+    elif stage == 'doDimRed':
+        settings = {'expr': dataset / 'ExpressionData.csv',
+                    'pseudo': dataset / 'PseudoTime.csv',
+                    'perplexity': min(opts.perplexity, (size - 1)/3.),
+                    'default': False}
+        call = lambda: po.doDimRed(settings)
+    elif stage == 'generateInputFiles':
+        os.makedirs(fixture / 'inputfiles', exist_ok=True)
+        mg = loadModel(opts.model, fixture / 'inputfiles')
+        columns = ['E' + str(c//opts.timepoints) + '_' + str(1 + c % opts.timepoints)
+                   for c in range(numTraj*opts.timepoints)]
+        X = syntheticTrajectories(1, len(columns), len(mg.genelist), opts.seed)[0]
+        resultDF = pd.DataFrame(X, index=pd.Index(mg.genelist), columns=columns)
+        tmax = max(1, opts.timepoints // 100)
+        call = lambda: utils.generateInputFiles(resultDF, mg.df, mg.withoutRules,
+                                                pd.DataFrame(), tmax, numTraj,
+                                                outPrefix=fixture / 'inputfiles')
+    rssBefore = currentRSS()
+    readBefore = readIOCounters()
+    start = time.perf_counter()
+    call()
+    elapsed = time.perf_counter() - start
+    queue.put({'size': size,
+               'stage': stage,
+               'time_s': elapsed,
+               # Growth of the peak resident set size over the RSS before the stage
+               'peak_mb': max(0., peakRSS() - rssBefore),
+               'read_mb': (readIOCounters() - readBefore)/1e6})
+
+def compareToBaseline(resultDF, baselinePath, tolerance):
+    """
+    Report stages that are slower or use more memory than in the
+    baseline results by more than `tolerance`.
+
+    :returns:
+        - regressions: list of (size, stage, metric, old, new)
+    """
+    baseDF = pd.read_csv(baselinePath).set_index(['size', 'stage'])
+    regressions = []
+    for _, row in resultDF.iterrows():
+        key = (row['size'], row['stage'])
+        if key not in baseDF.index:
+            continue
+        for metric, floor in NOISE_FLOOR.items():
+            old = baseDF.loc[key, metric]
+            if row[metric] - old > max(tolerance*old, floor):
+                regressions.append((row['size'], row['stage'], metric, old, row[metric]))
+    return regressions
+
+def main(args):
+    opts, args = parseArgs(args)
+    sizes = [int(s) for s in opts.sizes.split(',')]
+    stages = opts.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            print(stage, 'is not a valid stage. Choose from', ', '.join(STAGES))
+            sys.exit(1)
+    ctx = mp.get_context('spawn')
+    results = []
+    for size in sizes:
+        fixture = makeFixture(size, opts)
+        for stage in stages:
+            print('Benchmarking', stage, 'on', size, 'cells')
+            queue = ctx.Queue()
+            proc = ctx.Process(target=runStage, args=(stage, fixture, size, opts, queue))
+            proc.start()
+            proc.join()
+            if queue.empty():
+                print('\t', stage, 'failed, see the traceback above')
+                continue
+            res = queue.get()
+            print('\t%.2f s, %.1f MB peak, %.1f MB read' % (res['time_s'], res['peak_mb'], res['read_mb']))
+            results.append(res)
+    resultDF = pd.DataFrame(results, columns=['size', 'stage', 'time_s', 'peak_mb', 'read_mb'])
+    print(resultDF.to_string(index=False))
+    resultDF.to_csv(opts.out, index=False)
+    if opts.baseline is not None:
+        regressions = compareToBaseline(resultDF, opts.baseline, opts.tolerance)
+        for size, stage, metric, old, new in regressions:
+            print('REGRESSION: %s on %d cells, %s %.2f -> %.2f' % (stage, size, metric, old, new))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv)
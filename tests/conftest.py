@@ -0,0 +1,58 @@
+import os
+import sys
+from pathlib import Path
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+@pytest.fixture
+def runJob():
+    """
+    Returns a function which runs a single simulation job on a model in
+    modelDir, by default data/, and returns its output folder. The job
+    settings are those of the config file, with a small dyn-bifurcating job
+    as the default.
+    """
+    import BoolODE as bo
+    def run(outputDir, modelDir=ROOT / 'data', **job):
+        jobSettings = {'name': 'job',
+                       'model_definition': 'dyn-bifurcating.txt',
+                       'model_initial_conditions': 'dyn-bifurcating_ics.txt',
+                       'simulation_time': 2,
+                       'num_cells': 20,
+                       'batch_size': 5}
+        jobSettings.update(job)
+        boolodejobs = bo.BoolODE(bo.JobSettings([jobSettings]),
+                                 bo.GlobalSettings(str(modelDir), str(outputDir),
+                                                   True, False, 'hill'),
+                                 bo.PostProcSettings(None, None, None, None, None))
+        boolodejobs.execute_jobs()
+        return Path(outputDir, jobSettings['name'])
+    return run
+
+@pytest.fixture
+def loadModel(tmp_path):
+    """
+    Returns a function which generates the ODE model of a model in data/,
+    with the default job settings and the given modeltype, and returns the
+    GenerateModel object and the loaded model.py module.
+    """
+    import BoolODE as bo
+    from importlib.machinery import SourceFileLoader
+    from BoolODE import utils
+    from BoolODE.model_generator import GenerateModel
+    def load(modelDefinition='dyn-bifurcating.txt', modeltype='hill'):
+        boolodejobs = bo.BoolODE(bo.JobSettings([{'name': modeltype, 'model_definition': modelDefinition}]),
+                                 bo.GlobalSettings(str(ROOT / 'data'), str(tmp_path), True, False, modeltype),
+                                 bo.PostProcSettings(None, None, None, None, None))
+        settings = boolodejobs.jobs[0]
+        os.makedirs(settings['outprefix'], exist_ok=True)
+        mg = GenerateModel(settings,
+                           utils.checkValidInputPath(settings['parameter_inputs_path']),
+                           utils.checkValidInputPath(settings['parameter_set']),
+                           utils.checkValidInputPath(settings['interaction_strengths']))
+        model = SourceFileLoader('model', mg.path_to_ode_model.as_posix()).load_module()
+        return mg, model
+    return load
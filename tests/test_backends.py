@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+@pytest.mark.parametrize('backend', ['shared', 'thread'])
+def test_backends_match_files(tmp_path, runJob, backend):
+    # stop_on_convergence reads the final states back from the shared array
+    # after each wave
+    job = dict(num_cells=20, stop_on_convergence=True, min_cells=10,
+               convergence_step=5, convergence_tol=1.)
+    files = runJob(tmp_path / 'files', **job)
+    other = runJob(tmp_path / backend, parallel_backend=backend, **job)
+    for name in ['ExpressionData.csv', 'PseudoTime.csv', 'simulations/Convergence.csv']:
+        expected = pd.read_csv(files / name, index_col=0)
+        found = pd.read_csv(other / name, index_col=0)
+        # The files backend reads the trajectories back from CSV, which
+        # need not round trip to the last digit
+        pd.testing.assert_frame_equal(expected, found, check_exact=False, rtol=1e-12)
@@ -0,0 +1,13 @@
+import os
+import tempfile
+
+def test_pilot_burnin_cache(tmp_path, runJob, monkeypatch):
+    # The pilot of simulation_time: auto caches its burn-in pool with those
+    # of the jobs, not in its temporary folder
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / 'tmp'))
+    os.makedirs(tmp_path / 'tmp')
+    runJob(tmp_path / 'out', simulation_time='auto', auto_time_max=5,
+           auto_time_pilot=5, num_cells=10, burn_in=True, burn_in_pool_size=5)
+    assert os.listdir(tmp_path / 'tmp') == []
+    # The job reuses the pool of its pilot
+    assert len(os.listdir(tmp_path / 'out' / 'burnin-cache')) == 1
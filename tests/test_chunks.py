@@ -0,0 +1,11 @@
+import filecmp
+
+def test_chunked_outputs(tmp_path, runJob):
+    job = dict(simulation_time=5, num_cells=30, nClusters=2)
+    full = runJob(tmp_path / 'full', **job)
+    chunked = runJob(tmp_path / 'chunked', max_memory=0.001, **job)
+    for name in ['PseudoTime.csv', 'ExpressionData.csv', 'ClusterIds.csv']:
+        assert filecmp.cmp(full / name, chunked / name, shallow=False)
+    for cellid in range(30):
+        assert filecmp.cmp(full / 'simulations' / ('E%d.csv' % cellid),
+                           chunked / 'simulations' / ('E%d.csv' % cellid), shallow=False)
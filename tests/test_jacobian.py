@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from test_simulator import modelState
+
+@pytest.mark.parametrize('modeltype', ['hill', 'heaviside'])
+def test_jacobian_matches_finite_differences(loadModel, modeltype):
+    mg, model = loadModel(modeltype=modeltype)
+    pars, y0 = modelState(mg)
+    rng = np.random.default_rng(0)
+    eps = 1e-6
+    nonzero = 0
+    for _ in range(5):
+        # States around the thresholds of the regulation functions, where
+        # the Jacobian entries are far from 0
+        Y = rng.uniform(5., 15., size=len(y0))
+        J = model.Jacobian(Y, 0., pars)
+        assert len(J) == len(model.JacobianIndex) > 0
+        for (target, regulator), entry in zip(model.JacobianIndex, J):
+            # Central difference of the target derivative along the regulator
+            dY = np.zeros(len(Y))
+            dY[regulator] = eps
+            fd = (model.Model(Y + dY, 0., pars)[target]
+                  - model.Model(Y - dY, 0., pars)[target])/(2*eps)
+            assert entry == pytest.approx(fd, rel=1e-5, abs=1e-7)
+        nonzero += (np.abs(J) > 1e-2).sum()
+    assert nonzero > 0
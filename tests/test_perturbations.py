@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+def writeToggle(modelDir):
+    # g1 and g2 sustain each other from these initial values, or collapse,
+    # in which case the cell is restarted. g3 regulates neither.
+    modelDir.mkdir()
+    (modelDir / 'toggle.txt').write_text('Gene\tRule\ng1\tg1 and g2\ng2\tg1 and g2\ng3\tg1\n')
+    (modelDir / 'toggle_ics.txt').write_text("Genes\tValues\n['g1','g2']\t[1.2,1.2]\n")
+
+def test_common_random_numbers(tmp_path, runJob):
+    writeToggle(tmp_path / 'data')
+    out = runJob(tmp_path / 'out', modelDir=tmp_path / 'data',
+                 model_definition='toggle.txt', model_initial_conditions='toggle_ics.txt',
+                 simulation_time=1, num_cells=20, perturbations=[{'knockout': ['g3']}],
+                 common_random_numbers=True)
+    control = pd.read_csv(out / 'simulations' / 'CellSummary.csv', index_col=0)
+    perturbed = pd.read_csv(out / 'g3-KO' / 'simulations' / 'CellSummary.csv', index_col=0)
+    restarted = control['tries'] > 1
+    assert restarted.any()
+    # Each pair shares the seed accepted for the unperturbed cell
+    assert (perturbed['seed'] == control['seed']).all()
+    assert (perturbed['tries'] == 1).all()
+    for cellid in range(20):
+        a = pd.read_csv(out / 'simulations' / ('E%d.csv' % cellid), index_col=0)
+        b = pd.read_csv(out / 'g3-KO' / 'simulations' / ('E%d.csv' % cellid), index_col=0)
+        assert np.allclose(a.loc[['g1', 'g2']], b.loc[['g1', 'g2']], rtol=0., atol=1e-12)
+    statsDF = pd.read_csv(out / 'PairedStatistics.csv')
+    assert (statsDF['pairs'] == 20 - restarted.sum()).all()
+
+def test_perturbation_streams(tmp_path, runJob):
+    out = runJob(tmp_path / 'out', simulation_time=1, num_cells=10,
+                 perturbations=[{'knockout': ['g2']}, {'knockout': ['g3']}])
+    streams = [pd.read_csv(out / prefix / 'simulations' / 'CellSummary.csv')['stream'].unique().tolist()\
+               for prefix in ['', 'g2-KO', 'g3-KO']]
+    assert streams == [[0], [1], [2]]
@@ -0,0 +1,39 @@
+import os
+import sys
+import filecmp
+import subprocess
+import BoolODE as bo
+from conftest import ROOT
+
+def test_identical_runs(tmp_path, runJob):
+    # 20 cells of 200 time points: ExpressionData.csv holds a random
+    # column of each cell
+    first = runJob(tmp_path / 'first')
+    second = runJob(tmp_path / 'second')
+    assert filecmp.cmp(first / 'ExpressionData.csv', second / 'ExpressionData.csv', shallow=False)
+    assert filecmp.cmp(first / 'PseudoTime.csv', second / 'PseudoTime.csv', shallow=False)
+
+def test_identical_processes(tmp_path):
+    # Sets of strings are iterated in a different order in each process,
+    # unless PYTHONHASHSEED is fixed
+    script = ("import sys; sys.path.insert(0, sys.argv[1]); import BoolODE as bo; "
+              "job = {'name': 'job', 'model_definition': 'dyn-bifurcating.txt', "
+              "'model_initial_conditions': 'dyn-bifurcating_ics.txt', "
+              "'simulation_time': 2, 'num_cells': 10}; "
+              "bo.BoolODE(bo.JobSettings([job]), bo.GlobalSettings(sys.argv[1] + '/data', sys.argv[2], True, False, 'hill'), "
+              "bo.PostProcSettings(None, None, None, None, None)).execute_jobs()")
+    for seed in ['1', '2']:
+        subprocess.run([sys.executable, '-c', script, str(ROOT), str(tmp_path / seed)], check=True,
+                       env=dict(os.environ, PYTHONHASHSEED=seed), capture_output=True)
+    for name in ['model.py', 'parameters.txt', 'ExpressionData.csv']:
+        assert filecmp.cmp(tmp_path / '1' / 'job' / name, tmp_path / '2' / 'job' / name, shallow=False)
+
+def test_jobs_sample_different_parameters(tmp_path):
+    jobs = [{'name': name, 'model_definition': 'dyn-bifurcating.txt',
+             'model_initial_conditions': 'dyn-bifurcating_ics.txt',
+             'simulation_time': 1, 'num_cells': 5, 'sample_pars': True} for name in ['first', 'second']]
+    bo.BoolODE(bo.JobSettings(jobs),
+               bo.GlobalSettings(str(ROOT / 'data'), str(tmp_path), True, False, 'hill'),
+               bo.PostProcSettings(None, None, None, None, None)).execute_jobs()
+    assert not filecmp.cmp(tmp_path / 'first' / 'parameters.txt',
+                           tmp_path / 'second' / 'parameters.txt', shallow=False)
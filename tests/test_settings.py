@@ -0,0 +1,15 @@
+import pytest
+
+@pytest.mark.parametrize('job', [dict(adaptive_allocation=True, nClusters=1),
+                                 dict(adaptive_allocation=True, nClusters=2, snapshot=True),
+                                 dict(stop_on_convergence=True, perturbations=[{'knockout': ['g2']}]),
+                                 dict(max_memory=1, sample_cells=True),
+                                 dict(snapshot=True, sample_cells=True),
+                                 dict(simulation_time='auto', auto_time_max=2),
+                                 dict(name='burnin-cache')])
+def test_incompatible_settings(tmp_path, runJob, capsys, job):
+    # Rejected before anything is simulated
+    with pytest.raises(SystemExit):
+        runJob(tmp_path, **job)
+    assert 'Error in definition of job' in capsys.readouterr().out
+    assert not (tmp_path / 'job' / 'simulations').exists()
@@ -0,0 +1,63 @@
+import numpy as np
+from BoolODE import simulator
+
+def modelState(mg):
+    pars = [mg.ModelSpec['pars'][k] for k in sorted(mg.ModelSpec['pars'].keys())]
+    y0 = [float(mg.ModelSpec['ics'][mg.varmapper[i]]) for i in range(len(mg.varmapper))]
+    return pars, y0
+
+def test_batch_matches_eulersde(loadModel):
+    mg, model = loadModel()
+    pars, y0 = modelState(mg)
+    # More steps than the chunks of 1024 Wiener increments drawn at a time
+    tspan = np.linspace(0, 12, 1200)
+    seeds = [1000, 1001, 1002, 1003]
+    with np.errstate(under='ignore'):
+        Y, info = simulator.eulersdeBatch(model.Model, simulator.noise, [y0]*len(seeds),
+                                          tspan, pars, seeds)
+        for b, seed in enumerate(seeds):
+            P = simulator.eulersde(model.Model, simulator.noise, y0, tspan, pars, seed=seed)
+            assert np.allclose(Y[b, :len(tspan)], P[:len(tspan)], rtol=0., atol=1e-12)
+    assert (info['tries'] == 1).all()
+
+def test_adaptive_batch_independent(loadModel):
+    mg, model = loadModel()
+    pars, y0 = modelState(mg)
+    tspan = np.linspace(0, 5, 500)
+    seeds = [1000, 1001, 1002]
+    with np.errstate(under='ignore'):
+        Y, _ = simulator.adaptivesdeBatch(model.Model, simulator.noise, [y0]*len(seeds),
+                                             tspan, pars, seeds)
+        for b, seed in enumerate(seeds):
+            # Each row chooses its own steps, so that it does not depend on
+            # the other rows of the batch, up to rounding errors which the
+            # step size control amplifies to about 1e-12
+            P, _ = simulator.adaptivesdeBatch(model.Model, simulator.noise, [y0],
+                                              tspan, pars, [seed])
+            assert np.allclose(Y[b], P[0], rtol=0., atol=1e-9)
+    assert Y.shape == (len(seeds), len(tspan) + 1, len(y0))
+
+def test_adaptive_deterministic():
+    # dy/dt = 1 - y without noise has the solution y = 1 - (1 - y0) exp(-t)
+    f = lambda Y, t, pars: pars[0] - Y
+    G = lambda Y, t: np.zeros_like(Y)
+    tspan = np.linspace(0, 5, 101)
+    Y, _ = simulator.adaptivesdeBatch(f, G, [[0.]], tspan, [1.], [0],
+                                      atol=1e-6, rtol=1e-6)
+    assert np.allclose(Y[0, :len(tspan), 0], 1. - np.exp(-tspan), rtol=0., atol=1e-4)
+
+def test_stationary_variance():
+    # dy = (c - k y) dt + dW has the stationary distribution N(c/k, 1/(2k)).
+    # The step size h = 1/k is at the stability limit of the Euler scheme,
+    # which doubles the variance.
+    f = lambda Y, t, pars: pars[0] - pars[1]*Y
+    G = lambda Y, t: np.ones_like(Y)
+    tspan = np.linspace(0, 200, 201)
+    seeds = list(range(200))
+    for scheme in ['semi-implicit', 'exponential']:
+        Y, _ = simulator.eulersdeBatch(f, G, [[10.]]*len(seeds), tspan, [10., 1.], seeds,
+                                       scheme=scheme, decay=[1.], noiseStep=1.)
+        # Discard the first 20 time points as burn in
+        states = Y[:, 20:len(tspan), 0]
+        assert abs(states.mean() - 10.) < 0.05
+        assert abs(states.var() - 0.5) < 0.05